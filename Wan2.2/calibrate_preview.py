@@ -0,0 +1,134 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import argparse
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from wan.configs import WAN_CONFIGS
+from wan.modules.vae2_1 import Wan2_1_VAE
+from wan.modules.vae2_2 import Wan2_2_VAE
+from wan.utils.device import get_best_device
+from wan.utils.preview import (
+    LatentPreviewer,
+    fit_preview,
+    pool_to_latent,
+    synthetic_videos,
+)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Fit the latent preview projection of a Wan VAE")
+    parser.add_argument(
+        "--task",
+        type=str,
+        default="t2v-A14B",
+        choices=list(WAN_CONFIGS.keys()),
+        help="The task whose VAE is calibrated.")
+    parser.add_argument(
+        "--ckpt_dir",
+        type=str,
+        required=True,
+        help="The path to the checkpoint directory.")
+    parser.add_argument(
+        "--media",
+        type=str,
+        nargs='*',
+        default=[],
+        help="Images or videos to calibrate on. Synthetic colour fields are added to them.")
+    parser.add_argument(
+        "--frame_num",
+        type=int,
+        default=17,
+        help="Frames per calibration video, 4n+1. Images are repeated over them.")
+    parser.add_argument(
+        "--resolution",
+        type=int,
+        default=256,
+        help="Side of the square the calibration videos are resized to.")
+    parser.add_argument(
+        "--num_synthetic",
+        type=int,
+        default=16,
+        help="Number of synthetic calibration videos.")
+    parser.add_argument(
+        "--save_file",
+        type=str,
+        default=None,
+        help="Where to write the fitted projection. Defaults to the preview checkpoint in ckpt_dir.")
+    return parser.parse_args()
+
+
+def _load_media(path, frame_num, resolution):
+    if path.lower().endswith(IMAGE_EXTENSIONS):
+        frames = np.asarray(Image.open(path).convert('RGB'))[None]
+    else:
+        from decord import VideoReader
+        reader = VideoReader(path)
+        indices = np.linspace(0, len(reader) - 1, frame_num).round()
+        frames = reader.get_batch(indices.astype(int).tolist()).asnumpy()
+    # [T, H, W, 3] uint8 -> [3, T, H, W] in [-1, 1]
+    video = torch.from_numpy(frames).permute(3, 0, 1, 2).float() / 127.5 - 1
+    video = F.interpolate(
+        video, size=(resolution, resolution), mode='bilinear',
+        align_corners=False)
+    if video.shape[1] < frame_num:
+        # images and short clips hold their last frame
+        pad = video[:, -1:].expand(-1, frame_num - video.shape[1], -1, -1)
+        video = torch.cat([video, pad], dim=1)
+    return video
+
+
+def main():
+    args = _parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s: %(message)s",
+        handlers=[logging.StreamHandler(stream=sys.stdout)])
+    assert (args.frame_num - 1) % 4 == 0, "frame_num should be 4n+1."
+    cfg = WAN_CONFIGS[args.task]
+    assert args.resolution % cfg.vae_stride[1] == 0, (
+        f"resolution should be a multiple of {cfg.vae_stride[1]}.")
+
+    device = get_best_device(0)
+    vae_cls = Wan2_2_VAE if cfg.vae_stride[1] == 16 else Wan2_1_VAE
+    vae = vae_cls(
+        vae_pth=os.path.join(args.ckpt_dir, cfg.vae_checkpoint), device=device)
+
+    videos = [
+        _load_media(path, args.frame_num, args.resolution)
+        for path in args.media
+    ]
+    videos += synthetic_videos(args.num_synthetic, args.frame_num,
+                               (args.resolution, args.resolution))
+    logging.info(f"Fitting the preview of {cfg.vae_checkpoint} on "
+                 f"{len(videos)} videos.")
+    weight, bias = fit_preview(vae, videos, cfg.vae_stride)
+
+    save_file = args.save_file or os.path.join(args.ckpt_dir,
+                                               cfg.preview_checkpoint)
+    previewer = LatentPreviewer(vae, save_file, cfg.vae_stride)
+    previewer.weight, previewer.bias = weight, bias
+    previewer.save()
+
+    # error of the preview against the downsampled decode
+    errors = []
+    for video in videos[:4]:
+        z = vae.encode([video.to(device)])[0]
+        preview = previewer(z).cpu()
+        x = pool_to_latent(vae.decode([z])[0].float().cpu(), preview.shape[1:],
+                           cfg.vae_stride[0])
+        errors.append((preview - x).abs().mean().item())
+    logging.info(f"Saved the preview projection to {save_file}, mean "
+                 f"absolute error {sum(errors) / len(errors):.4f}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import logging
 import os
 import sys
 import warnings
+from contextlib import nullcontext
 from datetime import datetime
 
 warnings.filterwarnings('ignore')
@@ -17,8 +18,11 @@ from PIL import Image
 import wan
 from wan.configs import MAX_AREA_CONFIGS, SIZE_CONFIGS, SUPPORTED_SIZES, WAN_CONFIGS
 from wan.distributed.util import init_distributed_group
+from wan.utils.compile import COMPILE_MODES
 from wan.utils.prompt_extend import DashScopePromptExpander, QwenPromptExpander
+from wan.utils.snapshot import snapshot_seed
 from wan.utils.utils import save_video, str2bool
+from wan.utils.video_writer import VideoWriter
 try:
     from wan.utils.utils import merge_video_audio
 except ImportError:
@@ -66,6 +70,19 @@ def _validate_args(args):
     if args.task == "i2v-A14B":
         assert args.image is not None, "Please specify the image path for i2v."
 
+    if "s2v" in args.task:
+        assert args.step_cache_threshold == 0, "The step cache is not supported for s2v."
+
+    if args.dit_vram_budget is not None:
+        assert not args.dit_fsdp, "dit_vram_budget is not supported with dit_fsdp."
+
+    assert args.preview_steps > 0, "preview_steps should be positive."
+    assert args.snapshot_steps > 0, "snapshot_steps should be positive."
+
+    if args.compile is not None:
+        assert not args.dit_fsdp, "compile is not supported with dit_fsdp."
+        assert args.dit_vram_budget is None, "compile is not supported with dit_vram_budget."
+
     cfg = WAN_CONFIGS[args.task]
 
     if args.sample_steps is None:
@@ -80,6 +97,10 @@ def _validate_args(args):
     if args.frame_num is None:
         args.frame_num = cfg.frame_num
 
+    if args.base_seed < 0 and args.snapshot_file is not None:
+        # a rerun without --base_seed resumes with the seed of the snapshot
+        seed = snapshot_seed(args.snapshot_file)
+        args.base_seed = seed if seed is not None else -1
     args.base_seed = args.base_seed if args.base_seed >= 0 else random.randint(
         0, sys.maxsize)
     # Size check
@@ -89,7 +110,7 @@ def _validate_args(args):
             task], f"Unsupport size {args.size} for task {args.task}, supported sizes are: {', '.join(SUPPORTED_SIZES[args.task])}"
 
 
-def _parse_args():
+def _build_parser():
     parser = argparse.ArgumentParser(
         description="Generate a image or video from a text prompt or image using Wan"
     )
@@ -128,6 +149,12 @@ def _parse_args():
         type=int,
         default=1,
         help="The size of the ulysses parallelism in DiT.")
+    parser.add_argument(
+        "--ring_size",
+        type=int,
+        default=1,
+        help="The size of the ring attention parallelism in DiT. The sequence parallel degree is ulysses_size * ring_size, so it is not limited by the number of attention heads."
+    )
     parser.add_argument(
         "--t5_fsdp",
         action="store_true",
@@ -138,6 +165,18 @@ def _parse_args():
         action="store_true",
         default=False,
         help="Whether to place T5 model on CPU.")
+    parser.add_argument(
+        "--t5_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the on-disk cache of T5 prompt embeddings. Encoded prompts are always cached in memory."
+    )
+    parser.add_argument(
+        "--audio_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the on-disk cache of s2v audio features, keyed by the audio file content."
+    )
     parser.add_argument(
         "--dit_fsdp",
         action="store_true",
@@ -208,6 +247,75 @@ def _parse_args():
         action="store_true",
         default=False,
         help="Whether to convert model paramerters dtype.")
+    parser.add_argument(
+        "--batch_cfg",
+        action="store_true",
+        default=False,
+        help="Whether to run the cond and uncond CFG passes as one batched forward. Falls back to sequential passes on OOM."
+    )
+    parser.add_argument(
+        "--stream_video",
+        action="store_true",
+        default=False,
+        help="Whether to encode the video while the VAE is still decoding, muxing the s2v audio in the same ffmpeg process."
+    )
+    parser.add_argument(
+        "--vae_tile_size",
+        type=int,
+        default=None,
+        help="Decode the VAE in overlapping spatial tiles of this many latent pixels (e.g. 32) to bound its peak memory."
+    )
+    parser.add_argument(
+        "--dit_vram_budget",
+        type=float,
+        default=None,
+        help="Device memory in GiB for the DiT weights, both MoE experts together. Experts that only fit one at a time are swapped in from host memory; otherwise the transformer blocks are streamed from pinned host memory, overlapping the copies with compute."
+    )
+    parser.add_argument(
+        "--prefetch_vram_budget",
+        type=float,
+        default=None,
+        help="Device memory in GiB that the next MoE expert (or the s2v DiT) may be prefetched into while the current one samples. Defaults to the free memory minus the measured peak of a sampling step, and at least a quarter of the device memory."
+    )
+    parser.add_argument(
+        "--no_pin_experts",
+        action="store_true",
+        default=False,
+        help="Do not pin the prefetched expert weights in host memory. Saves page-locked memory, but the prefetch no longer overlaps with sampling."
+    )
+    parser.add_argument(
+        "--compile",
+        type=str,
+        nargs="?",
+        const="default",
+        default=None,
+        choices=COMPILE_MODES,
+        help="Compile the DiT blocks with torch.compile in the given mode (default if no mode is given). Shapes are static per resolution, the first step of each resolution pays the compile time."
+    )
+    parser.add_argument(
+        "--compile_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the compiled DiT artifacts, keyed by model, latent shape and dtype, so later runs skip compiling."
+    )
+    parser.add_argument(
+        "--expert_prefetch_steps",
+        type=int,
+        default=1,
+        help="How many steps before the A14B expert switch the next expert starts loading in the background when offloading. 0 loads it at the switch."
+    )
+    parser.add_argument(
+        "--step_cache_threshold",
+        type=float,
+        default=0.0,
+        help="Accumulated relative change of the modulated DiT input below which a step reuses the cached block residual, e.g. 0.1-0.2. 0 disables the step cache. Not supported for s2v."
+    )
+    parser.add_argument(
+        "--step_cache_warmup",
+        type=int,
+        default=1,
+        help="Number of leading sampling steps that always run the DiT blocks when the step cache is enabled."
+    )
 
     # following args only works for s2v
     parser.add_argument(
@@ -238,8 +346,46 @@ def _parse_args():
         default=80,
         help="Number of frames per clip, 48 or 80 or others (must be multiple of 4) for 14B s2v"
     )
+    parser.add_argument(
+        "--pipeline_clips",
+        action="store_true",
+        default=False,
+        help="Whether to copy or write the finished frames of every s2v clip in the background. With offload_model, the DiT of the next clip is also reloaded during the VAE round trip; without it the gain is small, since the VAE round trip still runs before the next clip is sampled."
+    )
+    parser.add_argument(
+        "--audio_chunk_seconds",
+        type=float,
+        default=None,
+        help="Extract the s2v audio features in windows of this many seconds (e.g. 30) on a background thread, so long audio fits in memory and sampling starts before the whole track is encoded."
+    )
+    parser.add_argument(
+        "--preview_file",
+        type=str,
+        default=None,
+        help="PNG file that is overwritten with a cheap preview of the last latent frame during sampling, e.g. for a UI to display."
+    )
+    parser.add_argument(
+        "--preview_steps",
+        type=int,
+        default=5,
+        help="Number of sampling steps between two previews.")
+    parser.add_argument(
+        "--snapshot_file",
+        type=str,
+        default=None,
+        help="File the sampling state is saved to during sampling. If it exists, a run with the same arguments and inputs resumes from it instead of starting over, with the seed stored in it unless --base_seed is given. It is removed once the video is decoded."
+    )
+    parser.add_argument(
+        "--snapshot_steps",
+        type=int,
+        default=5,
+        help="Number of sampling steps between two snapshots.")
+
+    return parser
 
-    args = parser.parse_args()
+
+def _parse_args(argv=None):
+    args = _build_parser().parse_args(argv)
 
     _validate_args(args)
 
@@ -258,6 +404,195 @@ def _init_logging(rank):
         logging.basicConfig(level=logging.ERROR)
 
 
+def _pipeline_class(task):
+    if "t2v" in task:
+        return wan.WanT2V
+    elif "ti2v" in task:
+        return wan.WanTI2V
+    elif "s2v" in task:
+        return wan.WanS2V
+    return wan.WanI2V
+
+
+def _create_pipeline(args, cfg, device, rank):
+    pipeline_cls = _pipeline_class(args.task)
+    logging.info(f"Creating {pipeline_cls.__name__} pipeline.")
+    extra_kwargs = {}
+    if "s2v" in args.task:
+        extra_kwargs['audio_cache_dir'] = args.audio_cache_dir
+    if "ti2v" not in args.task:
+        extra_kwargs['prefetch_vram_budget'] = args.prefetch_vram_budget
+        extra_kwargs['pin_expert_memory'] = not args.no_pin_experts
+    return pipeline_cls(
+        config=cfg,
+        checkpoint_dir=args.ckpt_dir,
+        device_id=device,
+        rank=rank,
+        t5_fsdp=args.t5_fsdp,
+        dit_fsdp=args.dit_fsdp,
+        use_sp=(args.ulysses_size * args.ring_size > 1),
+        t5_cpu=args.t5_cpu,
+        convert_model_dtype=args.convert_model_dtype,
+        t5_cache_dir=args.t5_cache_dir,
+        vae_tile_size=args.vae_tile_size,
+        dit_vram_budget=args.dit_vram_budget,
+        compile_mode=args.compile,
+        compile_cache_dir=args.compile_cache_dir,
+        **extra_kwargs,
+    )
+
+
+def _preview_callback(args, cfg, on_preview=None):
+    if args.preview_file is None:
+        return None
+    stride = cfg.vae_stride[1]
+
+    def callback(step, preview):
+        # last latent frame, upscaled back to the video size
+        frame = preview[:, -1].add(1).mul_(127.5).clamp_(0, 255).to(
+            torch.uint8).permute(1, 2, 0).cpu().numpy()
+        image = Image.fromarray(frame)
+        image = image.resize((image.width * stride, image.height * stride),
+                             Image.BILINEAR)
+        tmp = args.preview_file + '.tmp'
+        image.save(tmp, format='PNG')
+        os.replace(tmp, args.preview_file)
+        logging.info(f"Preview of step {step + 1} saved to {args.preview_file}")
+        if on_preview is not None:
+            on_preview(step)
+
+    return callback
+
+
+def _run_pipeline(pipeline, args, img, video_writer=None,
+                  preview_callback=None, cancel_token=None):
+    logging.info("Generating video ...")
+    if "t2v" in args.task:
+        return pipeline.generate(
+            args.prompt,
+            size=SIZE_CONFIGS[args.size],
+            frame_num=args.frame_num,
+            shift=args.sample_shift,
+            sample_solver=args.sample_solver,
+            sampling_steps=args.sample_steps,
+            guide_scale=args.sample_guide_scale,
+            seed=args.base_seed,
+            offload_model=args.offload_model,
+            batch_cfg=args.batch_cfg,
+            step_cache_threshold=args.step_cache_threshold,
+            step_cache_warmup=args.step_cache_warmup,
+            video_writer=video_writer,
+            expert_prefetch_steps=args.expert_prefetch_steps,
+            preview_callback=preview_callback,
+            preview_steps=args.preview_steps,
+            cancel_token=cancel_token,
+            snapshot_file=args.snapshot_file,
+            snapshot_steps=args.snapshot_steps)
+    elif "ti2v" in args.task:
+        return pipeline.generate(
+            args.prompt,
+            img=img,
+            size=SIZE_CONFIGS[args.size],
+            max_area=MAX_AREA_CONFIGS[args.size],
+            frame_num=args.frame_num,
+            shift=args.sample_shift,
+            sample_solver=args.sample_solver,
+            sampling_steps=args.sample_steps,
+            guide_scale=args.sample_guide_scale,
+            seed=args.base_seed,
+            offload_model=args.offload_model,
+            batch_cfg=args.batch_cfg,
+            step_cache_threshold=args.step_cache_threshold,
+            step_cache_warmup=args.step_cache_warmup,
+            video_writer=video_writer,
+            preview_callback=preview_callback,
+            preview_steps=args.preview_steps,
+            cancel_token=cancel_token,
+            snapshot_file=args.snapshot_file,
+            snapshot_steps=args.snapshot_steps)
+    elif "s2v" in args.task:
+        return pipeline.generate(
+            input_prompt=args.prompt,
+            ref_image_path=args.image,
+            audio_path=args.audio,
+            num_repeat=args.num_clip,
+            pose_video=args.pose_video,
+            max_area=MAX_AREA_CONFIGS[args.size],
+            infer_frames=args.infer_frames,
+            shift=args.sample_shift,
+            sample_solver=args.sample_solver,
+            sampling_steps=args.sample_steps,
+            guide_scale=args.sample_guide_scale,
+            seed=args.base_seed,
+            offload_model=args.offload_model,
+            init_first_frame=args.start_from_ref,
+            batch_cfg=args.batch_cfg,
+            video_writer=video_writer,
+            pipeline_clips=args.pipeline_clips,
+            audio_chunk_seconds=args.audio_chunk_seconds,
+            preview_callback=preview_callback,
+            preview_steps=args.preview_steps,
+            cancel_token=cancel_token,
+            snapshot_file=args.snapshot_file,
+            snapshot_steps=args.snapshot_steps,
+        )
+    return pipeline.generate(
+        args.prompt,
+        img,
+        max_area=MAX_AREA_CONFIGS[args.size],
+        frame_num=args.frame_num,
+        shift=args.sample_shift,
+        sample_solver=args.sample_solver,
+        sampling_steps=args.sample_steps,
+        guide_scale=args.sample_guide_scale,
+        seed=args.base_seed,
+        offload_model=args.offload_model,
+        batch_cfg=args.batch_cfg,
+        step_cache_threshold=args.step_cache_threshold,
+        step_cache_warmup=args.step_cache_warmup,
+        video_writer=video_writer,
+        expert_prefetch_steps=args.expert_prefetch_steps,
+        preview_callback=preview_callback,
+        preview_steps=args.preview_steps,
+        cancel_token=cancel_token,
+        snapshot_file=args.snapshot_file,
+        snapshot_steps=args.snapshot_steps)
+
+
+def _resolve_save_file(args):
+    if args.save_file is None:
+        formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+        formatted_prompt = args.prompt.replace(" ", "_").replace("/",
+                                                                 "_")[:50]
+        suffix = '.mp4'
+        args.save_file = f"{args.task}_{args.size.replace('*','x') if sys.platform=='win32' else args.size}_{args.ulysses_size}_{formatted_prompt}_{formatted_time}" + suffix
+    return args.save_file
+
+
+def _open_video_writer(args, cfg):
+    save_file = _resolve_save_file(args)
+    logging.info(f"Streaming generated video to {save_file}")
+    return VideoWriter(
+        save_file,
+        fps=cfg.sample_fps,
+        audio_path=args.audio if "s2v" in args.task else None)
+
+
+def _save_outputs(args, cfg, video):
+    _resolve_save_file(args)
+    logging.info(f"Saving generated video to {args.save_file}")
+    save_video(
+        tensor=video[None],
+        save_file=args.save_file,
+        fps=cfg.sample_fps,
+        nrow=1,
+        normalize=True,
+        value_range=(-1, 1))
+    if "s2v" in args.task and merge_video_audio is not None:
+        merge_video_audio(video_path=args.save_file, audio_path=args.audio)
+    return args.save_file
+
+
 def generate(args):
     rank = int(os.getenv("RANK", 0))
     world_size = int(os.getenv("WORLD_SIZE", 1))
@@ -281,12 +616,12 @@ def generate(args):
             args.t5_fsdp or args.dit_fsdp
         ), f"t5_fsdp and dit_fsdp are not supported in non-distributed environments."
         assert not (
-            args.ulysses_size > 1
+            args.ulysses_size > 1 or args.ring_size > 1
         ), f"sequence parallel are not supported in non-distributed environments."
 
-    if args.ulysses_size > 1:
-        assert args.ulysses_size == world_size, f"The number of ulysses_size should be equal to the world size."
-        init_distributed_group()
+    if args.ulysses_size * args.ring_size > 1:
+        assert args.ulysses_size * args.ring_size == world_size, f"The product of ulysses_size and ring_size should be equal to the world size."
+        init_distributed_group(ring_size=args.ring_size)
 
     if args.use_prompt_extend:
         if args.prompt_extend_method == "dashscope":
@@ -346,134 +681,14 @@ def generate(args):
         args.prompt = input_prompt[0]
         logging.info(f"Extended prompt: {args.prompt}")
 
-    if "t2v" in args.task:
-        logging.info("Creating WanT2V pipeline.")
-        wan_t2v = wan.WanT2V(
-            config=cfg,
-            checkpoint_dir=args.ckpt_dir,
-            device_id=device,
-            rank=rank,
-            t5_fsdp=args.t5_fsdp,
-            dit_fsdp=args.dit_fsdp,
-            use_sp=(args.ulysses_size > 1),
-            t5_cpu=args.t5_cpu,
-            convert_model_dtype=args.convert_model_dtype,
-        )
+    pipeline = _create_pipeline(args, cfg, device, rank)
+    stream = args.stream_video and rank == 0
+    with _open_video_writer(args, cfg) if stream else nullcontext() as writer:
+        video = _run_pipeline(pipeline, args, img, writer,
+                              _preview_callback(args, cfg))
 
-        logging.info(f"Generating video ...")
-        video = wan_t2v.generate(
-            args.prompt,
-            size=SIZE_CONFIGS[args.size],
-            frame_num=args.frame_num,
-            shift=args.sample_shift,
-            sample_solver=args.sample_solver,
-            sampling_steps=args.sample_steps,
-            guide_scale=args.sample_guide_scale,
-            seed=args.base_seed,
-            offload_model=args.offload_model)
-    elif "ti2v" in args.task:
-        logging.info("Creating WanTI2V pipeline.")
-        wan_ti2v = wan.WanTI2V(
-            config=cfg,
-            checkpoint_dir=args.ckpt_dir,
-            device_id=device,
-            rank=rank,
-            t5_fsdp=args.t5_fsdp,
-            dit_fsdp=args.dit_fsdp,
-            use_sp=(args.ulysses_size > 1),
-            t5_cpu=args.t5_cpu,
-            convert_model_dtype=args.convert_model_dtype,
-        )
-
-        logging.info(f"Generating video ...")
-        video = wan_ti2v.generate(
-            args.prompt,
-            img=img,
-            size=SIZE_CONFIGS[args.size],
-            max_area=MAX_AREA_CONFIGS[args.size],
-            frame_num=args.frame_num,
-            shift=args.sample_shift,
-            sample_solver=args.sample_solver,
-            sampling_steps=args.sample_steps,
-            guide_scale=args.sample_guide_scale,
-            seed=args.base_seed,
-            offload_model=args.offload_model)
-    elif "s2v" in args.task:
-        logging.info("Creating WanS2V pipeline.")
-        wan_s2v = wan.WanS2V(
-            config=cfg,
-            checkpoint_dir=args.ckpt_dir,
-            device_id=device,
-            rank=rank,
-            t5_fsdp=args.t5_fsdp,
-            dit_fsdp=args.dit_fsdp,
-            use_sp=(args.ulysses_size > 1),
-            t5_cpu=args.t5_cpu,
-            convert_model_dtype=args.convert_model_dtype,
-        )
-        logging.info(f"Generating video ...")
-        video = wan_s2v.generate(
-            input_prompt=args.prompt,
-            ref_image_path=args.image,
-            audio_path=args.audio,
-            num_repeat=args.num_clip,
-            pose_video=args.pose_video,
-            max_area=MAX_AREA_CONFIGS[args.size],
-            infer_frames=args.infer_frames,
-            shift=args.sample_shift,
-            sample_solver=args.sample_solver,
-            sampling_steps=args.sample_steps,
-            guide_scale=args.sample_guide_scale,
-            seed=args.base_seed,
-            offload_model=args.offload_model,
-            init_first_frame=args.start_from_ref,
-        )
-
-    else:
-        logging.info("Creating WanI2V pipeline.")
-        wan_i2v = wan.WanI2V(
-            config=cfg,
-            checkpoint_dir=args.ckpt_dir,
-            device_id=device,
-            rank=rank,
-            t5_fsdp=args.t5_fsdp,
-            dit_fsdp=args.dit_fsdp,
-            use_sp=(args.ulysses_size > 1),
-            t5_cpu=args.t5_cpu,
-            convert_model_dtype=args.convert_model_dtype,
-        )
-
-        logging.info("Generating video ...")
-        video = wan_i2v.generate(
-            args.prompt,
-            img,
-            max_area=MAX_AREA_CONFIGS[args.size],
-            frame_num=args.frame_num,
-            shift=args.sample_shift,
-            sample_solver=args.sample_solver,
-            sampling_steps=args.sample_steps,
-            guide_scale=args.sample_guide_scale,
-            seed=args.base_seed,
-            offload_model=args.offload_model)
-
-    if rank == 0:
-        if args.save_file is None:
-            formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-            formatted_prompt = args.prompt.replace(" ", "_").replace("/",
-                                                                     "_")[:50]
-            suffix = '.mp4'
-            args.save_file = f"{args.task}_{args.size.replace('*','x') if sys.platform=='win32' else args.size}_{args.ulysses_size}_{formatted_prompt}_{formatted_time}" + suffix
-
-        logging.info(f"Saving generated video to {args.save_file}")
-        save_video(
-            tensor=video[None],
-            save_file=args.save_file,
-            fps=cfg.sample_fps,
-            nrow=1,
-            normalize=True,
-            value_range=(-1, 1))
-        if "s2v" in args.task and merge_video_audio is not None:
-            merge_video_audio(video_path=args.save_file, audio_path=args.audio)
+    if rank == 0 and not stream:
+        _save_outputs(args, cfg, video)
     del video
 
     torch.cuda.synchronize()
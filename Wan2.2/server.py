@@ -0,0 +1,536 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import logging
+import os
+import time
+import traceback
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+warnings.filterwarnings('ignore')
+
+from PIL import Image
+
+from generate import (
+    _build_parser,
+    _create_pipeline,
+    _init_logging,
+    _open_video_writer,
+    _preview_callback,
+    _run_pipeline,
+    _save_outputs,
+    _validate_args,
+)
+from wan.configs import WAN_CONFIGS
+from wan.utils.cancel import CancellationToken
+from wan.utils.device import empty_cache_if_needed, get_best_device
+
+# Constructor arguments of a pipeline. Jobs that agree on all of them share the
+# same resident pipeline.
+PIPELINE_KEYS = ('task', 'ckpt_dir', 't5_fsdp', 'dit_fsdp', 't5_cpu',
+                 'convert_model_dtype', 't5_cache_dir', 'vae_tile_size',
+                 'dit_vram_budget', 'prefetch_vram_budget', 'no_pin_experts',
+                 'audio_cache_dir', 'compile', 'compile_cache_dir')
+
+# Arguments that need a distributed launch or extra models and are therefore
+# rejected by the single-process server.
+UNSUPPORTED_ARGS = {
+    'ulysses_size': 1,
+    'ring_size': 1,
+    't5_fsdp': False,
+    'dit_fsdp': False,
+    'use_prompt_extend': False,
+}
+
+TERMINAL_STATES = ('finished', 'failed', 'cancelled')
+
+# Events that report progress without changing the state of a job.
+PROGRESS_EVENTS = ('preview',)
+
+
+def _job_parser():
+    # the generate.py parser, raising instead of exiting the server
+    parser = _build_parser()
+
+    def error(message):
+        raise ValueError(f"Invalid arguments: {message}")
+
+    parser.error = error
+    return parser
+
+
+def _params_to_argv(parser, params):
+    r"""
+    Converts the JSON object of a job to generate.py arguments, so that every
+    value goes through the `type` and `choices` of its argument. A null value
+    keeps the default, a flag takes a boolean and an argument with `nargs`
+    a list or a single value.
+    """
+    actions = {a.dest: a for a in parser._actions if a.option_strings}
+    argv = []
+    for key, value in params.items():
+        action = actions.get(key)
+        if action is None or key == 'help':
+            raise ValueError(f"Unknown argument: {key}")
+        flag = action.option_strings[0]
+        if value is None:
+            continue
+        if action.nargs == 0:
+            if not isinstance(value, bool):
+                raise ValueError(f"`{key}` must be true or false.")
+            if value:
+                argv.append(flag)
+            continue
+        if isinstance(value, (list, tuple)):
+            if action.nargs in (None, '?'):
+                raise ValueError(f"`{key}` takes a single value.")
+            argv += [flag] + [str(v) for v in value]
+        else:
+            argv += [flag, str(value)]
+    return argv
+
+
+class PipelinePool:
+    r"""
+    Keeps up to `max_pipelines` pipelines resident between jobs and evicts the
+    least recently used one when a new configuration has to be loaded.
+    """
+
+    def __init__(self, max_pipelines=1, device_id=0):
+        self.max_pipelines = max_pipelines
+        self.device_id = device_id
+        self._pipelines = OrderedDict()
+
+    @staticmethod
+    def key(args):
+        return tuple(getattr(args, k) for k in PIPELINE_KEYS)
+
+    def __contains__(self, args):
+        return self.key(args) in self._pipelines
+
+    def get(self, args):
+        key = self.key(args)
+        if key in self._pipelines:
+            self._pipelines.move_to_end(key)
+            return self._pipelines[key]
+        while len(self._pipelines) >= self.max_pipelines:
+            self._evict()
+        pipeline = _create_pipeline(
+            args, WAN_CONFIGS[args.task], self.device_id, rank=0)
+        self._pipelines[key] = pipeline
+        return pipeline
+
+    def clear(self):
+        while self._pipelines:
+            self._evict()
+
+    def _evict(self):
+        key, pipeline = self._pipelines.popitem(last=False)
+        logging.info(f"Unloading {type(pipeline).__name__} pipeline for {key}.")
+        del pipeline
+        gc.collect()
+        empty_cache_if_needed(get_best_device(self.device_id))
+
+    def describe(self):
+        return [dict(zip(PIPELINE_KEYS, key)) for key in self._pipelines]
+
+
+class Job:
+
+    def __init__(self, job_id, args):
+        self.job_id = job_id
+        self.args = args
+        self.state = 'queued'
+        self.events = []
+        self.subscribers = set()
+        self.created = time.time()
+        self.cancel_token = CancellationToken()
+
+    def summary(self):
+        return {
+            'job_id': self.job_id,
+            'state': self.state,
+            'task': self.args.task,
+            'prompt': self.args.prompt,
+            'save_file': self.args.save_file,
+        }
+
+
+class InferenceServer:
+    r"""
+    Line-delimited JSON front-end that serializes generation jobs onto a single
+    worker thread and keeps the pipelines loaded between them.
+
+    Every request is one JSON object per line with an `action` field:
+
+        {"action": "submit", "args": [...] | {...}, "stream": true}
+        {"action": "status", "job_id": 1}
+        {"action": "watch", "job_id": 1}
+        {"action": "cancel", "job_id": 1}
+        {"action": "jobs"}
+        {"action": "unload"}
+        {"action": "ping"}
+
+    `args` is either an argv list or a dict of `generate.py` arguments. Job
+    events (`queued`, `loading`, `running`, `saving`, `finished`, `failed`,
+    `cancelled`) are written back as JSON lines while a client is subscribed
+    to the job. A cancelled job stops before its next sampling step and
+    leaves its pipeline loaded for the next job. Jobs with a `preview_file`
+    also send a `preview` event every `preview_steps` sampling steps, after
+    the preview image has been rewritten.
+    """
+
+    def __init__(self, defaults, max_pipelines=1, max_history=256):
+        r"""
+        Args:
+            defaults (`dict`):
+                Values applied to every job before its own arguments, e.g. the
+                server's checkpoint directory.
+            max_pipelines (`int`, *optional*, defaults to 1):
+                Number of pipelines kept resident at the same time.
+            max_history (`int`, *optional*, defaults to 256):
+                Number of finished jobs whose status is kept for queries.
+        """
+        self.defaults = defaults
+        self.max_history = max_history
+        self.pool = PipelinePool(max_pipelines=max_pipelines)
+        self.jobs = OrderedDict()
+        self.queue = None
+        self.loop = None
+        self._ids = itertools.count(1)
+        # All GPU work happens on this thread, one job at a time.
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='wan-worker')
+
+    def _default_argv(self):
+        argv = []
+        for key, value in self.defaults.items():
+            if value is not None:
+                argv += [f'--{key}', str(value)]
+        return argv
+
+    def parse_job_args(self, params):
+        parser = _job_parser()
+        if isinstance(params, (list, tuple)):
+            argv = [str(p) for p in params]
+        elif isinstance(params, dict):
+            argv = _params_to_argv(parser, params)
+        else:
+            raise ValueError("`args` must be a list or an object.")
+        args = parser.parse_args(self._default_argv() + argv)
+        try:
+            _validate_args(args)
+        except AssertionError as e:
+            raise ValueError(f"Invalid arguments: {e}") from None
+        for key, expected in UNSUPPORTED_ARGS.items():
+            if getattr(args, key) != expected:
+                raise ValueError(
+                    f"`{key}` is not supported in server mode, use generate.py."
+                )
+        if args.offload_model is None:
+            args.offload_model = True
+        return args
+
+    def submit(self, args):
+        job = Job(next(self._ids), args)
+        self.jobs[job.job_id] = job
+        self._trim_history()
+        self.queue.put_nowait(job)
+        self._emit(job, 'queued', position=self.queue.qsize())
+        return job
+
+    def _trim_history(self):
+        finished = [
+            j for j in self.jobs.values() if j.state in TERMINAL_STATES
+        ]
+        for job in finished[:max(0, len(finished) - self.max_history)]:
+            del self.jobs[job.job_id]
+
+    def _emit(self, job, event, **payload):
+        message = {'event': event, 'job_id': job.job_id, **payload}
+        if event not in PROGRESS_EVENTS:
+            job.state = event
+        job.events.append(message)
+        for subscriber in list(job.subscribers):
+            subscriber.put_nowait(message)
+
+    def _emit_threadsafe(self, job, event, **payload):
+        self.loop.call_soon_threadsafe(
+            lambda: self._emit(job, event, **payload))
+
+    def _execute(self, job):
+        r"""
+        Runs `job` and returns the saved file and the elapsed time, or None as
+        the file if the job was cancelled.
+        """
+        args = job.args
+        cfg = WAN_CONFIGS[args.task]
+        start = time.time()
+        if job.cancel_token.cancelled:
+            return None, 0.
+        if args not in self.pool:
+            self._emit_threadsafe(job, 'loading', task=args.task)
+        pipeline = self.pool.get(args)
+        img = None
+        if args.image is not None:
+            img = Image.open(args.image).convert("RGB")
+        self._emit_threadsafe(job, 'running', seed=args.base_seed)
+        preview_callback = _preview_callback(
+            args, cfg, lambda step: self._emit_threadsafe(
+                job,
+                'preview',
+                step=step + 1,
+                preview_file=os.path.abspath(args.preview_file)))
+        if args.stream_video:
+            with _open_video_writer(args, cfg) as writer:
+                _run_pipeline(pipeline, args, img, writer, preview_callback,
+                              job.cancel_token)
+                if job.cancel_token.cancelled:
+                    # drop the partial file instead of finalizing it
+                    writer.abort()
+                    return self._cancelled(start)
+                self._emit_threadsafe(job, 'saving')
+            return writer.save_file, time.time() - start
+        video = _run_pipeline(
+            pipeline,
+            args,
+            img,
+            preview_callback=preview_callback,
+            cancel_token=job.cancel_token)
+        if job.cancel_token.cancelled:
+            del video
+            return self._cancelled(start)
+        self._emit_threadsafe(job, 'saving')
+        save_file = _save_outputs(args, cfg, video)
+        del video
+        return save_file, time.time() - start
+
+    def _cancelled(self, start):
+        # free the intermediates of the aborted run, the models stay loaded
+        gc.collect()
+        empty_cache_if_needed(get_best_device(self.pool.device_id))
+        return None, time.time() - start
+
+    def cancel(self, job):
+        if job.state in TERMINAL_STATES:
+            return False
+        job.cancel_token.cancel()
+        return True
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                save_file, elapsed = await self.loop.run_in_executor(
+                    self._executor, self._execute, job)
+                if save_file is None:
+                    self._emit(job, 'cancelled', seconds=round(elapsed, 2))
+                    continue
+                self._emit(
+                    job,
+                    'finished',
+                    save_file=os.path.abspath(save_file),
+                    seconds=round(elapsed, 2))
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                self._emit(job, 'failed', error=f'{type(e).__name__}: {e}')
+            finally:
+                self.queue.task_done()
+
+    async def _stream(self, writer, job, replay):
+        subscriber = asyncio.Queue()
+        history = list(job.events) if replay else []
+        job.subscribers.add(subscriber)
+        try:
+            for message in history:
+                await self._send(writer, message)
+                if message['event'] in TERMINAL_STATES:
+                    return
+            while True:
+                message = await subscriber.get()
+                await self._send(writer, message)
+                if message['event'] in TERMINAL_STATES:
+                    return
+        finally:
+            job.subscribers.discard(subscriber)
+
+    @staticmethod
+    async def _send(writer, message):
+        writer.write((json.dumps(message, ensure_ascii=False) + '\n').encode())
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    await self._dispatch(request, writer)
+                except ConnectionError:
+                    raise
+                except SystemExit:
+                    await self._send(writer, {
+                        'event': 'error',
+                        'error': 'Invalid generate.py arguments.'
+                    })
+                except Exception as e:
+                    await self._send(writer, {
+                        'event': 'error',
+                        'error': f'{type(e).__name__}: {e}'
+                    })
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request, writer):
+        action = request.get('action')
+        if action == 'submit':
+            args = self.parse_job_args(request.get('args', []))
+            job = self.submit(args)
+            if request.get('stream', True):
+                await self._stream(writer, job, replay=True)
+            else:
+                await self._send(writer, job.events[0])
+        elif action == 'cancel':
+            job = self.jobs.get(request.get('job_id'))
+            if job is None:
+                raise KeyError(f"Unknown job {request.get('job_id')}")
+            await self._send(
+                writer, {
+                    'event': 'cancel',
+                    'job_id': job.job_id,
+                    'accepted': self.cancel(job)
+                })
+        elif action in ('status', 'watch'):
+            job = self.jobs.get(request.get('job_id'))
+            if job is None:
+                raise KeyError(f"Unknown job {request.get('job_id')}")
+            if action == 'watch':
+                await self._stream(writer, job, replay=True)
+            else:
+                await self._send(writer, {'event': 'status', **job.summary()})
+        elif action == 'jobs':
+            await self._send(writer, {
+                'event': 'jobs',
+                'jobs': [j.summary() for j in self.jobs.values()],
+                'pipelines': self.pool.describe(),
+            })
+        elif action == 'unload':
+            await self.loop.run_in_executor(self._executor, self.pool.clear)
+            await self._send(writer, {'event': 'unloaded'})
+        elif action == 'ping':
+            await self._send(writer, {'event': 'pong'})
+        else:
+            raise ValueError(f"Unknown action: {action}")
+
+    async def preload(self, tasks):
+        for task in tasks:
+            # Only the constructor arguments matter, so the per-task size and
+            # sampling defaults are not validated here.
+            args = _build_parser().parse_args(self._default_argv() +
+                                              ['--task', task])
+            logging.info(f"Preloading {task} pipeline.")
+            await self.loop.run_in_executor(self._executor, self.pool.get,
+                                            args)
+
+    async def serve(self, host, port, unix_socket=None, preload=()):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(
+                self.handle, path=unix_socket)
+            logging.info(f"Listening on unix socket {unix_socket}")
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            logging.info(f"Listening on {host}:{port}")
+        worker = asyncio.create_task(self.worker())
+        await self.preload(preload)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            worker.cancel()
+            self._executor.shutdown(wait=False)
+
+
+def _parse_server_args():
+    parser = argparse.ArgumentParser(
+        description="Serve Wan generation jobs from resident pipelines")
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="The interface to listen on.")
+    parser.add_argument(
+        "--port", type=int, default=8765, help="The TCP port to listen on.")
+    parser.add_argument(
+        "--unix_socket",
+        type=str,
+        default=None,
+        help="Listen on this unix socket path instead of TCP.")
+    parser.add_argument(
+        "--ckpt_dir",
+        type=str,
+        default=None,
+        help="The default checkpoint directory of submitted jobs.")
+    parser.add_argument(
+        "--t5_cache_dir",
+        type=str,
+        default=None,
+        help="The default T5 embedding cache directory of submitted jobs.")
+    parser.add_argument(
+        "--audio_cache_dir",
+        type=str,
+        default=None,
+        help="The default s2v audio feature cache directory of submitted jobs.")
+    parser.add_argument(
+        "--max_pipelines",
+        type=int,
+        default=1,
+        help="How many pipelines are kept resident at the same time.")
+    parser.add_argument(
+        "--preload",
+        type=str,
+        nargs="*",
+        default=[],
+        choices=list(WAN_CONFIGS.keys()),
+        help="Tasks whose pipelines are loaded at startup.")
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_server_args()
+    _init_logging(0)
+    assert int(os.getenv("WORLD_SIZE", 1)) == 1, \
+        "server.py runs in a single process, use generate.py for distributed jobs."
+    if args.unix_socket is not None and os.path.exists(args.unix_socket):
+        os.remove(args.unix_socket)
+
+    server = InferenceServer(
+        defaults={
+            'ckpt_dir': args.ckpt_dir,
+            't5_cache_dir': args.t5_cache_dir,
+            'audio_cache_dir': args.audio_cache_dir,
+        },
+        max_pipelines=args.max_pipelines)
+    try:
+        asyncio.run(
+            server.serve(
+                args.host,
+                args.port,
+                unix_socket=args.unix_socket,
+                preload=args.preload))
+    except KeyboardInterrupt:
+        logging.info("Shutting down.")
+
+
+if __name__ == "__main__":
+    main()
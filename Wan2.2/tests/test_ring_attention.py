@@ -0,0 +1,107 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Checks ring and hybrid Ulysses/ring attention against single-process
+attention, on CPU with gloo, so it runs without GPUs:
+
+    python tests/test_ring_attention.py [--world_size 4]
+"""
+import argparse
+import os
+import socket
+import sys
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wan.distributed.ulysses import distributed_attention
+from wan.distributed.util import init_distributed_group, sp_split_sizes
+from wan.modules.attention import attention
+
+BATCH = 2
+HEADS = 4
+HEAD_DIM = 16
+ATOL = 3e-2
+
+
+def _reference(q, k, v, seq_lens):
+    # single-process attention over the unpadded keys of every sample
+    return torch.cat([
+        attention(q[i:i + 1], k[i:i + 1, :n], v[i:i + 1, :n])
+        for i, n in enumerate(seq_lens.tolist())
+    ]).float()
+
+
+def _check(name, ring_size, length, seq_lens, uneven):
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    init_distributed_group(ring_size)
+
+    # every rank draws the same full sequence and keeps its shard
+    g = torch.Generator().manual_seed(length)
+    q, k, v = [
+        torch.randn(BATCH, length, HEADS, HEAD_DIM, generator=g)
+        for _ in range(3)
+    ]
+    seq_lens = torch.tensor(seq_lens)
+    split_sizes = sp_split_sizes(length, world_size) if uneven else None
+    sizes = split_sizes or [length // world_size] * world_size
+    start = sum(sizes[:rank])
+    shard = slice(start, start + sizes[rank])
+
+    x = distributed_attention(
+        q[:, shard].contiguous(),
+        k[:, shard].contiguous(),
+        v[:, shard].contiguous(),
+        seq_lens=seq_lens,
+        split_sizes=split_sizes).float()
+    error = (x - _reference(q, k, v, seq_lens)[:, shard]).abs().max().item()
+    assert error < ATOL, f"{name}: rank {rank} differs by {error:.4f}."
+    if rank == 0:
+        print(f"{name}: max abs error {error:.4f}")
+
+
+def _worker(rank, world_size, port):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        length = 8 * world_size
+        # the padding starts inside an earlier block than the last one
+        seq_lens = [length, length - 8 - 3]
+        _check('ring', world_size, length, seq_lens, uneven=False)
+        _check('ring uneven', world_size, length + 3, seq_lens, uneven=True)
+        if world_size % 2 == 0 and world_size > 2:
+            _check('hybrid', world_size // 2, length, seq_lens, uneven=False)
+            _check(
+                'hybrid uneven',
+                world_size // 2,
+                length + 3,
+                seq_lens,
+                uneven=True)
+    finally:
+        dist.destroy_process_group()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_ring_attention(world_size=4):
+    mp.spawn(
+        _worker, args=(world_size, _free_port()), nprocs=world_size, join=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check ring attention against single-process attention")
+    parser.add_argument(
+        "--world_size",
+        type=int,
+        default=4,
+        help="Number of CPU processes. Hybrid Ulysses/ring attention is checked for even sizes above 2."
+    )
+    test_ring_attention(parser.parse_args().world_size)
@@ -15,6 +15,7 @@ i2v_A14B.t5_tokenizer = 'google/umt5-xxl'
 # vae
 i2v_A14B.vae_checkpoint = 'Wan2.1_VAE.pth'
 i2v_A14B.vae_stride = (4, 8, 8)
+i2v_A14B.preview_checkpoint = 'Wan2.1_VAE_preview.pth'
 
 # transformer
 i2v_A14B.patch_size = (1, 2, 2)
@@ -15,6 +15,7 @@ s2v_14B.t5_tokenizer = 'google/umt5-xxl'
 # vae
 s2v_14B.vae_checkpoint = 'Wan2.1_VAE.pth'
 s2v_14B.vae_stride = (4, 8, 8)
+s2v_14B.preview_checkpoint = 'Wan2.1_VAE_preview.pth'
 
 # wav2vec
 s2v_14B.wav2vec = "wav2vec2-large-xlsr-53-english"
@@ -0,0 +1,142 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import torch
+import torch.distributed as dist
+
+__all__ = ['ring_attention']
+
+
+def _finite(lse):
+    # rows without any valid key have lse -inf, keep exp() of them at 0
+    return lse.masked_fill(torch.isneginf(lse), 0)
+
+
+def _block_attention(q, k, v, scale, key_mask=None, chunk_bytes=256 * 1024**2):
+    """
+    Attention of `q` over one K/V block that also returns the log-sum-exp of
+    the scores, so that the results of several blocks can be merged.
+
+    Args:
+        q:           [B, N, Lq, C1].
+        k:           [B, N, Lk, C1].
+        v:           [B, N, Lk, C2].
+        scale:       softmax scale.
+        key_mask:    [B, Lk], True for the keys to attend to. All if None.
+        chunk_bytes: bound of the float32 score matrix of one query chunk.
+
+    Returns:
+        out: [B, N, Lq, C2] in float32.
+        lse: [B, N, Lq] in float32, -inf where no key is attended to.
+    """
+    b, n, lq, _ = q.shape
+    rows = max(1, chunk_bytes // (b * n * k.shape[2] * 4))
+    k_t = k.transpose(-1, -2)
+    outs, lses = [], []
+    for i in range(0, lq, rows):
+        scores = torch.matmul(q[:, :, i:i + rows], k_t).float().mul_(scale)
+        if key_mask is not None:
+            scores.masked_fill_(~key_mask[:, None, None, :], float('-inf'))
+        lse = torch.logsumexp(scores, dim=-1)
+        probs = scores.sub_(_finite(lse).unsqueeze(-1)).exp_()
+        outs.append(torch.matmul(probs.to(v.dtype), v).float())
+        lses.append(lse)
+    return torch.cat(outs, dim=2), torch.cat(lses, dim=2)
+
+
+def _merge(out, lse, block_out, block_lse):
+    """
+    Online-softmax update of the running output with one more block.
+    """
+    if out is None:
+        return block_out, block_lse
+    new_lse = torch.logaddexp(lse, block_lse)
+    finite = _finite(new_lse)
+    out.mul_(torch.exp(lse - finite).unsqueeze(-1))
+    out.add_(block_out.mul_(torch.exp(block_lse - finite).unsqueeze(-1)))
+    return out, new_lse
+
+
+def ring_attention(
+        q,
+        k,
+        v,
+        ranks,
+        group=None,
+        seq_lens=None,
+        window_size=(-1, -1),
+        softmax_scale=None,
+        dtype=torch.bfloat16,
+        block_sizes=None,
+):
+    """
+    Performs ring attention over a sequence sharded across `ranks`.
+    please refer to https://arxiv.org/abs/2310.01889
+
+    Every rank keeps its queries and passes its K/V block to the next rank of
+    the ring, so after `len(ranks)` steps each query has seen the whole
+    sequence. The transfer of the next block is issued before the current
+    block is computed, and the partial results are combined with an online
+    softmax. Keys at or past the length of their sample in `seq_lens` are
+    masked in every block, wherever they sit in the ring. Sliding window
+    attention is not supported. Only point-to-point sends are used, so any
+    backend works, including gloo on CPU.
+
+    Args:
+        q:             [B, Lq // p, Nq, C1].
+        k:             [B, Lk // p, Nk, C1].
+        v:             [B, Lk // p, Nk, C1]. Nq must be equal to Nk.
+        ranks:         global ranks of the ring, in sequence order.
+        group:         process group containing `ranks`.
+        seq_lens:      [B], length of each sequence in batch. No masking if
+                       None.
+        window_size:   must be (-1, -1), i.e. full attention.
+        softmax_scale: defaults to C1 ** -0.5.
+        dtype:         dtype of the attention computation and the output.
+        block_sizes:   sequence length of the block of every rank in `ranks`,
+                       defaults to the local length for all.
+    """
+    assert tuple(window_size) == (-1, -1), \
+        "ring attention does not support sliding window attention."
+    size = len(ranks)
+    idx = ranks.index(dist.get_rank())
+    send_to = ranks[(idx + 1) % size]
+    recv_from = ranks[(idx - 1) % size]
+    scale = softmax_scale or q.shape[-1]**-0.5
+
+    # [B, L, N, C] -> [B, N, L, C]; K and V travel as one message
+    q = q.to(dtype).transpose(1, 2)
+    kv = torch.stack([k.to(dtype), v.to(dtype)]).transpose(2, 3).contiguous()
+
+    # global start of the block of every ring index
+    if block_sizes is None:
+        block_sizes = [kv.shape[3]] * size
+    offsets = [sum(block_sizes[:i]) for i in range(size)]
+    if seq_lens is not None:
+        seq_lens = torch.as_tensor(seq_lens, device=q.device).view(-1, 1)
+
+    out = lse = None
+    for step in range(size):
+        if step + 1 < size:
+            # the block that started `step + 1` ranks back in the ring
+            shape = list(kv.shape)
+            shape[3] = block_sizes[(idx - step - 1) % size]
+            next_kv = kv.new_empty(shape)
+            reqs = dist.batch_isend_irecv([
+                dist.P2POp(dist.isend, kv, send_to, group),
+                dist.P2POp(dist.irecv, next_kv, recv_from, group),
+            ])
+        key_mask = None
+        if seq_lens is not None:
+            # the block that started `step` ranks back in the ring
+            start = offsets[(idx - step) % size]
+            pos = torch.arange(
+                start, start + kv.shape[3], device=q.device).view(1, -1)
+            key_mask = pos < seq_lens
+        out, lse = _merge(out, lse,
+                          *_block_attention(q, kv[0], kv[1], scale, key_mask))
+        if step + 1 < size:
+            for req in reqs:
+                req.wait()
+            kv = next_kv
+
+    # [B, N, L, C] -> [B, L, N, C]
+    return out.to(dtype).transpose(1, 2).contiguous()
@@ -1,21 +1,24 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import torch
 import torch.cuda.amp as amp
-
-from ..modules.model import sinusoidal_embedding_1d
+import torch.distributed as dist
+
+from ..modules.model import (
+    cached_rope_table,
+    rope_freqs_key,
+    rope_grid_freqs,
+    rope_rotate,
+)
 from .ulysses import distributed_attention
-from .util import gather_forward, get_rank, get_world_size
+from .util import gather_forward, get_rank, get_world_size, sp_split_sizes
 
 
 def pad_freqs(original_tensor, target_len):
-    seq_len, s1, s2 = original_tensor.shape
-    pad_size = target_len - seq_len
-    padding_tensor = torch.ones(
-        pad_size,
-        s1,
-        s2,
-        dtype=original_tensor.dtype,
-        device=original_tensor.device)
+    # pad a real-valued rotation table with the identity rotation
+    pad_size = target_len - original_tensor.size(0)
+    padding_tensor = original_tensor.new_zeros(pad_size,
+                                               *original_tensor.shape[1:])
+    padding_tensor[..., 0] = 1
     padded_tensor = torch.cat([original_tensor, padding_tensor], dim=0)
     return padded_tensor
 
@@ -27,38 +30,33 @@ def rope_apply(x, grid_sizes, freqs):
     grid_sizes: [B, 3].
     freqs:      [M, C // 2].
     """
-    s, n, c = x.size(1), x.size(2), x.size(3) // 2
-    # split freqs
-    freqs = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
+    s = x.size(1)
+    sp_rank = get_rank()
+    grid_sizes = grid_sizes.tolist()
+    split_sizes = sp_split_sizes(max(f * h * w for f, h, w in grid_sizes))
+    assert split_sizes[sp_rank] == s
+    start = sum(split_sizes[:sp_rank])
+
+    # rotation table of the tokens held by this rank
+    def rank_table(f, h, w):
+
+        def build_fn():
+            table = rope_grid_freqs(freqs, f, h, w, x.device)
+            table = pad_freqs(table, sum(split_sizes))
+            return table[start:start + s].clone()
+
+        key = ('sp', rope_freqs_key(freqs), str(x.device), f, h, w,
+               tuple(split_sizes), sp_rank)
+        return cached_rope_table(key, build_fn, freqs)
+
+    if all(g == grid_sizes[0] for g in grid_sizes):
+        return rope_rotate(x, rank_table(*grid_sizes[0]))
 
     # loop over samples
     output = []
-    for i, (f, h, w) in enumerate(grid_sizes.tolist()):
-        seq_len = f * h * w
-
-        # precompute multipliers
-        x_i = torch.view_as_complex(x[i, :s].to(torch.float64).reshape(
-            s, n, -1, 2))
-        freqs_i = torch.cat([
-            freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
-            freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
-            freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
-        ],
-                            dim=-1).reshape(seq_len, 1, -1)
-
-        # apply rotary embedding
-        sp_size = get_world_size()
-        sp_rank = get_rank()
-        freqs_i = pad_freqs(freqs_i, s * sp_size)
-        s_per_rank = s
-        freqs_i_rank = freqs_i[(sp_rank * s_per_rank):((sp_rank + 1) *
-                                                       s_per_rank), :, :]
-        x_i = torch.view_as_real(x_i * freqs_i_rank).flatten(2)
-        x_i = torch.cat([x_i, x[i, s:]])
-
-        # append to collection
-        output.append(x_i)
-    return torch.stack(output).float()
+    for i, (f, h, w) in enumerate(grid_sizes):
+        output.append(rope_rotate(x[i], rank_table(f, h, w)))
+    return torch.stack(output)
 
 
 def sp_dit_forward(
@@ -68,11 +66,13 @@ def sp_dit_forward(
     context,
     seq_len,
     y=None,
+    step_cache=None,
 ):
     """
     x:              A list of videos each with shape [C, T, H, W].
     t:              [B].
     context:        A list of text embeddings each with shape [L, C].
+    step_cache:     Optional StepCache that may skip the blocks.
     """
     if self.model_type == 'i2v':
         assert y is not None
@@ -91,24 +91,22 @@ def sp_dit_forward(
     x = [u.flatten(2).transpose(1, 2) for u in x]
     seq_lens = torch.tensor([u.size(1) for u in x], dtype=torch.long)
     assert seq_lens.max() <= seq_len
+
+    # Context Parallel, shard the real tokens instead of padding to seq_len
+    split_sizes = sp_split_sizes(int(seq_lens.max()))
+    start = sum(split_sizes[:get_rank()])
+    end = start + split_sizes[get_rank()]
+    x = [u[:, start:end] for u in x]
     x = torch.cat([
-        torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))], dim=1)
-        for u in x
+        torch.cat([u, u.new_zeros(1, end - start - u.size(1), u.size(2))],
+                  dim=1) for u in x
     ])
 
-    # time embeddings
-    if t.dim() == 1:
-        t = t.expand(t.size(0), seq_len)
-    with torch.amp.autocast('cuda', dtype=torch.float32):
-        bt = t.size(0)
-        t = t.flatten()
-        e = self.time_embedding(
-            sinusoidal_embedding_1d(self.freq_dim,
-                                    t).unflatten(0, (bt, seq_len)).float())
-        e0 = self.time_projection(e).unflatten(2, (6, self.dim))
-        assert e.dtype == torch.float32 and e0.dtype == torch.float32
+    # time embeddings, of the rank's own tokens for per-token timesteps
+    e, e0 = self.time_modulation(t if t.dim() == 1 else t[:, start:end])
 
     # context
+    branch = context
     context_lens = None
     context = self.text_embedding(
         torch.stack([
@@ -116,11 +114,6 @@ def sp_dit_forward(
             for u in context
         ]))
 
-    # Context Parallel
-    x = torch.chunk(x, get_world_size(), dim=1)[get_rank()]
-    e = torch.chunk(e, get_world_size(), dim=1)[get_rank()]
-    e0 = torch.chunk(e0, get_world_size(), dim=1)[get_rank()]
-
     # arguments
     kwargs = dict(
         e=e0,
@@ -130,14 +123,29 @@ def sp_dit_forward(
         context=context,
         context_lens=context_lens)
 
-    for block in self.blocks:
-        x = block(x, **kwargs)
+    def run_blocks(x, modulated=None):
+        # the first block reuses the modulated input of the step cache
+        x = self.blocks[0](x, modulated=modulated, **kwargs)
+        for block in self.blocks[1:]:
+            x = block(x, **kwargs)
+        return x
+
+    if step_cache is not None:
+        x = step_cache(
+            self,
+            x,
+            self.blocks[0].modulated_input(x, e0),
+            branch,
+            run_blocks,
+            group=dist.group.WORLD)
+    else:
+        x = run_blocks(x)
 
     # head
     x = self.head(x, e)
 
     # Context Parallel
-    x = gather_forward(x, dim=1)
+    x = gather_forward(x, dim=1, sizes=split_sizes)
 
     # unpatchify
     x = self.unpatchify(x, grid_sizes)
@@ -168,6 +176,7 @@ def sp_attn_forward(self, x, seq_lens, grid_sizes, freqs, dtype=torch.bfloat16):
         half(v),
         seq_lens,
         window_size=self.window_size,
+        split_sizes=sp_split_sizes(int(seq_lens.max())),
     )
 
     # output
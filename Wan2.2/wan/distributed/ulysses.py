@@ -3,7 +3,14 @@ import torch
 import torch.distributed as dist
 
 from ..modules.attention import flash_attention
-from .util import all_to_all
+from .ring import ring_attention
+from .util import (
+    all_to_all,
+    get_ring_group,
+    get_ring_ranks,
+    get_ulysses_group,
+    get_ulysses_size,
+)
 
 
 def distributed_attention(
@@ -12,36 +19,84 @@ def distributed_attention(
         v,
         seq_lens,
         window_size=(-1, -1),
+        split_sizes=None,
 ):
     """
     Performs distributed attention based on DeepSpeed Ulysses attention mechanism.
     please refer to https://arxiv.org/pdf/2309.14509
 
+    If ring groups were set up by `init_distributed_group(ring_size)`, the
+    all-to-all only spans the Ulysses group and the gathered sequence blocks
+    are combined by ring attention across the ring group.
+
     Args:
         q:           [B, Lq // p, Nq, C1].
         k:           [B, Lk // p, Nk, C1].
         v:           [B, Lk // p, Nk, C2]. Nq must be divisible by Nk.
         seq_lens:    [B], length of each sequence in batch
         window_size: (left right). If not (-1, -1), apply sliding window local attention.
+        split_sizes: sequence length held by every rank, see `sp_split_sizes`.
+                     Defaults to an even split.
     """
     if not dist.is_initialized():
         raise ValueError("distributed group should be initialized.")
     b = q.shape[0]
+    ulysses_group = get_ulysses_group()
+    use_ulysses = get_ulysses_size() > 1
+    ring_ranks = get_ring_ranks()
+
+    # shard sizes inside the Ulysses group and per ring block
+    ulysses_sizes = block_sizes = None
+    if split_sizes is not None:
+        size = get_ulysses_size()
+        g = dist.get_rank() // size
+        ulysses_sizes = split_sizes[g * size:(g + 1) * size]
+        block_sizes = [
+            sum(split_sizes[i:i + size])
+            for i in range(0, len(split_sizes), size)
+        ]
 
     # gather q/k/v sequence
-    q = all_to_all(q, scatter_dim=2, gather_dim=1)
-    k = all_to_all(k, scatter_dim=2, gather_dim=1)
-    v = all_to_all(v, scatter_dim=2, gather_dim=1)
+    if use_ulysses:
+        handles = [
+            all_to_all(
+                u,
+                scatter_dim=2,
+                gather_dim=1,
+                group=ulysses_group,
+                async_op=True,
+                buffer=name,
+                gather_sizes=ulysses_sizes) for u, name in zip((q, k, v), 'qkv')
+        ]
+        q, k, v = [h.wait() for h in handles]
 
     # apply attention
-    x = flash_attention(
-        q,
-        k,
-        v,
-        k_lens=seq_lens,
-        window_size=window_size,
-    )
+    if ring_ranks is not None:
+        x = ring_attention(
+            q,
+            k,
+            v,
+            ranks=ring_ranks,
+            group=get_ring_group(),
+            seq_lens=seq_lens,
+            window_size=window_size,
+            block_sizes=block_sizes)
+    else:
+        x = flash_attention(
+            q,
+            k,
+            v,
+            k_lens=seq_lens,
+            window_size=window_size,
+        )
 
     # scatter q/k/v sequence
-    x = all_to_all(x, scatter_dim=1, gather_dim=2)
+    if use_ulysses:
+        x = all_to_all(
+            x,
+            scatter_dim=1,
+            gather_dim=2,
+            group=ulysses_group,
+            buffer='x',
+            scatter_sizes=ulysses_sizes)
     return x
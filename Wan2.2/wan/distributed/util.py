@@ -1,13 +1,67 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import math
+
 import torch
 import torch.distributed as dist
 
 
-def init_distributed_group():
+# Sequence parallel groups, see `init_distributed_group`. None means the
+# whole world for Ulysses and no ring.
+_ULYSSES_GROUP = None
+_ULYSSES_SIZE = None
+_RING_GROUP = None
+_RING_RANKS = None
+
+
+def init_distributed_group(ring_size=1):
     """r initialize sequence parallel group.
+
+    The world is split into `ring_size` blocks of consecutive ranks. Ulysses
+    attention runs inside each block, and ring attention runs across the
+    blocks between the ranks that hold the same heads. `ring_size=1` is plain
+    Ulysses and `ring_size=world_size` is plain ring attention.
     """
+    global _ULYSSES_GROUP, _ULYSSES_SIZE, _RING_GROUP, _RING_RANKS
     if not dist.is_initialized():
-        dist.init_process_group(backend='nccl')
+        dist.init_process_group(
+            backend='nccl' if torch.cuda.is_available() else 'gloo')
+    world_size = dist.get_world_size()
+    assert world_size % ring_size == 0, \
+        f"`{ring_size=}` cannot divide the world size {world_size}."
+    ulysses_size = world_size // ring_size
+    rank = dist.get_rank()
+
+    # every rank has to create every group
+    _ULYSSES_GROUP = _RING_GROUP = _RING_RANKS = None
+    _ULYSSES_SIZE = ulysses_size
+    if 1 < ulysses_size < world_size:
+        for i in range(ring_size):
+            ranks = list(range(i * ulysses_size, (i + 1) * ulysses_size))
+            group = dist.new_group(ranks)
+            if rank in ranks:
+                _ULYSSES_GROUP = group
+    if ring_size > 1:
+        for i in range(ulysses_size):
+            ranks = list(range(i, world_size, ulysses_size))
+            group = dist.new_group(ranks) if ring_size < world_size else None
+            if rank in ranks:
+                _RING_GROUP, _RING_RANKS = group, ranks
+
+
+def get_ulysses_group():
+    return _ULYSSES_GROUP
+
+
+def get_ulysses_size():
+    return _ULYSSES_SIZE if _ULYSSES_SIZE is not None else get_world_size()
+
+
+def get_ring_group():
+    return _RING_GROUP
+
+
+def get_ring_ranks():
+    return _RING_RANKS
 
 
 def get_rank():
@@ -18,17 +72,191 @@ def get_world_size():
     return dist.get_world_size()
 
 
-def all_to_all(x, scatter_dim, gather_dim, group=None, **kwargs):
+class _BufferPool:
+    r"""
+    Persistent communication buffers keyed by name, shape, dtype and device.
+
+    A buffer is handed out again on the next request with the same key, so a
+    caller must be done with it before then. The pool is cleared once it holds
+    `max_buffers` buffers, e.g. after the resolution changed a few times.
+    """
+
+    def __init__(self, max_buffers=32):
+        self.max_buffers = max_buffers
+        self._buffers = {}
+
+    def get(self, name, shape, dtype, device):
+        key = (name, tuple(shape), dtype, torch.device(device))
+        buf = self._buffers.get(key)
+        if buf is None:
+            if len(self._buffers) >= self.max_buffers:
+                self._buffers.clear()
+            buf = self._buffers[key] = torch.empty(
+                shape, dtype=dtype, device=device)
+        return buf
+
+    def clear(self):
+        self._buffers.clear()
+
+
+_BUFFERS = _BufferPool()
+
+
+def clear_comm_buffers():
+    r"""
+    Releases the pooled `all_to_all` buffers.
+    """
+    _BUFFERS.clear()
+
+
+def _buffer(name, tag, shape, dtype, device):
+    if name is None:
+        return torch.empty(shape, dtype=dtype, device=device)
+    return _BUFFERS.get((name, tag), shape, dtype, device)
+
+
+def _is_flat_concat(shape, dim):
+    # concatenating along `dim` is a plain concatenation of the memory
+    return all(n == 1 for n in shape[:dim])
+
+
+def sp_split_sizes(length, world_size=None):
+    r"""
+    Sizes of the sequence shards of `length` tokens over `world_size` ranks,
+    the first `length % world_size` ranks hold one more token.
+    """
+    world_size = world_size or get_world_size()
+    return [
+        length // world_size + int(i < length % world_size)
+        for i in range(world_size)
+    ]
+
+
+class AllToAllHandle:
+    r"""
+    Pending `all_to_all`; `wait()` returns the gathered tensor.
+    """
+
+    def __init__(self, work, recv, gather_dim, buffer, shapes=None):
+        self._work = work
+        self._recv = recv
+        self._gather_dim = gather_dim
+        self._buffer = buffer
+        self._shapes = shapes
+
+    def wait(self):
+        if self._work is not None:
+            self._work.wait()
+        dim = self._gather_dim
+        if self._shapes is not None:
+            # flat pieces of different sizes along the gathered dim
+            shape = list(self._shapes[0])
+            shape[dim] = sum(u[dim] for u in self._shapes)
+            if _is_flat_concat(shape, dim):
+                return self._recv.view(shape)
+            pieces = self._recv.split([math.prod(u) for u in self._shapes])
+            out = _buffer(self._buffer, 'out', shape, self._recv.dtype,
+                          self._recv.device)
+            return torch.cat(
+                [u.view(v) for u, v in zip(pieces, self._shapes)],
+                dim=dim,
+                out=out)
+
+        # recv[i] holds the chunk of rank i, which goes to slot i of the
+        # gathered dim
+        x = self._recv.movedim(0, dim)
+        if not x.is_contiguous():
+            x = _buffer(self._buffer, 'out', x.shape, x.dtype,
+                        x.device).copy_(x)
+        return x.flatten(dim, dim + 1)
+
+
+def all_to_all(x,
+               scatter_dim,
+               gather_dim,
+               group=None,
+               async_op=False,
+               buffer=None,
+               scatter_sizes=None,
+               gather_sizes=None,
+               **kwargs):
     """
     `scatter` along one dimension and `gather` along another.
+
+    The chunks are exchanged with a single `all_to_all_single`. Moving the
+    scattered dim to the front and back is a free view when the dims before
+    it have size 1, e.g. batch 1 in Ulysses attention; otherwise one copy is
+    made on each side. With `buffer` set, the send, receive and output
+    tensors come from a persistent pool keyed by that name instead of being
+    allocated, and the result is only valid until the next call with the
+    same name and shape. With `async_op=True` an `AllToAllHandle` is
+    returned, so several exchanges can be in flight at once.
+
+    `scatter_sizes` and `gather_sizes` give the size of the chunk of every
+    rank along the scattered and gathered dim, for sequences that do not
+    split evenly; by default the dims are split evenly.
     """
-    world_size = get_world_size()
-    if world_size > 1:
-        inputs = [u.contiguous() for u in x.chunk(world_size, dim=scatter_dim)]
-        outputs = [torch.empty_like(u) for u in inputs]
-        dist.all_to_all(outputs, inputs, group=group, **kwargs)
-        x = torch.cat(outputs, dim=gather_dim).contiguous()
-    return x
+    world_size = dist.get_world_size(group)
+    if world_size == 1:
+        handle = AllToAllHandle(None, x.unsqueeze(0), gather_dim, buffer)
+        return handle if async_op else x
+    rank = dist.get_rank(group)
+
+    # send chunks
+    input_splits = None
+    if scatter_sizes is None:
+        send = x.unflatten(scatter_dim,
+                           (world_size, -1)).movedim(scatter_dim, 0)
+        if not send.is_contiguous():
+            send = _buffer(buffer, 'send', send.shape, x.dtype,
+                           x.device).copy_(send)
+        chunk_shape = list(send.shape[1:])
+    else:
+        chunks = x.split(scatter_sizes, dim=scatter_dim)
+        input_splits = [u.numel() for u in chunks]
+        if x.is_contiguous() and _is_flat_concat(x.shape, scatter_dim):
+            send = x.view(-1)
+        else:
+            send = _buffer(buffer, 'send', (x.numel(),), x.dtype, x.device)
+            for u, v in zip(chunks, send.split(input_splits)):
+                v.view(u.shape).copy_(u)
+        chunk_shape = list(chunks[rank].shape)
+
+    # receive chunks
+    if gather_sizes is None and input_splits is None:
+        recv = _buffer(buffer, 'recv', send.shape, x.dtype, x.device)
+        work = dist.all_to_all_single(
+            recv, send, group=group, async_op=True, **kwargs)
+        handle = AllToAllHandle(work, recv, gather_dim, buffer)
+    elif gather_sizes is None:
+        recv = _buffer(buffer, 'recv', [world_size] + chunk_shape, x.dtype,
+                       x.device)
+        work = dist.all_to_all_single(
+            recv.view(-1),
+            send,
+            input_split_sizes=input_splits,
+            group=group,
+            async_op=True,
+            **kwargs)
+        handle = AllToAllHandle(work, recv, gather_dim, buffer)
+    else:
+        shapes = []
+        for size in gather_sizes:
+            shapes.append(list(chunk_shape))
+            shapes[-1][gather_dim] = size
+        output_splits = [math.prod(u) for u in shapes]
+        recv = _buffer(buffer, 'recv', (sum(output_splits),), x.dtype,
+                       x.device)
+        work = dist.all_to_all_single(
+            recv,
+            send.view(-1),
+            output_split_sizes=output_splits,
+            input_split_sizes=input_splits,
+            group=group,
+            async_op=True,
+            **kwargs)
+        handle = AllToAllHandle(work, recv, gather_dim, buffer, shapes)
+    return handle if async_op else handle.wait()
 
 
 def all_gather(tensor):
@@ -40,12 +268,21 @@ def all_gather(tensor):
     return tensor_list
 
 
-def gather_forward(input, dim):
+def gather_forward(input, dim, sizes=None):
     # skip if world_size == 1
     world_size = dist.get_world_size()
     if world_size == 1:
         return input
 
+    # uneven shards are padded to the largest one for the gather
+    if sizes is not None and min(sizes) != max(sizes):
+        pad = list(input.shape)
+        pad[dim] = max(sizes) - input.size(dim)
+        input = torch.cat([input, input.new_zeros(pad)], dim=dim)
+        output = all_gather(input.contiguous())
+        return torch.cat(
+            [u.narrow(dim, 0, n) for u, n in zip(output, sizes)], dim=dim)
+
     # gather sequence
     output = all_gather(input)
     return torch.cat(output, dim=dim).contiguous()
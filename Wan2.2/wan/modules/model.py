@@ -1,5 +1,6 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import math
+from collections import OrderedDict
 
 import torch
 import torch.nn as nn
@@ -35,35 +36,113 @@ def rope_params(max_seq_len, dim, theta=10000):
     return freqs
 
 
+# rotation tables keyed by freqs and grid size, see `cached_rope_table`
+_ROPE_CACHE = OrderedDict()
+_ROPE_CACHE_SIZE = 32
+
+
+def rope_freqs_key(freqs):
+    r"""
+    Identity of a freqs tensor for the rotation table cache: its storage and
+    version, so that tables of another `theta` or head split, or of freqs
+    modified in place, are never mixed up.
+    """
+    return (freqs.data_ptr(), freqs._version, tuple(freqs.shape), freqs.dtype,
+            str(freqs.device))
+
+
+def cached_rope_table(key, build_fn, freqs=None):
+    r"""
+    Returns the rotation table stored under `key`, building it with
+    `build_fn` on a miss. The cache keeps the most recently used tables.
+    An entry keeps `freqs` alive, so the storage address in its
+    `rope_freqs_key` cannot be reused by other freqs while it is cached.
+    """
+    entry = _ROPE_CACHE.get(key)
+    if entry is None:
+        entry = _ROPE_CACHE[key] = (build_fn(), freqs)
+        if len(_ROPE_CACHE) > _ROPE_CACHE_SIZE:
+            _ROPE_CACHE.popitem(last=False)
+    else:
+        _ROPE_CACHE.move_to_end(key)
+    return entry[0]
+
+
+def clear_rope_cache():
+    _ROPE_CACHE.clear()
+
+
+@torch.amp.autocast('cuda', enabled=False)
+def rope_grid_freqs(freqs, f, h, w, device=None):
+    r"""
+    Real-valued rotation table of a (F, H, W) grid.
+
+    Args:
+        freqs(Tensor): Rope freqs from `rope_params`, shape [M, C / 2]
+        f, h, w(int): Grid size
+        device(torch.device): Device of the returned table
+
+    Returns:
+        Tensor: Shape [F * H * W, 1, C / 2, 2] in float32, holding the cosine
+            and sine of every rotation angle in the last dimension.
+    """
+    device = freqs.device if device is None else torch.device(device)
+    key = ('grid', rope_freqs_key(freqs), str(device), f, h, w)
+
+    def build_fn():
+        c = freqs.size(1)
+        parts = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
+        table = torch.cat([
+            parts[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
+            parts[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
+            parts[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
+        ],
+                          dim=-1).reshape(f * h * w, 1, -1)
+        return torch.view_as_real(table).float().to(device)
+
+    return cached_rope_table(key, build_fn, freqs)
+
+
+def rope_rotate(x, table):
+    r"""
+    Applies a real-valued rotation table.
+
+    Args:
+        x(Tensor): Shape [..., L, N, C]
+        table(Tensor): Shape broadcastable to [..., L, N, C / 2, 2]
+
+    Returns:
+        Tensor: Rotated `x` in float32.
+    """
+    x = x.float().unflatten(-1, (-1, 2))
+    x_r, x_i = x.unbind(-1)
+    cos, sin = table.unbind(-1)
+    return torch.stack([x_r * cos - x_i * sin, x_r * sin + x_i * cos],
+                       dim=-1).flatten(-2)
+
+
 @torch.amp.autocast('cuda', enabled=False)
 def rope_apply(x, grid_sizes, freqs):
-    n, c = x.size(2), x.size(3) // 2
+    grid_sizes = grid_sizes.tolist()
 
-    # split freqs
-    freqs = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
+    # all samples share one grid, rotate the whole batch at once
+    if all(g == grid_sizes[0] for g in grid_sizes):
+        f, h, w = grid_sizes[0]
+        seq_len = f * h * w
+        table = rope_grid_freqs(freqs, f, h, w, x.device)
+        return torch.cat(
+            [rope_rotate(x[:, :seq_len], table), x[:, seq_len:].float()],
+            dim=1)
 
     # loop over samples
     output = []
-    for i, (f, h, w) in enumerate(grid_sizes.tolist()):
+    for i, (f, h, w) in enumerate(grid_sizes):
         seq_len = f * h * w
-
-        # precompute multipliers
-        x_i = torch.view_as_complex(x[i, :seq_len].to(torch.float64).reshape(
-            seq_len, n, -1, 2))
-        freqs_i = torch.cat([
-            freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
-            freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
-            freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
-        ],
-                            dim=-1).reshape(seq_len, 1, -1)
-
-        # apply rotary embedding
-        x_i = torch.view_as_real(x_i * freqs_i).flatten(2)
-        x_i = torch.cat([x_i, x[i, seq_len:]])
-
-        # append to collection
-        output.append(x_i)
-    return torch.stack(output).float()
+        table = rope_grid_freqs(freqs, f, h, w, x.device)
+        output.append(
+            torch.cat(
+                [rope_rotate(x[i, :seq_len], table), x[i, seq_len:].float()]))
+    return torch.stack(output)
 
 
 class WanRMSNorm(nn.Module):
@@ -225,24 +304,26 @@ class WanAttentionBlock(nn.Module):
         freqs,
         context,
         context_lens,
+        modulated=None,
     ):
         r"""
         Args:
             x(Tensor): Shape [B, L, C]
-            e(Tensor): Shape [B, L1, 6, C]
+            e(Tensor): Shape [B, L1, 6, C], L1 is 1 or L
             seq_lens(Tensor): Shape [B], length of each sequence in batch
             grid_sizes(Tensor): Shape [B, 3], the second dimension contains (F, H, W)
             freqs(Tensor): Rope freqs, shape [1024, C / num_heads / 2]
+            modulated(Tensor, *optional*): `modulated_input(x, e)` if it was
+                already computed, e.g. by the step cache
         """
         assert e.dtype == torch.float32
-        with torch.amp.autocast('cuda', dtype=torch.float32):
-            e = (self.modulation.unsqueeze(0) + e).chunk(6, dim=2)
+        e = self._modulation(e)
         assert e[0].dtype == torch.float32
 
         # self-attention
-        y = self.self_attn(
-            self.norm1(x).float() * (1 + e[1].squeeze(2)) + e[0].squeeze(2),
-            seq_lens, grid_sizes, freqs)
+        if modulated is None:
+            modulated = self._modulate(x, e)
+        y = self.self_attn(modulated, seq_lens, grid_sizes, freqs)
         with torch.amp.autocast('cuda', dtype=torch.float32):
             x = x + y * e[2].squeeze(2)
 
@@ -258,6 +339,25 @@ class WanAttentionBlock(nn.Module):
         x = cross_attn_ffn(x, context, context_lens, e)
         return x
 
+    def _modulation(self, e):
+        with torch.amp.autocast('cuda', dtype=torch.float32):
+            return (self.modulation.unsqueeze(0) + e).chunk(6, dim=2)
+
+    def _modulate(self, x, e):
+        # `e` holds the chunks of `_modulation`
+        return self.norm1(x).float() * (1 + e[1].squeeze(2)) + e[0].squeeze(2)
+
+    def modulated_input(self, x, e):
+        r"""
+        Returns the timestep-modulated input of the self-attention, as
+        computed by `forward`.
+
+        Args:
+            x(Tensor): Shape [B, L, C]
+            e(Tensor): Shape [B, L1, 6, C]
+        """
+        return self._modulate(x, self._modulation(e))
+
 
 class Head(nn.Module):
 
@@ -414,6 +514,7 @@ class WanModel(ModelMixin, ConfigMixin):
         context,
         seq_len,
         y=None,
+        step_cache=None,
     ):
         r"""
         Forward pass through the diffusion model
@@ -422,13 +523,16 @@ class WanModel(ModelMixin, ConfigMixin):
             x (List[Tensor]):
                 List of input video tensors, each with shape [C_in, F, H, W]
             t (Tensor):
-                Diffusion timesteps tensor of shape [B]
+                Diffusion timesteps tensor of shape [B], or [B, seq_len] for per-token timesteps
             context (List[Tensor]):
                 List of text embeddings each with shape [L, C]
             seq_len (`int`):
                 Maximum sequence length for positional encoding
             y (List[Tensor], *optional*):
                 Conditional video inputs for image-to-video mode, same shape as x
+            step_cache (`StepCache`, *optional*):
+                Residual cache that may skip the transformer blocks when the
+                modulated input barely changed since the previous step
 
         Returns:
             List[Tensor]:
@@ -457,18 +561,10 @@ class WanModel(ModelMixin, ConfigMixin):
         ])
 
         # time embeddings
-        if t.dim() == 1:
-            t = t.expand(t.size(0), seq_len)
-        with torch.amp.autocast('cuda', dtype=torch.float32):
-            bt = t.size(0)
-            t = t.flatten()
-            e = self.time_embedding(
-                sinusoidal_embedding_1d(self.freq_dim,
-                                        t).unflatten(0, (bt, seq_len)).float())
-            e0 = self.time_projection(e).unflatten(2, (6, self.dim))
-            assert e.dtype == torch.float32 and e0.dtype == torch.float32
+        e, e0 = self.time_modulation(t)
 
         # context
+        branch = context
         context_lens = None
         context = self.text_embedding(
             torch.stack([
@@ -486,8 +582,18 @@ class WanModel(ModelMixin, ConfigMixin):
             context=context,
             context_lens=context_lens)
 
-        for block in self.blocks:
-            x = block(x, **kwargs)
+        def run_blocks(x, modulated=None):
+            # the first block reuses the modulated input of the step cache
+            x = self.blocks[0](x, modulated=modulated, **kwargs)
+            for block in self.blocks[1:]:
+                x = block(x, **kwargs)
+            return x
+
+        if step_cache is not None:
+            x = step_cache(self, x, self.blocks[0].modulated_input(x, e0),
+                           branch, run_blocks)
+        else:
+            x = run_blocks(x)
 
         # head
         x = self.head(x, e)
@@ -496,6 +602,38 @@ class WanModel(ModelMixin, ConfigMixin):
         x = self.unpatchify(x, grid_sizes)
         return [u.float() for u in x]
 
+    def time_modulation(self, t):
+        r"""
+        Timestep embeddings of the head and the blocks.
+
+        Every distinct timestep is embedded once. Timesteps shared by all
+        tokens of a sample give one modulation per sample that broadcasts over
+        the sequence; only truly per-token timesteps, e.g. the masked first
+        frame of TI2V, give per-token modulation.
+
+        Args:
+            t (Tensor):
+                Diffusion timesteps of shape [B], or [B, L] per token
+
+        Returns:
+            Tuple[Tensor, Tensor]:
+                Head embedding of shape [B, L1, C] and block modulation of
+                shape [B, L1, 6, C] in float32, where L1 is 1 or L
+        """
+        with torch.amp.autocast('cuda', dtype=torch.float32):
+            if t.dim() == 1:
+                values, index = t, torch.arange(t.size(0)).unsqueeze(1)
+            else:
+                values, index = torch.unique(t, return_inverse=True)
+                if values.numel() == 1:
+                    index = index[:, :1]
+            e = self.time_embedding(
+                sinusoidal_embedding_1d(self.freq_dim, values).float())
+            e0 = self.time_projection(e).unflatten(1, (6, self.dim))
+            assert e.dtype == torch.float32 and e0.dtype == torch.float32
+        index = index.to(e.device)
+        return e[index], e0[index]
+
     def unpatchify(self, x, grid_sizes):
         r"""
         Reconstruct video tensors from patch embeddings.
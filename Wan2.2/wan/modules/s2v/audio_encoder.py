@@ -1,5 +1,7 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import math
+import threading
+from functools import partial
 
 import librosa
 import numpy as np
@@ -52,9 +54,182 @@ def linear_interpolation(features, input_fps, output_fps, output_len=None):
     return output_features.transpose(1, 2)  # [1, output_len, 512]
 
 
+def gather_audio_frames(audio_embed, centers, m, stride):
+    """
+    Gathers the 2m+1 audio frames spaced by `stride` around every center
+    frame in one indexing op.
+
+    audio_embed: shape=[num_layers, T, C]
+    centers: center frame of every output frame, shape=[N]
+    Returns [N, (2m+1)*C] for a single layer, [N, num_layers, (2m+1)*C]
+    otherwise. Neighbours are clamped to the audio, centers beyond its end
+    give zeros.
+    """
+    num_layers, audio_frame_num, _ = audio_embed.shape
+    device = audio_embed.device
+    centers = torch.as_tensor(centers, dtype=torch.long, device=device)
+    offsets = torch.arange(-m, m + 1, device=device) * stride
+    idx = (centers[:, None] + offsets).clamp(0, audio_frame_num - 1)
+    if num_layers > 1:
+        feat = audio_embed[:, idx].flatten(start_dim=-2, end_dim=-1)
+        feat = feat.transpose(0, 1).contiguous()
+    else:
+        feat = audio_embed[0][idx].flatten(start_dim=1)
+    beyond = centers >= audio_frame_num
+    if beyond.any():
+        # the zero padding is float32, as in torch.zeros
+        feat = feat.to(torch.promote_types(feat.dtype, torch.float32))
+        feat[beyond] = 0
+    return feat
+
+
+class AudioFeatureStream:
+    """
+    Extracts the wav2vec2 features of a long audio in fixed windows.
+
+    Every window covers `chunk_frames` wav2vec2 frames plus `context_frames`
+    frames of context on each side. Only the frames of the core are kept, so
+    the transformer of every kept frame sees at least the context on both
+    sides and the windows stitch without seams. Kept features are stored on
+    the CPU. With `background=True` the windows are encoded on a worker thread
+    and `get` only waits for the windows it needs. `on_complete` receives the
+    complete features once, e.g. to cache them.
+    """
+
+    def __init__(self,
+                 model,
+                 input_values,
+                 return_all_layers=False,
+                 dtype=torch.float32,
+                 chunk_frames=1500,
+                 context_frames=150,
+                 input_fps=50,
+                 output_fps=30,
+                 background=True,
+                 on_complete=None):
+        self.model = model
+        self.input_values = input_values
+        self.return_all_layers = return_all_layers
+        self.dtype = dtype
+        self.chunk_frames = chunk_frames
+        self.context_frames = context_frames
+        self.on_complete = on_complete
+
+        # geometry of the convolutional feature extractor
+        config = model.config
+        self.hop = math.prod(config.conv_stride)
+        self.receptive_field = 1
+        for kernel, stride in reversed(
+                list(zip(config.conv_kernel, config.conv_stride))):
+            self.receptive_field = (self.receptive_field - 1) * stride + kernel
+        length = input_values.shape[-1]
+        for kernel, stride in zip(config.conv_kernel, config.conv_stride):
+            length = (length - kernel) // stride + 1
+        self.num_input_frames = length
+        # same length as `linear_interpolation`
+        self.num_frames = int(length / float(input_fps) * output_fps)
+
+        self._feats = []
+        self._done = 0
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _encode_window(self, start, end):
+        lo = max(start - self.context_frames, 0)
+        hi = min(end + self.context_frames, self.num_input_frames)
+        samples = self.input_values[..., lo * self.hop:(hi - 1) * self.hop +
+                                    self.receptive_field]
+        with torch.no_grad():
+            res = self.model(
+                samples.to(self.model.device), output_hidden_states=True)
+        if self.return_all_layers:
+            feat = torch.cat(res.hidden_states)
+        else:
+            feat = res.hidden_states[-1]
+        return feat[:, start - lo:end - lo].cpu()
+
+    def _run(self):
+        try:
+            for start in range(0, self.num_input_frames, self.chunk_frames):
+                end = min(start + self.chunk_frames, self.num_input_frames)
+                feat = self._encode_window(start, end)
+                with self._cond:
+                    self._feats.append(feat)
+                    self._done = end
+                    self._cond.notify_all()
+            if self.on_complete is not None:
+                self.get()
+        except Exception as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
+
+    def _wait(self, num_input_frames):
+        if self._thread is None:
+            while self._done < num_input_frames:
+                start = self._done
+                end = min(start + self.chunk_frames, self.num_input_frames)
+                self._feats.append(self._encode_window(start, end))
+                self._done = end
+            return
+        with self._cond:
+            self._cond.wait_for(lambda: self._done >= num_input_frames or
+                                self._error is not None)
+            if self._error is not None:
+                raise RuntimeError(
+                    f"audio feature extraction failed: {self._error}")
+
+    def get(self, end=None):
+        """
+        Returns the features of the first `end` output frames, shape
+        [num_layers, end, C], resampled to the output fps like
+        `linear_interpolation`.
+        """
+        end = self.num_frames if end is None else min(end, self.num_frames)
+        scale = (self.num_input_frames - 1) / max(self.num_frames - 1, 1)
+        pos = torch.arange(end, dtype=torch.float32) * scale
+        lo = pos.floor().long().clamp(max=self.num_input_frames - 1)
+        hi = (lo + 1).clamp(max=self.num_input_frames - 1)
+        self._wait(int(hi.max()) + 1 if end > 0 else 0)
+        with self._cond:
+            if len(self._feats) > 1:
+                self._feats = [torch.cat(self._feats, dim=1)]
+            feat = self._feats[0]
+        weight = (pos - lo)[None, :, None]
+        feat = feat[:, lo] * (1 - weight) + feat[:, hi] * weight
+        feat = feat.to(self.dtype)
+        if end == self.num_frames:
+            # hand the complete features over once
+            with self._cond:
+                on_complete, self.on_complete = self.on_complete, None
+            if on_complete is not None:
+                on_complete(feat)
+        return feat
+
+
+class CachedFeatureStream:
+    """
+    `AudioFeatureStream` interface over features that are already extracted.
+    """
+
+    def __init__(self, feat):
+        self.feat = feat
+        self.num_frames = feat.shape[1]
+
+    def get(self, end=None):
+        return self.feat[:, :end]
+
+
 class AudioEncoder():
 
-    def __init__(self, device='cpu', model_id="facebook/wav2vec2-base-960h"):
+    def __init__(self,
+                 device='cpu',
+                 model_id="facebook/wav2vec2-base-960h",
+                 cache=None):
         # load pretrained model
         self.processor = Wav2Vec2Processor.from_pretrained(model_id)
         self.model = Wav2Vec2ForCTC.from_pretrained(model_id)
@@ -62,16 +237,74 @@ class AudioEncoder():
         self.model = self.model.to(device)
 
         self.video_rate = 30
+        self.model_id = model_id
+        # `AudioFeatureCache` of extracted features
+        self.cache = cache
+
+    def _cache_key(self, audio_path, return_all_layers, dtype, chunk_seconds):
+        if self.cache is None:
+            return None
+        return self.cache.make_key(audio_path, 'wav2vec2', self.model_id,
+                                   self.video_rate, return_all_layers, dtype,
+                                   chunk_seconds)
+
+    def _input_values(self, audio_path):
+        audio_input, sample_rate = librosa.load(audio_path, sr=16000)
+        # normalized over the whole track, also when encoded in windows
+        return self.processor(
+            audio_input, sampling_rate=sample_rate,
+            return_tensors="pt").input_values
+
+    def stream_audio_feat(self,
+                          audio_path,
+                          return_all_layers=False,
+                          dtype=torch.float32,
+                          chunk_seconds=30.0,
+                          context_seconds=3.0,
+                          background=True):
+        """
+        Returns an `AudioFeatureStream` that encodes the audio in windows of
+        `chunk_seconds`, each with `context_seconds` of context on both sides.
+        Cached features are returned as a `CachedFeatureStream`.
+        """
+        key = self._cache_key(audio_path, return_all_layers, dtype,
+                              (chunk_seconds, context_seconds))
+        if key is not None:
+            feat = self.cache.get(key)
+            if feat is not None:
+                return CachedFeatureStream(feat)
+        return AudioFeatureStream(
+            self.model,
+            self._input_values(audio_path),
+            return_all_layers=return_all_layers,
+            dtype=dtype,
+            chunk_frames=max(1, round(chunk_seconds * 50)),
+            context_frames=round(context_seconds * 50),
+            input_fps=50,
+            output_fps=self.video_rate,
+            background=background,
+            on_complete=None if key is None else partial(self.cache.put, key))
 
     def extract_audio_feat(self,
                            audio_path,
                            return_all_layers=False,
-                           dtype=torch.float32):
-        audio_input, sample_rate = librosa.load(audio_path, sr=16000)
-
-        input_values = self.processor(
-            audio_input, sampling_rate=sample_rate,
-            return_tensors="pt").input_values
+                           dtype=torch.float32,
+                           chunk_seconds=None):
+        if chunk_seconds is not None:
+            return self.stream_audio_feat(
+                audio_path,
+                return_all_layers=return_all_layers,
+                dtype=dtype,
+                chunk_seconds=chunk_seconds,
+                background=False).get()
+
+        key = self._cache_key(audio_path, return_all_layers, dtype, None)
+        if key is not None:
+            z = self.cache.get(key)
+            if z is not None:
+                return z.to(self.model.device)
+
+        input_values = self._input_values(audio_path)
 
         # INFERENCE
 
@@ -86,6 +319,8 @@ class AudioEncoder():
             feat, input_fps=50, output_fps=self.video_rate)
 
         z = feat.to(dtype)  # Encoding for the motion
+        if key is not None:
+            self.cache.put(key, z)
         return z
 
     def get_audio_embed_bucket(self,
@@ -93,43 +328,14 @@ class AudioEncoder():
                                stride=2,
                                batch_frames=12,
                                m=2):
-        num_layers, audio_frame_num, audio_dim = audio_embed.shape
-
-        if num_layers > 1:
-            return_all_layers = True
-        else:
-            return_all_layers = False
+        audio_frame_num = audio_embed.shape[1]
 
         min_batch_num = int(audio_frame_num / (batch_frames * stride)) + 1
 
         bucket_num = min_batch_num * batch_frames
-        batch_idx = [stride * i for i in range(bucket_num)]
-        batch_audio_eb = []
-        for bi in batch_idx:
-            if bi < audio_frame_num:
-                audio_sample_stride = 2
-                chosen_idx = list(
-                    range(bi - m * audio_sample_stride,
-                          bi + (m + 1) * audio_sample_stride,
-                          audio_sample_stride))
-                chosen_idx = [0 if c < 0 else c for c in chosen_idx]
-                chosen_idx = [
-                    audio_frame_num - 1 if c >= audio_frame_num else c
-                    for c in chosen_idx
-                ]
-
-                if return_all_layers:
-                    frame_audio_embed = audio_embed[:, chosen_idx].flatten(
-                        start_dim=-2, end_dim=-1)
-                else:
-                    frame_audio_embed = audio_embed[0][chosen_idx].flatten()
-            else:
-                frame_audio_embed = \
-                torch.zeros([audio_dim * (2 * m + 1)], device=audio_embed.device) if not return_all_layers \
-                    else torch.zeros([num_layers, audio_dim * (2 * m + 1)], device=audio_embed.device)
-            batch_audio_eb.append(frame_audio_embed)
-        batch_audio_eb = torch.cat([c.unsqueeze(0) for c in batch_audio_eb],
-                                   dim=0)
+        batch_idx = torch.arange(bucket_num) * stride
+        batch_audio_eb = gather_audio_frames(
+            audio_embed, batch_idx, m, stride=2)
 
         return batch_audio_eb, min_batch_num
 
@@ -138,13 +344,15 @@ class AudioEncoder():
                                    fps=16,
                                    batch_frames=81,
                                    m=0):
-        num_layers, audio_frame_num, audio_dim = audio_embed.shape
+        batch_idx, min_batch_num = self._bucket_indices_fps(
+            audio_embed.shape[1], fps, batch_frames)
+        audio_sample_stride = int(self.video_rate / fps)
+        batch_audio_eb = gather_audio_frames(
+            audio_embed, batch_idx, m, stride=audio_sample_stride)
 
-        if num_layers > 1:
-            return_all_layers = True
-        else:
-            return_all_layers = False
+        return batch_audio_eb, min_batch_num
 
+    def _bucket_indices_fps(self, audio_frame_num, fps, batch_frames):
         scale = self.video_rate / fps
 
         min_batch_num = int(audio_frame_num / (batch_frames * scale)) + 1
@@ -158,32 +366,34 @@ class AudioEncoder():
             target_fps=fps,
             num_sample=bucket_num,
             fixed_start=0)
-        batch_audio_eb = []
+        return batch_idx, min_batch_num
+
+    def num_buckets_fps(self, stream, fps=16, batch_frames=81):
+        """
+        Number of clips `get_audio_embed_bucket_fps` splits the audio of
+        `stream` into.
+        """
+        return self._bucket_indices_fps(stream.num_frames, fps,
+                                        batch_frames)[1]
+
+    def get_audio_embed_bucket_fps_clip(self,
+                                        stream,
+                                        clip,
+                                        fps=16,
+                                        batch_frames=81,
+                                        m=0):
+        """
+        Returns rows `clip * batch_frames` to `(clip + 1) * batch_frames` of
+        the `get_audio_embed_bucket_fps` output for the audio of `stream`,
+        waiting only for the audio these rows cover.
+        """
+        batch_idx, _ = self._bucket_indices_fps(stream.num_frames, fps,
+                                                batch_frames)
+        centers = batch_idx[clip * batch_frames:(clip + 1) * batch_frames]
         audio_sample_stride = int(self.video_rate / fps)
-        for bi in batch_idx:
-            if bi < audio_frame_num:
-
-                chosen_idx = list(
-                    range(bi - m * audio_sample_stride,
-                          bi + (m + 1) * audio_sample_stride,
-                          audio_sample_stride))
-                chosen_idx = [0 if c < 0 else c for c in chosen_idx]
-                chosen_idx = [
-                    audio_frame_num - 1 if c >= audio_frame_num else c
-                    for c in chosen_idx
-                ]
-
-                if return_all_layers:
-                    frame_audio_embed = audio_embed[:, chosen_idx].flatten(
-                        start_dim=-2, end_dim=-1)
-                else:
-                    frame_audio_embed = audio_embed[0][chosen_idx].flatten()
-            else:
-                frame_audio_embed = \
-                torch.zeros([audio_dim * (2 * m + 1)], device=audio_embed.device) if not return_all_layers \
-                    else torch.zeros([num_layers, audio_dim * (2 * m + 1)], device=audio_embed.device)
-            batch_audio_eb.append(frame_audio_embed)
-        batch_audio_eb = torch.cat([c.unsqueeze(0) for c in batch_audio_eb],
-                                   dim=0)
-
-        return batch_audio_eb, min_batch_num
+        # neighbours past the last needed frame are clamped to the end of the
+        # audio anyway
+        needed = min(
+            int(centers.max()) + m * audio_sample_stride + 1, stream.num_frames)
+        return gather_audio_frames(
+            stream.get(needed), centers, m, stride=audio_sample_stride)
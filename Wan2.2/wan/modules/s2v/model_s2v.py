@@ -25,6 +25,7 @@ from ..model import (
     WanSelfAttention,
     flash_attention,
     rope_params,
+    rope_rotate,
     sinusoidal_embedding_1d,
 )
 from .audio_utils import AudioInjector_WAN, CausalAudioEncoder
@@ -60,39 +61,15 @@ def torch_dfs(model: nn.Module, parent_name='root'):
 
 @amp.autocast(enabled=False)
 def rope_apply(x, grid_sizes, freqs, start=None):
-    n, c = x.size(2), x.size(3) // 2
-    # loop over samples
-    output = []
-    for i, _ in enumerate(x):
-        s = x.size(1)
-        x_i = torch.view_as_complex(x[i, :s].to(torch.float64).reshape(
-            s, n, -1, 2))
-        freqs_i = freqs[i, :s]
-        # apply rotary embedding
-        x_i = torch.view_as_real(x_i * freqs_i).flatten(2)
-        x_i = torch.cat([x_i, x[i, s:]])
-        # append to collection
-        output.append(x_i)
-    return torch.stack(output).float()
+    # freqs: per-token rotation table from `rope_precompute`
+    s = x.size(1)
+    return rope_rotate(x, freqs[:, :s])
 
 
 @amp.autocast(enabled=False)
 def rope_apply_usp(x, grid_sizes, freqs):
-    s, n, c = x.size(1), x.size(2), x.size(3) // 2
-    # loop over samples
-    output = []
-    for i, _ in enumerate(x):
-        s = x.size(1)
-        # precompute multipliers
-        x_i = torch.view_as_complex(x[i, :s].to(torch.float64).reshape(
-            s, n, -1, 2))
-        freqs_i = freqs[i]
-        freqs_i_rank = freqs_i
-        x_i = torch.view_as_real(x_i * freqs_i_rank).flatten(2)
-        x_i = torch.cat([x_i, x[i, s:]])
-        # append to collection
-        output.append(x_i)
-    return torch.stack(output).float()
+    # freqs: rotation table of the tokens held by this rank
+    return rope_rotate(x, freqs)
 
 
 def sp_attn_forward_s2v(self,
@@ -424,7 +401,8 @@ class WanModel_S2V(ModelMixin, ConfigMixin):
                         self.motioner.motion_side_len
                     ]).unsqueeze(0).repeat(1, 1),
                 ]]
-                token_freqs = rope_apply(x, gride_sizes, self.freqs)
+                token_freqs = rope_rotate(
+                    x, rope_precompute(x, gride_sizes, self.freqs))
                 token_freqs = token_freqs[0, :,
                                           0].reshape(motion_token_num, -1, 2)
                 token_freqs = token_freqs * 0.01
@@ -501,10 +479,11 @@ class WanModel_S2V(ModelMixin, ConfigMixin):
             motion_latents), motion_latents[0].shape[2] // self.patch_size[
                 1], motion_latents[0].shape[3] // self.patch_size[2]
 
-        freqs = self.freqs
         device = self.patch_embedding.weight.device
-        if freqs.device != device:
-            freqs = freqs.to(device)
+        if self.freqs.device != device:
+            # moved once, the rotation tables are cached per freqs tensor
+            self.freqs = self.freqs.to(device)
+        freqs = self.freqs
         if self.trainable_token_pos_emb:
             with amp.autocast(dtype=torch.float64):
                 token_freqs = self.token_freqs.to(torch.float64)
@@ -647,37 +626,23 @@ class WanModel_S2V(ModelMixin, ConfigMixin):
 
         return hidden_states
 
-    def forward(
-            self,
-            x,
-            t,
-            context,
-            seq_len,
-            ref_latents,
-            motion_latents,
-            cond_states,
-            audio_input=None,
-            motion_frames=[17, 5],
-            add_last_motion=2,
-            drop_motion_frames=False,
-            *extra_args,
-            **extra_kwargs):
+    def prepare_condition(self,
+                          context,
+                          ref_latents,
+                          motion_latents,
+                          cond_states,
+                          audio_input=None,
+                          motion_frames=[17, 5],
+                          add_last_motion=2,
+                          drop_motion_frames=False,
+                          *extra_args,
+                          **extra_kwargs):
         """
-        x:                  A list of videos each with shape [C, T, H, W].
-        t:                  [B].
-        context:            A list of text embeddings each with shape [L, C].
-        seq_len:            A list of video token lens, no need for this model.
-        ref_latents         A list of reference image for each video with shape [C, 1, H, W].
-        motion_latents      A list of  motion frames for each video with shape [C, T_m, H, W].
-        cond_states         A list of condition frames (i.e. pose) each with shape [C, T, H, W].
-        audio_input         The input audio embedding [B, num_wav2vec_layer, C_a, T_a].
-        motion_frames       The number of motion frames and motion latents frames encoded by vae, i.e. [17, 5]
-        add_last_motion     For the motioner, if add_last_motion > 0, it means that the most recent frame (i.e., the last frame) will be added.
-                            For frame packing, the behavior depends on the value of add_last_motion:
-                            add_last_motion = 0: Only the farthest part of the latent (i.e., clean_latents_4x) is included.
-                            add_last_motion = 1: Both clean_latents_2x and clean_latents_4x are included.
-                            add_last_motion = 2: All motion-related latents are used.
-        drop_motion_frames  Bool, whether drop the motion frames info
+        Computes the inputs of `forward` that depend neither on the timestep
+        nor on the noisy latent: the audio embedding, the pose, reference and
+        motion tokens, the rotary tables and the text embedding. The
+        arguments are those of `forward`. The result is passed to `forward`
+        as `condition` and stays valid for all sampling steps of a clip.
         """
         add_last_motion = self.add_last_motion * add_last_motion
         audio_input = torch.cat([
@@ -685,26 +650,21 @@ class WanModel_S2V(ModelMixin, ConfigMixin):
         ],
                                 dim=-1)
         audio_emb_res = self.casual_audio_encoder(audio_input)
+        audio_emb_global = None
         if self.enbale_adain:
             audio_emb_global, audio_emb = audio_emb_res
-            self.audio_emb_global = audio_emb_global[:,
-                                                     motion_frames[1]:].clone()
+            audio_emb_global = audio_emb_global[:, motion_frames[1]:].clone()
         else:
             audio_emb = audio_emb_res
-        self.merged_audio_emb = audio_emb[:, motion_frames[1]:, :]
-
-        device = self.patch_embedding.weight.device
+        merged_audio_emb = audio_emb[:, motion_frames[1]:, :]
 
-        # embeddings
-        x = [self.patch_embedding(u.unsqueeze(0)) for u in x]
-        # cond states
+        # cond states, added to the embedded noisy latent at every step
         cond = [self.cond_encoder(c.unsqueeze(0)) for c in cond_states]
-        x = [x_ + pose for x_, pose in zip(x, cond)]
 
         grid_sizes = torch.stack(
-            [torch.tensor(u.shape[2:], dtype=torch.long) for u in x])
-        x = [u.flatten(2).transpose(1, 2) for u in x]
-        seq_lens = torch.tensor([u.size(1) for u in x], dtype=torch.long)
+            [torch.tensor(u.shape[2:], dtype=torch.long) for u in cond])
+        cond = [u.flatten(2).transpose(1, 2) for u in cond]
+        seq_lens = torch.tensor([u.size(1) for u in cond], dtype=torch.long)
 
         original_grid_sizes = deepcopy(grid_sizes)
         grid_sizes = [[torch.zeros_like(grid_sizes), grid_sizes, grid_sizes]]
@@ -726,14 +686,16 @@ class WanModel_S2V(ModelMixin, ConfigMixin):
                          ]
 
         ref = [r.flatten(2).transpose(1, 2) for r in ref]  # r: 1 c f h w
-        self.original_seq_len = seq_lens[0]
+        original_seq_len = seq_lens[0]
 
         seq_lens = seq_lens + torch.tensor([r.size(1) for r in ref],
                                            dtype=torch.long)
 
         grid_sizes = grid_sizes + ref_grid_sizes
 
-        x = [torch.cat([u, r], dim=1) for u, r in zip(x, ref)]
+        # the cond tokens stand in for the noisy tokens, which have the same
+        # shape, to lay out the sequence
+        x = [torch.cat([u, r], dim=1) for u, r in zip(cond, ref)]
 
         # Initialize masks to indicate noisy latent, ref latent, and motion latent.
         # However, at this point, only the first two (noisy and ref latents) are marked;
@@ -743,34 +705,115 @@ class WanModel_S2V(ModelMixin, ConfigMixin):
             for u in x
         ]
         for i in range(len(mask_input)):
-            mask_input[i][:, self.original_seq_len:] = 1
+            mask_input[i][:, original_seq_len:] = 1
 
         # compute the rope embeddings for the input
         x = torch.cat(x)
         b, s, n, d = x.size(0), x.size(
             1), self.num_heads, self.dim // self.num_heads
-        self.pre_compute_freqs = rope_precompute(
+        freqs = rope_precompute(
             x.detach().view(b, s, n, d), grid_sizes, self.freqs, start=None)
 
         x = [u.unsqueeze(0) for u in x]
-        self.pre_compute_freqs = [
-            u.unsqueeze(0) for u in self.pre_compute_freqs
-        ]
+        freqs = [u.unsqueeze(0) for u in freqs]
 
-        x, seq_lens, self.pre_compute_freqs, mask_input = self.inject_motion(
+        x, seq_lens, freqs, mask_input = self.inject_motion(
             x,
             seq_lens,
-            self.pre_compute_freqs,
+            freqs,
             mask_input,
             motion_latents,
             drop_motion_frames=drop_motion_frames,
             add_last_motion=add_last_motion)
 
         x = torch.cat(x, dim=0)
-        self.pre_compute_freqs = torch.cat(self.pre_compute_freqs, dim=0)
+        freqs = torch.cat(freqs, dim=0)
         mask_input = torch.cat(mask_input, dim=0)
+        mask_emb = self.trainable_cond_mask(mask_input).to(x.dtype)
+
+        # context
+        context = self.text_embedding(
+            torch.stack([
+                torch.cat(
+                    [u, u.new_zeros(self.text_len - u.size(0), u.size(1))])
+                for u in context
+            ]))
 
-        x = x + self.trainable_cond_mask(mask_input).to(x.dtype)
+        return types.SimpleNamespace(
+            cond=torch.cat(cond),
+            cond_mask=mask_emb[:, :original_seq_len],
+            tail=x[:, original_seq_len:] + mask_emb[:, original_seq_len:],
+            seq_lens=seq_lens,
+            grid_sizes=grid_sizes,
+            original_grid_sizes=original_grid_sizes,
+            original_seq_len=original_seq_len,
+            freqs=freqs,
+            context=context,
+            merged_audio_emb=merged_audio_emb,
+            audio_emb_global=audio_emb_global,
+            lat_motion_frames=self.lat_motion_frames)
+
+    def forward(
+            self,
+            x,
+            t,
+            context=None,
+            seq_len=None,
+            ref_latents=None,
+            motion_latents=None,
+            cond_states=None,
+            audio_input=None,
+            motion_frames=[17, 5],
+            add_last_motion=2,
+            drop_motion_frames=False,
+            *extra_args,
+            condition=None,
+            **extra_kwargs):
+        """
+        x:                  A list of videos each with shape [C, T, H, W].
+        t:                  [B].
+        context:            A list of text embeddings each with shape [L, C].
+        seq_len:            A list of video token lens, no need for this model.
+        ref_latents         A list of reference image for each video with shape [C, 1, H, W].
+        motion_latents      A list of  motion frames for each video with shape [C, T_m, H, W].
+        cond_states         A list of condition frames (i.e. pose) each with shape [C, T, H, W].
+        audio_input         The input audio embedding [B, num_wav2vec_layer, C_a, T_a].
+        motion_frames       The number of motion frames and motion latents frames encoded by vae, i.e. [17, 5]
+        add_last_motion     For the motioner, if add_last_motion > 0, it means that the most recent frame (i.e., the last frame) will be added.
+                            For frame packing, the behavior depends on the value of add_last_motion:
+                            add_last_motion = 0: Only the farthest part of the latent (i.e., clean_latents_4x) is included.
+                            add_last_motion = 1: Both clean_latents_2x and clean_latents_4x are included.
+                            add_last_motion = 2: All motion-related latents are used.
+        drop_motion_frames  Bool, whether drop the motion frames info
+        condition           The output of `prepare_condition`. If given, the conditioning
+                            arguments above are ignored.
+        """
+        if condition is None:
+            condition = self.prepare_condition(
+                context,
+                ref_latents,
+                motion_latents,
+                cond_states,
+                audio_input=audio_input,
+                motion_frames=motion_frames,
+                add_last_motion=add_last_motion,
+                drop_motion_frames=drop_motion_frames)
+        self.merged_audio_emb = condition.merged_audio_emb
+        if self.enbale_adain:
+            self.audio_emb_global = condition.audio_emb_global
+        self.lat_motion_frames = condition.lat_motion_frames
+        self.original_seq_len = condition.original_seq_len
+        self.pre_compute_freqs = condition.freqs
+        seq_lens = condition.seq_lens
+        grid_sizes = condition.grid_sizes
+        original_grid_sizes = condition.original_grid_sizes
+        context = condition.context
+
+        # embeddings
+        x = [self.patch_embedding(u.unsqueeze(0)) for u in x]
+        x = torch.cat([u.flatten(2).transpose(1, 2) for u in x])
+        x = torch.cat([x + condition.cond + condition.cond_mask, condition.tail],
+                      dim=1)
 
         # time embeddings
         if self.zero_timestep:
@@ -798,12 +841,6 @@ class WanModel_S2V(ModelMixin, ConfigMixin):
 
         # context
         context_lens = None
-        context = self.text_embedding(
-            torch.stack([
-                torch.cat(
-                    [u, u.new_zeros(self.text_len - u.size(0), u.size(1))])
-                for u in context
-            ]))
 
         # grad ckpt args
         def create_custom_forward(module, return_dict=None):
@@ -2,10 +2,47 @@
 import numpy as np
 import torch
 
+from ..model import cached_rope_table, rope_freqs_key
+
+
+def _grid_key(grid_sizes, start):
+    key = []
+    for g in grid_sizes:
+        if not type(g) is list:
+            g = [torch.zeros_like(g), g]
+        key.append(tuple(tuple(u.tolist()) for u in g))
+    if start is not None:
+        start = tuple(tuple(int(v) for v in u) for u in start)
+    return tuple(key), start
+
 
 def rope_precompute(x, grid_sizes, freqs, start=None):
+    """
+    Builds the real-valued rotation table of `x` [B, L, N, C].
+
+    Returns a float32 tensor of shape [B, L, 1, C // 2, 2] holding the cosine
+    and sine of every rotation angle. Tokens not covered by `grid_sizes` get
+    the identity rotation. Tables are cached per freqs tensor and grid
+    layout.
+    """
     b, s, n, c = x.size(0), x.size(1), x.size(2), x.size(3) // 2
 
+    if not type(grid_sizes) is list:
+        grid_sizes = [grid_sizes]
+
+    # trainable freqs change with the weights and are never cached
+    if type(freqs) is list:
+        return _rope_precompute(b, s, c, grid_sizes, freqs, start, x.device)
+
+    def build_fn():
+        return _rope_precompute(b, s, c, grid_sizes, freqs, start, x.device)
+
+    key = ('s2v', rope_freqs_key(freqs), str(x.device), b, s, c,
+           *_grid_key(grid_sizes, start))
+    return cached_rope_table(key, build_fn, freqs)
+
+
+def _rope_precompute(b, s, c, grid_sizes, freqs, start, device):
     # split freqs
     if type(freqs) is list:
         trainable_freqs = freqs[1]
@@ -13,11 +50,8 @@ def rope_precompute(x, grid_sizes, freqs, start=None):
     freqs = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
 
     # loop over samples
-    output = torch.view_as_complex(x.detach().reshape(b, s, n, -1,
-                                                      2).to(torch.float64))
+    output = torch.ones(b, s, 1, c, dtype=torch.complex128)
     seq_bucket = [0]
-    if not type(grid_sizes) is list:
-        grid_sizes = [grid_sizes]
     for g in grid_sizes:
         if not type(g) is list:
             g = [torch.zeros_like(g), g]
@@ -67,4 +101,4 @@ def rope_precompute(x, grid_sizes, freqs, start=None):
                 # apply rotary embedding
                 output[i, seq_bucket[-1]:seq_bucket[-1] + seq_len] = freqs_i
         seq_bucket.append(seq_bucket[-1] + seq_len)
-    return output
+    return torch.view_as_real(output).float().to(device)
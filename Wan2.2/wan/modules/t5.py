@@ -1,12 +1,13 @@
 # Modified from transformers.models.t5.modeling_t5
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
-import logging
 import math
+import os
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from ..utils.checkpoint import load_checkpoint, resolve_checkpoint
 from .tokenizers import HuggingfaceTokenizer
 
 __all__ = [
@@ -479,6 +480,7 @@ class T5EncoderModel:
         checkpoint_path=None,
         tokenizer_path=None,
         shard_fn=None,
+        cache=None,
     ):
         self.text_len = text_len
         self.dtype = dtype
@@ -486,15 +488,17 @@ class T5EncoderModel:
         self.checkpoint_path = checkpoint_path
         self.tokenizer_path = tokenizer_path
 
-        # init model
+        # init model, the weights are assigned straight from the checkpoint
         model = umt5_xxl(
             encoder_only=True,
             return_tokenizer=False,
             dtype=dtype,
-            device=device).eval().requires_grad_(False)
-        logging.info(f'loading {checkpoint_path}')
-        model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
-        self.model = model
+            device='meta').eval().requires_grad_(False)
+        self.model = load_checkpoint(
+            model,
+            checkpoint_path,
+            device='cpu' if shard_fn is not None else device,
+            dtype=dtype)
         if shard_fn is not None:
             self.model = shard_fn(self.model, sync_module_states=False)
         else:
@@ -503,6 +507,18 @@ class T5EncoderModel:
         self.tokenizer = HuggingfaceTokenizer(
             name=tokenizer_path, seq_len=text_len, clean='whitespace')
 
+        # sharded ranks must run every forward together, so hits and misses
+        # could diverge across ranks
+        self.cache = cache if shard_fn is None else None
+        if self.cache is not None and checkpoint_path is not None:
+            # key on the file the weights were actually loaded from
+            weights_path = resolve_checkpoint(checkpoint_path)
+            stat = os.stat(weights_path)
+            self._cache_id = (os.path.abspath(weights_path), stat.st_size,
+                              stat.st_mtime_ns)
+        else:
+            self._cache_id = (checkpoint_path,)
+
     def __call__(self, texts, device):
         ids, mask = self.tokenizer(
             texts, return_mask=True, add_special_tokens=True)
@@ -511,3 +527,48 @@ class T5EncoderModel:
         seq_lens = mask.gt(0).sum(dim=1).long()
         context = self.model(ids, mask)
         return [u[:v] for u, v in zip(context, seq_lens)]
+
+    def encode(self, texts, device, offload_model=False, cpu=False):
+        r"""
+        Encodes each text in `texts` separately, serving repeated texts from
+        the embedding cache. The model is only moved to `device` when at least
+        one text misses the cache.
+
+        Args:
+            texts (List[str]):
+                Texts to encode.
+            device (torch.device):
+                Device of the returned embeddings.
+            offload_model (`bool`, *optional*, defaults to False):
+                Move the model back to CPU after encoding.
+            cpu (`bool`, *optional*, defaults to False):
+                Run the encoder on CPU and only move the outputs to `device`.
+
+        Returns:
+            List[Tensor]: One embedding of shape [L, C] per text.
+        """
+        keys = [
+            self.cache.make_key('t5', self.tokenizer_path, *self._cache_id,
+                                self.text_len, self.dtype, u)
+            if self.cache is not None else None for u in texts
+        ]
+        context = [
+            self.cache.get(k, device) if k is not None else None for k in keys
+        ]
+        missing = [i for i, u in enumerate(context) if u is None]
+        if not missing:
+            return context
+
+        if not cpu:
+            self.model.to(device)
+        for i in missing:
+            if cpu:
+                u = self([texts[i]], torch.device('cpu'))[0].to(device)
+            else:
+                u = self([texts[i]], device)[0]
+            if self.cache is not None:
+                self.cache.put(keys[i], u)
+            context[i] = u
+        if not cpu and offload_model:
+            self.model.cpu()
+        return context
@@ -1,18 +1,18 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
-import logging
-
 import torch
 import torch.cuda.amp as amp
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
 
+from ..utils.checkpoint import load_checkpoint
+from ..utils.vae_cache import CausalCache, shape_batches
+from ..utils.vae_tiling import blend_tiles, tile_grid
+
 __all__ = [
     'Wan2_1_VAE',
 ]
 
-CACHE_T = 2
-
 
 class CausalConv3d(nn.Conv3d):
     """
@@ -103,32 +103,11 @@ class Resample(nn.Module):
         if self.mode == 'upsample3d':
             if feat_cache is not None:
                 idx = feat_idx[0]
-                if feat_cache[idx] is None:
-                    feat_cache[idx] = 'Rep'
+                if feat_cache.prime(idx):
+                    # the first chunk is not upsampled in time
                     feat_idx[0] += 1
                 else:
-
-                    cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                    if cache_x.shape[2] < 2 and feat_cache[
-                            idx] is not None and feat_cache[idx] != 'Rep':
-                        # cache last frame of last two chunk
-                        cache_x = torch.cat([
-                            feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                                cache_x.device), cache_x
-                        ],
-                                            dim=2)
-                    if cache_x.shape[2] < 2 and feat_cache[
-                            idx] is not None and feat_cache[idx] == 'Rep':
-                        cache_x = torch.cat([
-                            torch.zeros_like(cache_x).to(cache_x.device),
-                            cache_x
-                        ],
-                                            dim=2)
-                    if feat_cache[idx] == 'Rep':
-                        x = self.time_conv(x)
-                    else:
-                        x = self.time_conv(x, feat_cache[idx])
-                    feat_cache[idx] = cache_x
+                    x = feat_cache.conv(self.time_conv, x, idx)
                     feat_idx[0] += 1
 
                     x = x.reshape(b, 2, c, t, h, w)
@@ -143,19 +122,12 @@ class Resample(nn.Module):
         if self.mode == 'downsample3d':
             if feat_cache is not None:
                 idx = feat_idx[0]
-                if feat_cache[idx] is None:
-                    feat_cache[idx] = x.clone()
+                if feat_cache.prime(idx):
+                    # the first chunk is not downsampled in time
+                    feat_cache.store(x, idx, frames=1)
                     feat_idx[0] += 1
                 else:
-
-                    cache_x = x[:, :, -1:, :, :].clone()
-                    # if cache_x.shape[2] < 2 and feat_cache[idx] is not None and feat_cache[idx]!='Rep':
-                    #     # cache last frame of last two chunk
-                    #     cache_x = torch.cat([feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(cache_x.device), cache_x], dim=2)
-
-                    x = self.time_conv(
-                        torch.cat([feat_cache[idx][:, :, -1:, :, :], x], 2))
-                    feat_cache[idx] = cache_x
+                    x = feat_cache.conv(self.time_conv, x, idx, frames=1)
                     feat_idx[0] += 1
         return x
 
@@ -203,17 +175,7 @@ class ResidualBlock(nn.Module):
         h = self.shortcut(x)
         for layer in self.residual:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat([
-                        feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                            cache_x.device), cache_x
-                    ],
-                                        dim=2)
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
+                x = feat_cache.conv(layer, x, feat_idx[0])
                 feat_idx[0] += 1
             else:
                 x = layer(x)
@@ -317,17 +279,7 @@ class Encoder3d(nn.Module):
 
     def forward(self, x, feat_cache=None, feat_idx=[0]):
         if feat_cache is not None:
-            idx = feat_idx[0]
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                # cache last frame of last two chunk
-                cache_x = torch.cat([
-                    feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                        cache_x.device), cache_x
-                ],
-                                    dim=2)
-            x = self.conv1(x, feat_cache[idx])
-            feat_cache[idx] = cache_x
+            x = feat_cache.conv(self.conv1, x, feat_idx[0])
             feat_idx[0] += 1
         else:
             x = self.conv1(x)
@@ -349,17 +301,7 @@ class Encoder3d(nn.Module):
         ## head
         for layer in self.head:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat([
-                        feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                            cache_x.device), cache_x
-                    ],
-                                        dim=2)
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
+                x = feat_cache.conv(layer, x, feat_idx[0])
                 feat_idx[0] += 1
             else:
                 x = layer(x)
@@ -423,17 +365,7 @@ class Decoder3d(nn.Module):
     def forward(self, x, feat_cache=None, feat_idx=[0]):
         ## conv1
         if feat_cache is not None:
-            idx = feat_idx[0]
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                # cache last frame of last two chunk
-                cache_x = torch.cat([
-                    feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                        cache_x.device), cache_x
-                ],
-                                    dim=2)
-            x = self.conv1(x, feat_cache[idx])
-            feat_cache[idx] = cache_x
+            x = feat_cache.conv(self.conv1, x, feat_idx[0])
             feat_idx[0] += 1
         else:
             x = self.conv1(x)
@@ -455,17 +387,7 @@ class Decoder3d(nn.Module):
         ## head
         for layer in self.head:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat([
-                        feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                            cache_x.device), cache_x
-                    ],
-                                        dim=2)
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
+                x = feat_cache.conv(layer, x, feat_idx[0])
                 feat_idx[0] += 1
             else:
                 x = layer(x)
@@ -507,6 +429,10 @@ class WanVAE_(nn.Module):
         self.decoder = Decoder3d(dim, z_dim, dim_mult, num_res_blocks,
                                  attn_scales, self.temperal_upsample, dropout)
 
+        # number of cached convs, counted once instead of on every pass
+        self._conv_num = count_conv3d(self.decoder)
+        self._enc_conv_num = count_conv3d(self.encoder)
+
     def forward(self, x):
         mu, log_var = self.encode(x)
         z = self.reparameterize(mu, log_var)
@@ -519,19 +445,16 @@ class WanVAE_(nn.Module):
         t = x.shape[2]
         iter_ = 1 + (t - 1) // 4
         ## 对encode输入的x，按时间拆分为1、4、4、4....
+        outs = []
         for i in range(iter_):
             self._enc_conv_idx = [0]
-            if i == 0:
-                out = self.encoder(
-                    x[:, :, :1, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx)
-            else:
-                out_ = self.encoder(
-                    x[:, :, 1 + 4 * (i - 1):1 + 4 * i, :, :],
+            start = 0 if i == 0 else 1 + 4 * (i - 1)
+            outs.append(
+                self.encoder(
+                    x[:, :, start:1 + 4 * i, :, :],
                     feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx)
-                out = torch.cat([out, out_], 2)
+                    feat_idx=self._enc_conv_idx))
+        out = torch.cat(outs, 2)
         mu, log_var = self.conv1(out).chunk(2, dim=1)
         if isinstance(scale[0], torch.Tensor):
             mu = (mu - scale[0].view(1, self.z_dim, 1, 1, 1)) * scale[1].view(
@@ -541,7 +464,21 @@ class WanVAE_(nn.Module):
         self.clear_cache()
         return mu
 
-    def decode(self, z, scale):
+    def decode(self, z, scale, tile_size=None, tile_overlap=8):
+        return torch.cat(
+            list(self.decode_stream(z, scale, tile_size, tile_overlap)), 2)
+
+    def decode_stream(self, z, scale, tile_size=None, tile_overlap=8):
+        r"""
+        Decodes `z` one latent frame at a time and yields each output chunk
+        [B, 3, T_i, H, W] instead of concatenating them.
+
+        If `tile_size` is given, every latent frame is decoded in spatial
+        tiles of at most `tile_size` latent pixels that overlap by
+        `tile_overlap` pixels and are blended at the seams. Each tile keeps
+        its own causal cache, so peak memory follows the tile size instead of
+        the frame size. Attention in the middle block only sees its own tile.
+        """
         self.clear_cache()
         # z: [b,c,t,h,w]
         if isinstance(scale[0], torch.Tensor):
@@ -551,21 +488,23 @@ class WanVAE_(nn.Module):
             z = z / scale[1] + scale[0]
         iter_ = z.shape[2]
         x = self.conv2(z)
-        for i in range(iter_):
-            self._conv_idx = [0]
-            if i == 0:
-                out = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
-            else:
-                out_ = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
-                out = torch.cat([out, out_], 2)
-        self.clear_cache()
-        return out
+        spans_h, spans_w, tiles = tile_grid(x.shape[3], x.shape[4], tile_size,
+                                            tile_overlap)
+        # tiles run one after the other and share the conv workspaces
+        workspaces = {}
+        feat_maps = [CausalCache(self._conv_num, workspaces) for _ in tiles]
+        try:
+            for i in range(iter_):
+                chunks = []
+                for ((h0, h1), (w0, w1)), feat_map in zip(tiles, feat_maps):
+                    chunks.append(
+                        self.decoder(
+                            x[:, :, i:i + 1, h0:h1, w0:w1],
+                            feat_cache=feat_map,
+                            feat_idx=[0]))
+                yield blend_tiles(chunks, spans_h, spans_w)
+        finally:
+            self.clear_cache()
 
     def reparameterize(self, mu, log_var):
         std = torch.exp(0.5 * log_var)
@@ -580,13 +519,11 @@ class WanVAE_(nn.Module):
         return mu + std * torch.randn_like(std)
 
     def clear_cache(self):
-        self._conv_num = count_conv3d(self.decoder)
         self._conv_idx = [0]
-        self._feat_map = [None] * self._conv_num
-        #cache encode
-        self._enc_conv_num = count_conv3d(self.encoder)
+        self._feat_map = CausalCache(self._conv_num)
+        # cache encode
         self._enc_conv_idx = [0]
-        self._enc_feat_map = [None] * self._enc_conv_num
+        self._enc_feat_map = CausalCache(self._enc_conv_num)
 
 
 def _video_vae(pretrained_path=None, z_dim=None, device='cpu', **kwargs):
@@ -609,9 +546,7 @@ def _video_vae(pretrained_path=None, z_dim=None, device='cpu', **kwargs):
         model = WanVAE_(**cfg)
 
     # load checkpoint
-    logging.info(f'loading {pretrained_path}')
-    model.load_state_dict(
-        torch.load(pretrained_path, map_location=device), assign=True)
+    load_checkpoint(model, pretrained_path, device=device)
 
     return model
 
@@ -622,9 +557,14 @@ class Wan2_1_VAE:
                  z_dim=16,
                  vae_pth='cache/vae_step_411000.pth',
                  dtype=torch.float,
-                 device="cuda"):
+                 device="cuda",
+                 tile_size=None,
+                 tile_overlap=8):
         self.dtype = dtype
         self.device = device
+        # spatial tiling of decode, in latent pixels
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
 
         mean = [
             -0.7571, -0.7089, -0.9113, 0.1075, -0.1745, 0.9653, -0.1517, 1.5508,
@@ -642,22 +582,53 @@ class Wan2_1_VAE:
         self.model = _video_vae(
             pretrained_path=vae_pth,
             z_dim=z_dim,
+            device=device,
         ).eval().requires_grad_(False).to(device)
 
-    def encode(self, videos):
+    def encode(self, videos, batch_size=None):
         """
         videos: A list of videos each with shape [C, T, H, W].
+        batch_size: Most videos per encoder pass. Videos of the same shape
+            are stacked into one pass, all of them if None.
         """
+        outs = [None] * len(videos)
         with amp.autocast(dtype=self.dtype):
-            return [
-                self.model.encode(u.unsqueeze(0), self.scale).float().squeeze(0)
-                for u in videos
-            ]
-
-    def decode(self, zs):
+            for indices in shape_batches(videos, batch_size):
+                mu = self.model.encode(
+                    torch.stack([videos[i] for i in indices]),
+                    self.scale).float()
+                for i, u in zip(indices, mu):
+                    outs[i] = u
+        return outs
+
+    def decode(self, zs, batch_size=None):
+        """
+        zs: A list of latent videos each with shape [C, T, H, W].
+        batch_size: Most latents per decoder pass. Latents of the same shape
+            are stacked into one pass, all of them if None.
+        """
+        outs = [None] * len(zs)
         with amp.autocast(dtype=self.dtype):
-            return [
-                self.model.decode(u.unsqueeze(0),
-                                  self.scale).float().clamp_(-1, 1).squeeze(0)
-                for u in zs
-            ]
+            for indices in shape_batches(zs, batch_size):
+                videos = self.model.decode(
+                    torch.stack([zs[i] for i in indices]), self.scale,
+                    self.tile_size, self.tile_overlap).float().clamp_(-1, 1)
+                for i, u in zip(indices, videos):
+                    outs[i] = u
+        return outs
+
+    def decode_stream(self, z):
+        """
+        z: A latent video with shape [C, T, H, W].
+
+        Yields decoded chunks each with shape [3, T_i, H, W].
+        """
+        stream = self.model.decode_stream(
+            z.unsqueeze(0), self.scale, self.tile_size, self.tile_overlap)
+        while True:
+            # autocast must not stay active in the consumer between chunks
+            with amp.autocast(dtype=self.dtype):
+                chunk = next(stream, None)
+            if chunk is None:
+                return
+            yield chunk.float().clamp_(-1, 1).squeeze(0)
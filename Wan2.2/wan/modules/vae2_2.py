@@ -7,12 +7,14 @@ import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
 
+from ..utils.checkpoint import load_checkpoint
+from ..utils.vae_cache import CausalCache, shape_batches
+from ..utils.vae_tiling import blend_tiles, tile_grid
+
 __all__ = [
     "Wan2_2_VAE",
 ]
 
-CACHE_T = 2
-
 
 class CausalConv3d(nn.Conv3d):
     """
@@ -114,36 +116,11 @@ class Resample(nn.Module):
         if self.mode == "upsample3d":
             if feat_cache is not None:
                 idx = feat_idx[0]
-                if feat_cache[idx] is None:
-                    feat_cache[idx] = "Rep"
+                if feat_cache.prime(idx):
+                    # the first chunk is not upsampled in time
                     feat_idx[0] += 1
                 else:
-                    cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                    if (cache_x.shape[2] < 2 and feat_cache[idx] is not None and
-                            feat_cache[idx] != "Rep"):
-                        # cache last frame of last two chunk
-                        cache_x = torch.cat(
-                            [
-                                feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                                    cache_x.device),
-                                cache_x,
-                            ],
-                            dim=2,
-                        )
-                    if (cache_x.shape[2] < 2 and feat_cache[idx] is not None and
-                            feat_cache[idx] == "Rep"):
-                        cache_x = torch.cat(
-                            [
-                                torch.zeros_like(cache_x).to(cache_x.device),
-                                cache_x
-                            ],
-                            dim=2,
-                        )
-                    if feat_cache[idx] == "Rep":
-                        x = self.time_conv(x)
-                    else:
-                        x = self.time_conv(x, feat_cache[idx])
-                    feat_cache[idx] = cache_x
+                    x = feat_cache.conv(self.time_conv, x, idx)
                     feat_idx[0] += 1
                     x = x.reshape(b, 2, c, t, h, w)
                     x = torch.stack((x[:, 0, :, :, :, :], x[:, 1, :, :, :, :]),
@@ -157,14 +134,12 @@ class Resample(nn.Module):
         if self.mode == "downsample3d":
             if feat_cache is not None:
                 idx = feat_idx[0]
-                if feat_cache[idx] is None:
-                    feat_cache[idx] = x.clone()
+                if feat_cache.prime(idx):
+                    # the first chunk is not downsampled in time
+                    feat_cache.store(x, idx, frames=1)
                     feat_idx[0] += 1
                 else:
-                    cache_x = x[:, :, -1:, :, :].clone()
-                    x = self.time_conv(
-                        torch.cat([feat_cache[idx][:, :, -1:, :, :], x], 2))
-                    feat_cache[idx] = cache_x
+                    x = feat_cache.conv(self.time_conv, x, idx, frames=1)
                     feat_idx[0] += 1
         return x
 
@@ -215,20 +190,7 @@ class ResidualBlock(nn.Module):
         h = self.shortcut(x)
         for layer in self.residual:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat(
-                        [
-                            feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                                cache_x.device),
-                            cache_x,
-                        ],
-                        dim=2,
-                    )
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
+                x = feat_cache.conv(layer, x, feat_idx[0])
                 feat_idx[0] += 1
             else:
                 x = layer(x)
@@ -445,11 +407,12 @@ class Down_ResidualBlock(nn.Module):
         self.downsamples = nn.Sequential(*downsamples)
 
     def forward(self, x, feat_cache=None, feat_idx=[0]):
-        x_copy = x.clone()
+        # the blocks do not modify their input in place
+        identity = x
         for module in self.downsamples:
             x = module(x, feat_cache, feat_idx)
 
-        return x + self.avg_shortcut(x_copy)
+        return x + self.avg_shortcut(identity)
 
 
 class Up_ResidualBlock(nn.Module):
@@ -487,7 +450,7 @@ class Up_ResidualBlock(nn.Module):
         self.upsamples = nn.Sequential(*upsamples)
 
     def forward(self, x, feat_cache=None, feat_idx=[0], first_chunk=False):
-        x_main = x.clone()
+        x_main = x
         for module in self.upsamples:
             x_main = module(x_main, feat_cache, feat_idx)
         if self.avg_shortcut is not None:
@@ -559,19 +522,7 @@ class Encoder3d(nn.Module):
     def forward(self, x, feat_cache=None, feat_idx=[0]):
 
         if feat_cache is not None:
-            idx = feat_idx[0]
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                cache_x = torch.cat(
-                    [
-                        feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                            cache_x.device),
-                        cache_x,
-                    ],
-                    dim=2,
-                )
-            x = self.conv1(x, feat_cache[idx])
-            feat_cache[idx] = cache_x
+            x = feat_cache.conv(self.conv1, x, feat_idx[0])
             feat_idx[0] += 1
         else:
             x = self.conv1(x)
@@ -593,19 +544,7 @@ class Encoder3d(nn.Module):
         ## head
         for layer in self.head:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    cache_x = torch.cat(
-                        [
-                            feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                                cache_x.device),
-                            cache_x,
-                        ],
-                        dim=2,
-                    )
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
+                x = feat_cache.conv(layer, x, feat_idx[0])
                 feat_idx[0] += 1
             else:
                 x = layer(x)
@@ -671,19 +610,7 @@ class Decoder3d(nn.Module):
 
     def forward(self, x, feat_cache=None, feat_idx=[0], first_chunk=False):
         if feat_cache is not None:
-            idx = feat_idx[0]
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                cache_x = torch.cat(
-                    [
-                        feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                            cache_x.device),
-                        cache_x,
-                    ],
-                    dim=2,
-                )
-            x = self.conv1(x, feat_cache[idx])
-            feat_cache[idx] = cache_x
+            x = feat_cache.conv(self.conv1, x, feat_idx[0])
             feat_idx[0] += 1
         else:
             x = self.conv1(x)
@@ -704,19 +631,7 @@ class Decoder3d(nn.Module):
         ## head
         for layer in self.head:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    cache_x = torch.cat(
-                        [
-                            feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                                cache_x.device),
-                            cache_x,
-                        ],
-                        dim=2,
-                    )
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
+                x = feat_cache.conv(layer, x, feat_idx[0])
                 feat_idx[0] += 1
             else:
                 x = layer(x)
@@ -775,6 +690,10 @@ class WanVAE_(nn.Module):
             dropout,
         )
 
+        # number of cached convs, counted once instead of on every pass
+        self._conv_num = count_conv3d(self.decoder)
+        self._enc_conv_num = count_conv3d(self.encoder)
+
     def forward(self, x, scale=[0, 1]):
         mu = self.encode(x, scale)
         x_recon = self.decode(mu, scale)
@@ -785,21 +704,16 @@ class WanVAE_(nn.Module):
         x = patchify(x, patch_size=2)
         t = x.shape[2]
         iter_ = 1 + (t - 1) // 4
+        outs = []
         for i in range(iter_):
             self._enc_conv_idx = [0]
-            if i == 0:
-                out = self.encoder(
-                    x[:, :, :1, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx,
-                )
-            else:
-                out_ = self.encoder(
-                    x[:, :, 1 + 4 * (i - 1):1 + 4 * i, :, :],
+            start = 0 if i == 0 else 1 + 4 * (i - 1)
+            outs.append(
+                self.encoder(
+                    x[:, :, start:1 + 4 * i, :, :],
                     feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx,
-                )
-                out = torch.cat([out, out_], 2)
+                    feat_idx=self._enc_conv_idx))
+        out = torch.cat(outs, 2)
         mu, log_var = self.conv1(out).chunk(2, dim=1)
         if isinstance(scale[0], torch.Tensor):
             mu = (mu - scale[0].view(1, self.z_dim, 1, 1, 1)) * scale[1].view(
@@ -809,7 +723,21 @@ class WanVAE_(nn.Module):
         self.clear_cache()
         return mu
 
-    def decode(self, z, scale):
+    def decode(self, z, scale, tile_size=None, tile_overlap=8):
+        return torch.cat(
+            list(self.decode_stream(z, scale, tile_size, tile_overlap)), 2)
+
+    def decode_stream(self, z, scale, tile_size=None, tile_overlap=8):
+        r"""
+        Decodes `z` one latent frame at a time and yields each output chunk
+        [B, 3, T_i, H, W] instead of concatenating them.
+
+        If `tile_size` is given, every latent frame is decoded in spatial
+        tiles of at most `tile_size` latent pixels that overlap by
+        `tile_overlap` pixels and are blended at the seams. Each tile keeps
+        its own causal cache, so peak memory follows the tile size instead of
+        the frame size. Attention in the middle block only sees its own tile.
+        """
         self.clear_cache()
         if isinstance(scale[0], torch.Tensor):
             z = z / scale[1].view(1, self.z_dim, 1, 1, 1) + scale[0].view(
@@ -818,25 +746,26 @@ class WanVAE_(nn.Module):
             z = z / scale[1] + scale[0]
         iter_ = z.shape[2]
         x = self.conv2(z)
-        for i in range(iter_):
-            self._conv_idx = [0]
-            if i == 0:
-                out = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx,
-                    first_chunk=True,
-                )
-            else:
-                out_ = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx,
-                )
-                out = torch.cat([out, out_], 2)
-        out = unpatchify(out, patch_size=2)
-        self.clear_cache()
-        return out
+        spans_h, spans_w, tiles = tile_grid(x.shape[3], x.shape[4], tile_size,
+                                            tile_overlap)
+        # tiles run one after the other and share the conv workspaces
+        workspaces = {}
+        feat_maps = [CausalCache(self._conv_num, workspaces) for _ in tiles]
+        try:
+            for i in range(iter_):
+                chunks = []
+                for ((h0, h1), (w0, w1)), feat_map in zip(tiles, feat_maps):
+                    chunks.append(
+                        self.decoder(
+                            x[:, :, i:i + 1, h0:h1, w0:w1],
+                            feat_cache=feat_map,
+                            feat_idx=[0],
+                            first_chunk=(i == 0),
+                        ))
+                out = blend_tiles(chunks, spans_h, spans_w)
+                yield unpatchify(out, patch_size=2)
+        finally:
+            self.clear_cache()
 
     def reparameterize(self, mu, log_var):
         std = torch.exp(0.5 * log_var)
@@ -851,13 +780,11 @@ class WanVAE_(nn.Module):
         return mu + std * torch.randn_like(std)
 
     def clear_cache(self):
-        self._conv_num = count_conv3d(self.decoder)
         self._conv_idx = [0]
-        self._feat_map = [None] * self._conv_num
+        self._feat_map = CausalCache(self._conv_num)
         # cache encode
-        self._enc_conv_num = count_conv3d(self.encoder)
         self._enc_conv_idx = [0]
-        self._enc_feat_map = [None] * self._enc_conv_num
+        self._enc_feat_map = CausalCache(self._enc_conv_num)
 
 
 def _video_vae(pretrained_path=None, z_dim=16, dim=160, device="cpu", **kwargs):
@@ -878,9 +805,7 @@ def _video_vae(pretrained_path=None, z_dim=16, dim=160, device="cpu", **kwargs):
         model = WanVAE_(**cfg)
 
     # load checkpoint
-    logging.info(f"loading {pretrained_path}")
-    model.load_state_dict(
-        torch.load(pretrained_path, map_location=device), assign=True)
+    load_checkpoint(model, pretrained_path, device=device)
 
     return model
 
@@ -896,10 +821,15 @@ class Wan2_2_VAE:
         temperal_downsample=[False, True, True],
         dtype=torch.float,
         device="cuda",
+        tile_size=None,
+        tile_overlap=8,
     ):
 
         self.dtype = dtype
         self.device = device
+        # spatial tiling of decode, in latent pixels
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
 
         mean = torch.tensor(
             [
@@ -1019,33 +949,65 @@ class Wan2_2_VAE:
                 dim=c_dim,
                 dim_mult=dim_mult,
                 temperal_downsample=temperal_downsample,
+                device=device,
             ).eval().requires_grad_(False).to(device))
 
-    def encode(self, videos):
+    def encode(self, videos, batch_size=None):
+        """
+        videos: A list of videos each with shape [C, T, H, W].
+        batch_size: Most videos per encoder pass. Videos of the same shape
+            are stacked into one pass, all of them if None.
+        """
         try:
             if not isinstance(videos, list):
                 raise TypeError("videos should be a list")
+            outs = [None] * len(videos)
             with amp.autocast(dtype=self.dtype):
-                return [
-                    self.model.encode(u.unsqueeze(0),
-                                      self.scale).float().squeeze(0)
-                    for u in videos
-                ]
+                for indices in shape_batches(videos, batch_size):
+                    mu = self.model.encode(
+                        torch.stack([videos[i] for i in indices]),
+                        self.scale).float()
+                    for i, u in zip(indices, mu):
+                        outs[i] = u
+            return outs
         except TypeError as e:
             logging.info(e)
             return None
 
-    def decode(self, zs):
+    def decode(self, zs, batch_size=None):
+        """
+        zs: A list of latent videos each with shape [C, T, H, W].
+        batch_size: Most latents per decoder pass. Latents of the same shape
+            are stacked into one pass, all of them if None.
+        """
         try:
             if not isinstance(zs, list):
                 raise TypeError("zs should be a list")
+            outs = [None] * len(zs)
             with amp.autocast(dtype=self.dtype):
-                return [
-                    self.model.decode(u.unsqueeze(0),
-                                      self.scale).float().clamp_(-1,
-                                                                 1).squeeze(0)
-                    for u in zs
-                ]
+                for indices in shape_batches(zs, batch_size):
+                    videos = self.model.decode(
+                        torch.stack([zs[i] for i in indices]), self.scale,
+                        self.tile_size, self.tile_overlap).float().clamp_(-1, 1)
+                    for i, u in zip(indices, videos):
+                        outs[i] = u
+            return outs
         except TypeError as e:
             logging.info(e)
             return None
+
+    def decode_stream(self, z):
+        """
+        z: A latent video with shape [C, T, H, W].
+
+        Yields decoded chunks each with shape [3, T_i, H, W].
+        """
+        stream = self.model.decode_stream(
+            z.unsqueeze(0), self.scale, self.tile_size, self.tile_overlap)
+        while True:
+            # autocast must not stay active in the consumer between chunks
+            with amp.autocast(dtype=self.dtype):
+                chunk = next(stream, None)
+            if chunk is None:
+                return
+            yield chunk.float().clamp_(-1, 1).squeeze(0)
@@ -32,7 +32,16 @@ from .utils.fm_solvers import (
     get_sampling_sigmas,
     retrieve_timesteps,
 )
+from .utils.audio_cache import AudioFeatureCache
+from .utils.cfg import CFGBatcher
+from .utils.cancel import cancellable
+from .utils.compile import BlockCompiler
 from .utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .utils.offload import BlockStreamer, ExpertSwapper, HostCopier
+from .utils.preview import LatentPreviewer
+from .utils.snapshot import SamplingSnapshot, job_key, snapshot_seed
+from .utils.text_cache import TextEmbeddingCache
+from .utils.vae_cache import shape_batches
 from .utils.device import (
     get_best_device,
     get_effective_param_dtype,
@@ -41,6 +50,9 @@ from .utils.device import (
     synchronize_if_needed,
 )
 
+# pose chunks encoded per VAE pass, bounds the encoder activations
+POSE_ENCODE_BATCH = 4
+
 
 def load_safetensors(path):
     tensors = {}
@@ -64,6 +76,14 @@ class WanS2V:
         t5_cpu=False,
         init_on_cpu=True,
         convert_model_dtype=False,
+        t5_cache_dir=None,
+        vae_tile_size=None,
+        dit_vram_budget=None,
+        prefetch_vram_budget=None,
+        pin_expert_memory=True,
+        compile_mode=None,
+        compile_cache_dir=None,
+        audio_cache_dir=None,
     ):
         r"""
         Initializes the image-to-video generation model components.
@@ -90,12 +110,46 @@ class WanS2V:
             convert_model_dtype (`bool`, *optional*, defaults to False):
                 Convert DiT model parameters dtype to 'config.param_dtype'.
                 Only works without FSDP.
+            t5_cache_dir (`str`, *optional*, defaults to None):
+                Directory of the on-disk T5 embedding cache. If None, encoded
+                prompts are only cached in memory. Disabled with t5_fsdp.
+            vae_tile_size (`int`, *optional*, defaults to None):
+                Decode the VAE in overlapping spatial tiles of this many latent
+                pixels to bound its peak memory. If None, frames are decoded whole.
+            dit_vram_budget (`float`, *optional*, defaults to None):
+                Device memory in GiB for the DiT weights. If the DiT does not
+                fit, its blocks are streamed from host memory. Ignored with
+                dit_fsdp.
+            prefetch_vram_budget (`float`, *optional*, defaults to None):
+                Most device memory in GiB the offloaded DiT is prefetched into
+                ahead of the next clip. If None, the free memory minus the
+                measured peak of a sampling step, and at least a quarter of the
+                device memory.
+            pin_expert_memory (`bool`, *optional*, defaults to True):
+                Pin the prefetched host weights so their copies overlap with
+                compute. Disable to save page-locked host memory.
+            compile_mode (`str`, *optional*, defaults to None):
+                `torch.compile` mode of the DiT blocks, see `COMPILE_MODES`.
+                If None, the DiT runs eagerly. Not supported with dit_fsdp
+                or dit_vram_budget.
+            compile_cache_dir (`str`, *optional*, defaults to None):
+                Directory of the compiled artifacts, keyed by model, latent
+                shape and dtype.
+            audio_cache_dir (`str`, *optional*, defaults to None):
+                Directory of the on-disk cache of audio features, keyed by the
+                content of the audio file. If None, audio is always encoded.
         """
         self.device = get_best_device(device_id)
         self.config = config
         self.rank = rank
         self.t5_cpu = t5_cpu
         self.init_on_cpu = init_on_cpu
+        self.dit_vram_budget = dit_vram_budget
+        self.block_streaming = False
+        self.compiler = BlockCompiler(
+            compile_mode, compile_cache_dir,
+            self.device) if compile_mode is not None else None
+        self.dit_fsdp = dit_fsdp
 
         self.num_train_timesteps = config.num_train_timesteps
         self.param_dtype = get_effective_param_dtype(config.param_dtype, self.device)
@@ -112,11 +166,17 @@ class WanS2V:
             checkpoint_path=os.path.join(checkpoint_dir, config.t5_checkpoint),
             tokenizer_path=os.path.join(checkpoint_dir, config.t5_tokenizer),
             shard_fn=shard_fn if t5_fsdp else None,
+            cache=TextEmbeddingCache(cache_dir=t5_cache_dir),
         )
 
         self.vae = Wan2_1_VAE(
             vae_pth=os.path.join(checkpoint_dir, config.vae_checkpoint),
-            device=self.device)
+            device=self.device,
+            tile_size=vae_tile_size)
+        self.previewer = LatentPreviewer(
+            self.vae,
+            os.path.join(checkpoint_dir, config.preview_checkpoint),
+            config.vae_stride)
 
         logging.info(f"Creating WanModel from {checkpoint_dir}")
         if not dit_fsdp:
@@ -134,10 +194,19 @@ class WanS2V:
             dit_fsdp=dit_fsdp,
             shard_fn=shard_fn,
             convert_model_dtype=convert_model_dtype)
+        if self.dit_vram_budget is not None and not dit_fsdp:
+            self._apply_vram_budget([self.noise_model])
+        self.dit_swapper = ExpertSwapper(
+            self.device,
+            max_prefetch_bytes=int(prefetch_vram_budget * 1024**3)
+            if prefetch_vram_budget is not None else None,
+            pin_memory=pin_expert_memory)
 
         self.audio_encoder = AudioEncoder(
             model_id=os.path.join(checkpoint_dir,
-                                  "wav2vec2-large-xlsr-53-english"))
+                                  "wav2vec2-large-xlsr-53-english"),
+            cache=AudioFeatureCache(audio_cache_dir)
+            if audio_cache_dir is not None else None)
 
         if use_sp:
             self.sp_size = get_world_size()
@@ -150,6 +219,21 @@ class WanS2V:
         self.fps = config.sample_fps
         self.audio_sample_m = 0
 
+    def _apply_vram_budget(self, models):
+        r"""
+        Places the DiT `models` within `dit_vram_budget`, for all of them
+        together, see `BlockStreamer.from_budget`.
+        """
+        mode = BlockStreamer.from_budget(models, self.device,
+                                         int(self.dit_vram_budget * 1024**3))
+        self.block_streaming = mode == 'stream'
+        if mode == 'swap':
+            # kept on the host, swapped in one at a time
+            self.init_on_cpu = True
+        elif mode == 'resident' and not self.init_on_cpu:
+            for model in models:
+                model.to(self.device)
+
     def _configure_model(self, model, use_sp, dit_fsdp, shard_fn,
                          convert_model_dtype):
         """
@@ -188,11 +272,51 @@ class WanS2V:
         else:
             if convert_model_dtype:
                 model.to(self.param_dtype)
-            if not self.init_on_cpu:
+            if self.dit_vram_budget is None and not self.init_on_cpu:
                 model.to(self.device)
 
+        if self.compiler is not None:
+            model = self.compiler.compile(model)
+
         return model
 
+    def _prepare_condition(self, kwargs):
+        r"""
+        Replaces the conditioning arguments of a `noise_model` forward by the
+        output of `WanModel_S2V.prepare_condition`, which stays valid for all
+        sampling steps of a clip.
+        """
+        if self.dit_fsdp:
+            # the non-block weights are only gathered inside the FSDP forward
+            return kwargs
+        return {
+            'seq_len': kwargs['seq_len'],
+            'condition': self.noise_model.prepare_condition(**kwargs),
+        }
+
+    def _decode_clip(self, latents, infer_frames, drop_motion,
+                     video_writer=None):
+        r"""
+        Decodes a clip chunk by chunk and keeps its last `infer_frames` frames,
+        without the 3 leading frames if the motion frames were dropped. Kept
+        frames are passed to `video_writer` as soon as they are decoded.
+
+        Returns:
+            Tensor: The kept frames, shape [1, 3, T, H, W].
+        """
+        num_frames = (latents.shape[2] - 1) * 4 + 1
+        skip = max(num_frames - infer_frames, 0) + (3 if drop_motion else 0)
+        kept = []
+        for chunk in self.vae.decode_stream(latents[0]):
+            if skip >= chunk.shape[1]:
+                skip -= chunk.shape[1]
+                continue
+            chunk, skip = chunk[:, skip:], 0
+            if video_writer is not None and self.rank == 0:
+                video_writer.write(chunk)
+            kept.append(chunk)
+        return torch.cat(kept, dim=1).unsqueeze(0)
+
     def get_size_less_than_area(self,
                                 height,
                                 width,
@@ -292,6 +416,35 @@ class WanS2V:
             audio_path, return_all_layers=True)
         audio_embed_bucket, num_repeat = self.audio_encoder.get_audio_embed_bucket_fps(
             z, fps=self.fps, batch_frames=infer_frames, m=self.audio_sample_m)
+        return self._format_audio_bucket(audio_embed_bucket), num_repeat
+
+    def stream_audio(self, audio_path, infer_frames, chunk_seconds):
+        r"""
+        Starts encoding the audio in windows of `chunk_seconds` on a
+        background thread.
+
+        Returns:
+            Tuple[`Callable`, `int`]: A function mapping a clip index to the
+            audio embedding of the clip, as sliced from `encode_audio`, and
+            the number of clips. The function only waits for the audio of its
+            clip.
+        """
+        stream = self.audio_encoder.stream_audio_feat(
+            audio_path, return_all_layers=True, chunk_seconds=chunk_seconds)
+
+        def clip_audio(r):
+            bucket = self.audio_encoder.get_audio_embed_bucket_fps_clip(
+                stream,
+                r,
+                fps=self.fps,
+                batch_frames=infer_frames,
+                m=self.audio_sample_m)
+            return self._format_audio_bucket(bucket)
+
+        return clip_audio, self.audio_encoder.num_buckets_fps(
+            stream, fps=self.fps, batch_frames=infer_frames)
+
+    def _format_audio_bucket(self, audio_embed_bucket):
         audio_embed_bucket = audio_embed_bucket.to(self.device,
                                                    self.param_dtype)
         audio_embed_bucket = audio_embed_bucket.unsqueeze(0)
@@ -369,17 +522,20 @@ class WanS2V:
         else:
             cond_tensors = [-torch.ones([1, 3, infer_frames, HEIGHT, WIDTH])]
 
-        COND = []
-        for r in range(len(cond_tensors)):
-            cond = cond_tensors[r]
-            cond = torch.cat([cond[:, :, 0:1].repeat(1, 1, 1, 1, 1), cond],
-                             dim=2)
-            cond_lat = torch.stack(
-                self.vae.encode(
-                    cond.to(dtype=self.param_dtype,
-                            device=self.device)))[:, :,
-                                                  1:].cpu()  # for mem save
-            COND.append(cond_lat)
+        # the chunks share one shape, encode them a few at a time
+        conds = [
+            torch.cat([cond[0, :, 0:1], cond[0]], dim=1)
+            for cond in cond_tensors
+        ]
+        COND = [None] * len(conds)
+        for indices in shape_batches(conds, POSE_ENCODE_BATCH):
+            batch = [
+                conds[i].to(dtype=self.param_dtype, device=self.device)
+                for i in indices
+            ]
+            for i, cond_lat in zip(indices, self.vae.encode(batch)):
+                COND[i] = cond_lat[None, :, 1:].cpu()  # for mem save
+            del batch
         return COND
 
     def get_gen_size(self, size, max_area, ref_image_path, pre_video_path):
@@ -413,6 +569,16 @@ class WanS2V:
         seed=-1,
         offload_model=True,
         init_first_frame=False,
+        batch_cfg=False,
+        video_writer=None,
+        pipeline_clips=False,
+        audio_chunk_seconds=None,
+        preview_callback=None,
+        preview_steps=5,
+        callback=None,
+        cancel_token=None,
+        snapshot_file=None,
+        snapshot_steps=5,
     ):
         r"""
         Generates video frames from input image and text prompt using diffusion process.
@@ -451,6 +617,48 @@ class WanS2V:
                 If True, offloads models to CPU during generation to save VRAM
             init_first_frame (`bool`, *optional*, defaults to False):
                 Whether to use the reference image as the first frame (i.e., standard image-to-video generation)
+            batch_cfg (`bool`, *optional*, defaults to False):
+                If True, runs the conditional and unconditional passes as one
+                batched forward. Falls back to sequential passes on OOM.
+            video_writer (`VideoWriter`, *optional*, defaults to None):
+                If given, decoded frames are streamed to this writer clip by
+                clip and None is returned instead of the video tensor.
+            pipeline_clips (`bool`, *optional*, defaults to False):
+                If True, finished frames are copied to the host or handed to
+                `video_writer` in the background, decoded chunks reach
+                `video_writer` as soon as they are ready and, with
+                `offload_model`, the DiT weights of the next clip are reloaded
+                while the motion frames are re-encoded. The decode and the
+                re-encode still run before the next clip is sampled, so
+                without `offload_model` the gain is small.
+            audio_chunk_seconds (`float`, *optional*, defaults to None):
+                If given, the audio features are extracted in windows of this
+                many seconds on a background thread, and every clip only waits
+                for its own audio. If None, the whole track is encoded at once.
+            preview_callback (`callable`, *optional*, defaults to None):
+                Called as `preview_callback(step, preview)` every
+                `preview_steps` steps and at the last step of every clip, with
+                a cheap RGB preview [3, T, H / stride, W / stride] in [-1, 1]
+                of the current denoised estimate. `step` counts within the
+                clip. Only called on rank 0.
+            preview_steps (`int`, *optional*, defaults to 5):
+                Number of steps between two previews.
+            callback (`callable`, *optional*, defaults to None):
+                Called as `callback(step, t, latent)` after every sampling step,
+                with the updated latent [C, T, H, W], within the current clip.
+            cancel_token (`CancellationToken`, *optional*, defaults to None):
+                If cancelled, sampling stops before the next step, the models are
+                offloaded as after a finished run, nothing is decoded and None is
+                returned. In a distributed run every rank passes a token, and
+                cancelling any of them stops all ranks at the same step.
+            snapshot_file (`str`, *optional*, defaults to None):
+                If given, the sampling state is saved to this file every
+                `snapshot_steps` steps and at the end of every clip, and a run
+                with the same arguments and seed resumes from it. Finished
+                clips are decoded again without sampling. It is removed once
+                the video is decoded.
+            snapshot_steps (`int`, *optional*, defaults to 5):
+                Number of steps between two snapshots.
 
         Returns:
             torch.Tensor:
@@ -460,6 +668,12 @@ class WanS2V:
                 - H: Frame height (from max_area)
                 - W: Frame width from max_area)
         """
+        if pipeline_clips and (not offload_model or self.block_streaming):
+            logging.warning(
+                "pipeline_clips only overlaps the output of every clip with "
+                "the next one. The DiT is not reloaded between clips, so the "
+                "VAE round trip still runs before the next clip is sampled.")
+
         # preprocess
         size = self.get_gen_size(
             size=None,
@@ -485,7 +699,15 @@ class WanS2V:
                 device=self.device)
 
         # extract audio emb
-        audio_emb, nr = self.encode_audio(audio_path, infer_frames=infer_frames)
+        if audio_chunk_seconds is None:
+            audio_emb, nr = self.encode_audio(
+                audio_path, infer_frames=infer_frames)
+
+            def clip_audio(r):
+                return audio_emb[..., r * infer_frames:(r + 1) * infer_frames]
+        else:
+            clip_audio, nr = self.stream_audio(
+                audio_path, infer_frames, chunk_seconds=audio_chunk_seconds)
         if num_repeat is None or num_repeat > nr:
             num_repeat = nr
 
@@ -514,25 +736,48 @@ class WanS2V:
             infer_frames=infer_frames,
             size=size)
 
+        if seed < 0 and snapshot_file is not None:
+            # resume an interrupted run that drew a random seed
+            seed = snapshot_seed(snapshot_file)
+            seed = seed if seed is not None else -1
         seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
 
         if n_prompt == "":
             n_prompt = self.sample_neg_prompt
 
         # preprocess
-        if not self.t5_cpu:
-            self.text_encoder.model.to(self.device)
-            context = self.text_encoder([input_prompt], self.device)
-            context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
-                self.text_encoder.model.cpu()
-        else:
-            context = self.text_encoder([input_prompt], torch.device('cpu'))
-            context_null = self.text_encoder([n_prompt], torch.device('cpu'))
-            context = [t.to(self.device) for t in context]
-            context_null = [t.to(self.device) for t in context_null]
+        context, context_null = self.text_encoder.encode(
+            [input_prompt, n_prompt],
+            self.device,
+            offload_model=offload_model,
+            cpu=self.t5_cpu)
+        context, context_null = [context], [context_null]
+
+        snapshot = None
+        if snapshot_file is not None:
+            snapshot = SamplingSnapshot(
+                snapshot_file,
+                snapshot_steps,
+                key=job_key(
+                    type(self).__name__,
+                    input_prompt,
+                    num_repeat,
+                    max_area,
+                    infer_frames,
+                    init_first_frame,
+                    n_prompt,
+                    seed,
+                    sample_solver,
+                    sampling_steps,
+                    shift,
+                    guide_scale,
+                    batch_cfg,
+                    files=(ref_image_path, audio_path, pose_video)),
+                save=self.rank == 0,
+                seed=seed)
 
         out = []
+        host_copier = HostCopier(self.device)
         # evaluation mode
         with (
                 dev_autocast(self.device, self.param_dtype),
@@ -579,13 +824,15 @@ class WanS2V:
                     raise NotImplementedError("Unsupported solver.")
 
                 latents = deepcopy(noise)
+                start = 0
+                if snapshot is not None:
+                    start, latents[0] = snapshot.restore(
+                        r, sample_scheduler, seed_g, latents[0])
                 with torch.no_grad():
-                    left_idx = r * infer_frames
-                    right_idx = r * infer_frames + infer_frames
                     cond_latents = COND[r] if pose_video else COND[0] * 0
                     cond_latents = cond_latents.to(
                         dtype=self.param_dtype, device=self.device)
-                    audio_input = audio_emb[..., left_idx:right_idx]
+                    audio_input = clip_audio(r)
                 input_motion_latents = motion_latents.clone()
 
                 arg_c = {
@@ -611,28 +858,49 @@ class WanS2V:
                         ],
                         "drop_motion_frames": drop_first_motion and r == 0,
                     }
-                if offload_model or self.init_on_cpu:
-                    self.noise_model.to(self.device)
-                    empty_cache_if_needed(self.device)
-
-                for i, t in enumerate(tqdm(timesteps)):
+                if not self.block_streaming and (offload_model or
+                                                 self.init_on_cpu):
+                    self.dit_swapper.activate(self.noise_model)
+                if guide_scale > 1:
+                    cfg_batcher = CFGBatcher(
+                        arg_c,
+                        arg_null,
+                        enabled=batch_cfg,
+                        device=self.device,
+                        prepare=self._prepare_condition)
+                else:
+                    arg_c = self._prepare_condition(arg_c)
+
+                preview = None
+                if preview_callback is not None and self.rank == 0:
+                    preview = self.previewer.hook(preview_callback, preview_steps,
+                                                  len(timesteps),
+                                                  self.num_train_timesteps)
+                steps = timesteps[start:] if self.compiler is None else (
+                    self.compiler.steps(timesteps[start:],
+                                        tuple(noise[0].shape)))
+                steps = cancellable(steps, cancel_token)
+                for i, t in enumerate(
+                        tqdm(steps, initial=start, total=len(timesteps)),
+                        start):
                     latent_model_input = latents[0:1]
                     timestep = [t]
 
                     timestep = torch.stack(timestep).to(self.device)
 
-                    noise_pred_cond = self.noise_model(
-                        latent_model_input, t=timestep, **arg_c)
-
                     if guide_scale > 1:
-                        noise_pred_uncond = self.noise_model(
-                            latent_model_input, t=timestep, **arg_null)
+                        noise_pred_cond, noise_pred_uncond = cfg_batcher(
+                            self.noise_model, latent_model_input, timestep)
                         noise_pred = [
                             u + guide_scale * (c - u)
                             for c, u in zip(noise_pred_cond, noise_pred_uncond)
                         ]
                     else:
-                        noise_pred = noise_pred_cond
+                        noise_pred = self.noise_model(
+                            latent_model_input, t=timestep, **arg_c)
+
+                    if preview is not None:
+                        preview(i, t, latents[0], noise_pred[0])
 
                     temp_x0 = sample_scheduler.step(
                         noise_pred[0].unsqueeze(0),
@@ -641,20 +909,36 @@ class WanS2V:
                         return_dict=False,
                         generator=seed_g)[0]
                     latents[0] = temp_x0.squeeze(0)
+                    if callback is not None:
+                        callback(i, t, latents[0])
+                    if snapshot is not None:
+                        snapshot.step(r, i, latents[0], sample_scheduler,
+                                      seed_g)
 
-                if offload_model:
-                    self.noise_model.cpu()
-                    synchronize_if_needed(self.device)
+                if guide_scale > 1:
+                    # keep the OOM fallback for the remaining clips
+                    batch_cfg = cfg_batcher.enabled
+                if self.block_streaming:
+                    self.noise_model.block_streamer.release()
+                elif offload_model:
+                    self.dit_swapper.evict(self.noise_model)
                     empty_cache_if_needed(self.device)
+                if cancel_token is not None and cancel_token.cancelled:
+                    break
                 latents = torch.stack(latents)
-                if not (drop_first_motion and r == 0):
+                drop_motion = drop_first_motion and r == 0
+                if not drop_motion:
                     decode_latents = torch.cat([motion_latents, latents], dim=2)
                 else:
                     decode_latents = torch.cat([ref_latents, latents], dim=2)
-                image = torch.stack(self.vae.decode(decode_latents))
-                image = image[:, :, -(infer_frames):]
-                if (drop_first_motion and r == 0):
-                    image = image[:, :, 3:]
+                if pipeline_clips:
+                    image = self._decode_clip(decode_latents, infer_frames,
+                                              drop_motion, video_writer)
+                else:
+                    image = torch.stack(self.vae.decode(decode_latents))
+                    image = image[:, :, -(infer_frames):]
+                    if drop_motion:
+                        image = image[:, :, 3:]
 
                 overlap_frames_num = min(self.motion_frames, image.shape[2])
                 videos_last_frames = torch.cat([
@@ -666,9 +950,25 @@ class WanS2V:
                     dtype=motion_latents.dtype, device=motion_latents.device)
                 motion_latents = torch.stack(
                     self.vae.encode(videos_last_frames))
-                out.append(image.cpu())
-
-        videos = torch.cat(out, dim=2)
+                if (pipeline_clips and offload_model and
+                        not self.block_streaming and r < num_repeat - 1):
+                    # the encode is only queued, reload the DiT next to it
+                    self.dit_swapper.prefetch(self.noise_model)
+                if video_writer is not None:
+                    if self.rank == 0 and not pipeline_clips:
+                        video_writer.write(image[0])
+                elif pipeline_clips:
+                    out.append(host_copier.copy(image))
+                else:
+                    out.append(image.cpu())
+
+        host_copier.synchronize()
+        if cancel_token is not None and cancel_token.cancelled:
+            logging.info("Generation cancelled.")
+            out = []
+        elif snapshot is not None:
+            snapshot.clear()
+        videos = torch.cat(out, dim=2) if out else [None]
         del noise, latents
         del sample_scheduler
         if offload_model:
@@ -27,7 +27,15 @@ from .utils.fm_solvers import (
     get_sampling_sigmas,
     retrieve_timesteps,
 )
+from .utils.cfg import CFGBatcher
+from .utils.cancel import cancellable
+from .utils.compile import BlockCompiler
 from .utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .utils.offload import BlockStreamer
+from .utils.preview import LatentPreviewer
+from .utils.snapshot import SamplingSnapshot, job_key, snapshot_seed
+from .utils.step_cache import StepCache
+from .utils.text_cache import TextEmbeddingCache
 from .utils.utils import best_output_size, masks_like
 
 
@@ -45,6 +53,11 @@ class WanTI2V:
         t5_cpu=False,
         init_on_cpu=True,
         convert_model_dtype=False,
+        t5_cache_dir=None,
+        vae_tile_size=None,
+        dit_vram_budget=None,
+        compile_mode=None,
+        compile_cache_dir=None,
     ):
         r"""
         Initializes the Wan text-to-video generation model components.
@@ -71,12 +84,34 @@ class WanTI2V:
             convert_model_dtype (`bool`, *optional*, defaults to False):
                 Convert DiT model parameters dtype to 'config.param_dtype'.
                 Only works without FSDP.
+            t5_cache_dir (`str`, *optional*, defaults to None):
+                Directory of the on-disk T5 embedding cache. If None, encoded
+                prompts are only cached in memory. Disabled with t5_fsdp.
+            vae_tile_size (`int`, *optional*, defaults to None):
+                Decode the VAE in overlapping spatial tiles of this many latent
+                pixels to bound its peak memory. If None, frames are decoded whole.
+            dit_vram_budget (`float`, *optional*, defaults to None):
+                Device memory in GiB for the DiT weights. If the DiT does not
+                fit, its blocks are streamed from host memory. Ignored with
+                dit_fsdp.
+            compile_mode (`str`, *optional*, defaults to None):
+                `torch.compile` mode of the DiT blocks, see `COMPILE_MODES`.
+                If None, the DiT runs eagerly. Not supported with dit_fsdp
+                or dit_vram_budget.
+            compile_cache_dir (`str`, *optional*, defaults to None):
+                Directory of the compiled artifacts, keyed by model, latent
+                shape and dtype.
         """
         self.device = torch.device(f"cuda:{device_id}")
         self.config = config
         self.rank = rank
         self.t5_cpu = t5_cpu
         self.init_on_cpu = init_on_cpu
+        self.dit_vram_budget = dit_vram_budget
+        self.block_streaming = False
+        self.compiler = BlockCompiler(
+            compile_mode, compile_cache_dir,
+            self.device) if compile_mode is not None else None
 
         self.num_train_timesteps = config.num_train_timesteps
         self.param_dtype = config.param_dtype
@@ -91,13 +126,19 @@ class WanTI2V:
             device=torch.device('cpu'),
             checkpoint_path=os.path.join(checkpoint_dir, config.t5_checkpoint),
             tokenizer_path=os.path.join(checkpoint_dir, config.t5_tokenizer),
-            shard_fn=shard_fn if t5_fsdp else None)
+            shard_fn=shard_fn if t5_fsdp else None,
+            cache=TextEmbeddingCache(cache_dir=t5_cache_dir))
 
         self.vae_stride = config.vae_stride
         self.patch_size = config.patch_size
         self.vae = Wan2_2_VAE(
             vae_pth=os.path.join(checkpoint_dir, config.vae_checkpoint),
-            device=self.device)
+            device=self.device,
+            tile_size=vae_tile_size)
+        self.previewer = LatentPreviewer(
+            self.vae,
+            os.path.join(checkpoint_dir, config.preview_checkpoint),
+            config.vae_stride)
 
         logging.info(f"Creating WanModel from {checkpoint_dir}")
         self.model = WanModel.from_pretrained(checkpoint_dir)
@@ -107,6 +148,8 @@ class WanTI2V:
             dit_fsdp=dit_fsdp,
             shard_fn=shard_fn,
             convert_model_dtype=convert_model_dtype)
+        if self.dit_vram_budget is not None and not dit_fsdp:
+            self._apply_vram_budget([self.model])
 
         if use_sp:
             self.sp_size = get_world_size()
@@ -115,6 +158,21 @@ class WanTI2V:
 
         self.sample_neg_prompt = config.sample_neg_prompt
 
+    def _apply_vram_budget(self, models):
+        r"""
+        Places the DiT `models` within `dit_vram_budget`, for all of them
+        together, see `BlockStreamer.from_budget`.
+        """
+        mode = BlockStreamer.from_budget(models, self.device,
+                                         int(self.dit_vram_budget * 1024**3))
+        self.block_streaming = mode == 'stream'
+        if mode == 'swap':
+            # kept on the host, swapped in one at a time
+            self.init_on_cpu = True
+        elif mode == 'resident' and not self.init_on_cpu:
+            for model in models:
+                model.to(self.device)
+
     def _configure_model(self, model, use_sp, dit_fsdp, shard_fn,
                          convert_model_dtype):
         """
@@ -154,9 +212,12 @@ class WanTI2V:
         else:
             if convert_model_dtype:
                 model.to(self.param_dtype)
-            if not self.init_on_cpu:
+            if self.dit_vram_budget is None and not self.init_on_cpu:
                 model.to(self.device)
 
+        if self.compiler is not None:
+            model = self.compiler.compile(model)
+
         return model
 
     def generate(self,
@@ -171,7 +232,17 @@ class WanTI2V:
                  guide_scale=5.0,
                  n_prompt="",
                  seed=-1,
-                 offload_model=False):  # WELL optimization: Changed to False
+                 offload_model=False,  # WELL optimization: Changed to False
+                 batch_cfg=False,
+                 step_cache_threshold=0.0,
+                 step_cache_warmup=1,
+                 video_writer=None,
+                 preview_callback=None,
+                 preview_steps=5,
+                 callback=None,
+                 cancel_token=None,
+                 snapshot_file=None,
+                 snapshot_steps=5):
         r"""
         Generates video frames from text prompt using diffusion process.
 
@@ -200,6 +271,40 @@ class WanTI2V:
                 Random seed for noise generation. If -1, use random seed.
             offload_model (`bool`, *optional*, defaults to False):
                 If True, offloads models to CPU during generation to save VRAM. False is faster on Windows
+            batch_cfg (`bool`, *optional*, defaults to False):
+                If True, runs the conditional and unconditional passes as one
+                batched forward. Falls back to sequential passes on OOM.
+            step_cache_threshold (`float`, *optional*, defaults to 0.0):
+                Accumulated relative change of the modulated DiT input below
+                which a step reuses the cached block residual instead of running
+                the transformer blocks. 0 disables the step cache.
+            step_cache_warmup (`int`, *optional*, defaults to 1):
+                Number of leading steps that always run the transformer blocks.
+            video_writer (`VideoWriter`, *optional*, defaults to None):
+                If given, decoded frames are streamed to this writer chunk by
+                chunk and None is returned instead of the video tensor.
+            preview_callback (`callable`, *optional*, defaults to None):
+                Called as `preview_callback(step, preview)` every
+                `preview_steps` steps and at the last step, with a cheap RGB
+                preview [3, T, H / stride, W / stride] in [-1, 1] of the current
+                denoised estimate. Only called on rank 0.
+            preview_steps (`int`, *optional*, defaults to 5):
+                Number of steps between two previews.
+            callback (`callable`, *optional*, defaults to None):
+                Called as `callback(step, t, latent)` after every sampling step,
+                with the updated latent [C, T, H, W].
+            cancel_token (`CancellationToken`, *optional*, defaults to None):
+                If cancelled, sampling stops before the next step, the models are
+                offloaded as after a finished run, nothing is decoded and None is
+                returned. In a distributed run every rank passes a token, and
+                cancelling any of them stops all ranks at the same step.
+            snapshot_file (`str`, *optional*, defaults to None):
+                If given, the sampling state is saved to this file every
+                `snapshot_steps` steps, and a run with the same
+                arguments and seed resumes from it. It is removed once the video
+                is decoded.
+            snapshot_steps (`int`, *optional*, defaults to 5):
+                Number of steps between two snapshots.
 
         Returns:
             torch.Tensor:
@@ -222,7 +327,17 @@ class WanTI2V:
                 guide_scale=guide_scale,
                 n_prompt=n_prompt,
                 seed=seed,
-                offload_model=offload_model)
+                offload_model=offload_model,
+                batch_cfg=batch_cfg,
+                step_cache_threshold=step_cache_threshold,
+                step_cache_warmup=step_cache_warmup,
+                video_writer=video_writer,
+                preview_callback=preview_callback,
+                preview_steps=preview_steps,
+                callback=callback,
+                cancel_token=cancel_token,
+                snapshot_file=snapshot_file,
+                snapshot_steps=snapshot_steps)
         # t2v
         return self.t2v(
             input_prompt=input_prompt,
@@ -234,7 +349,17 @@ class WanTI2V:
             guide_scale=guide_scale,
             n_prompt=n_prompt,
             seed=seed,
-            offload_model=offload_model)
+            offload_model=offload_model,
+            batch_cfg=batch_cfg,
+            step_cache_threshold=step_cache_threshold,
+            step_cache_warmup=step_cache_warmup,
+            video_writer=video_writer,
+            preview_callback=preview_callback,
+            preview_steps=preview_steps,
+            callback=callback,
+            cancel_token=cancel_token,
+            snapshot_file=snapshot_file,
+            snapshot_steps=snapshot_steps)
 
     def t2v(self,
             input_prompt,
@@ -246,7 +371,17 @@ class WanTI2V:
             guide_scale=5.0,
             n_prompt="",
             seed=-1,
-            offload_model=False):  # WELL optimization: Changed to False
+            offload_model=False,  # WELL optimization: Changed to False
+            batch_cfg=False,
+            step_cache_threshold=0.0,
+            step_cache_warmup=1,
+            video_writer=None,
+            preview_callback=None,
+            preview_steps=5,
+            callback=None,
+            cancel_token=None,
+            snapshot_file=None,
+            snapshot_steps=5):
         r"""
         Generates video frames from text prompt using diffusion process.
 
@@ -271,6 +406,40 @@ class WanTI2V:
                 Random seed for noise generation. If -1, use random seed.
             offload_model (`bool`, *optional*, defaults to False):
                 If True, offloads models to CPU during generation to save VRAM. False is faster on Windows
+            batch_cfg (`bool`, *optional*, defaults to False):
+                If True, runs the conditional and unconditional passes as one
+                batched forward. Falls back to sequential passes on OOM.
+            step_cache_threshold (`float`, *optional*, defaults to 0.0):
+                Accumulated relative change of the modulated DiT input below
+                which a step reuses the cached block residual instead of running
+                the transformer blocks. 0 disables the step cache.
+            step_cache_warmup (`int`, *optional*, defaults to 1):
+                Number of leading steps that always run the transformer blocks.
+            video_writer (`VideoWriter`, *optional*, defaults to None):
+                If given, decoded frames are streamed to this writer chunk by
+                chunk and None is returned instead of the video tensor.
+            preview_callback (`callable`, *optional*, defaults to None):
+                Called as `preview_callback(step, preview)` every
+                `preview_steps` steps and at the last step, with a cheap RGB
+                preview [3, T, H / stride, W / stride] in [-1, 1] of the current
+                denoised estimate. Only called on rank 0.
+            preview_steps (`int`, *optional*, defaults to 5):
+                Number of steps between two previews.
+            callback (`callable`, *optional*, defaults to None):
+                Called as `callback(step, t, latent)` after every sampling step,
+                with the updated latent [C, T, H, W].
+            cancel_token (`CancellationToken`, *optional*, defaults to None):
+                If cancelled, sampling stops before the next step, the models are
+                offloaded as after a finished run, nothing is decoded and None is
+                returned. In a distributed run every rank passes a token, and
+                cancelling any of them stops all ranks at the same step.
+            snapshot_file (`str`, *optional*, defaults to None):
+                If given, the sampling state is saved to this file every
+                `snapshot_steps` steps, and a run with the same
+                arguments and seed resumes from it. It is removed once the video
+                is decoded.
+            snapshot_steps (`int`, *optional*, defaults to 5):
+                Number of steps between two snapshots.
 
         Returns:
             torch.Tensor:
@@ -292,21 +461,20 @@ class WanTI2V:
 
         if n_prompt == "":
             n_prompt = self.sample_neg_prompt
+        if seed < 0 and snapshot_file is not None:
+            # resume an interrupted run that drew a random seed
+            seed = snapshot_seed(snapshot_file)
+            seed = seed if seed is not None else -1
         seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
         seed_g = torch.Generator(device=self.device)
         seed_g.manual_seed(seed)
 
-        if not self.t5_cpu:
-            self.text_encoder.model.to(self.device)
-            context = self.text_encoder([input_prompt], self.device)
-            context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
-                self.text_encoder.model.cpu()
-        else:
-            context = self.text_encoder([input_prompt], torch.device('cpu'))
-            context_null = self.text_encoder([n_prompt], torch.device('cpu'))
-            context = [t.to(self.device) for t in context]
-            context_null = [t.to(self.device) for t in context_null]
+        context, context_null = self.text_encoder.encode(
+            [input_prompt, n_prompt],
+            self.device,
+            offload_model=offload_model,
+            cpu=self.t5_cpu)
+        context, context_null = [context], [context_null]
 
         noise = [
             torch.randn(
@@ -355,36 +523,72 @@ class WanTI2V:
 
             # sample videos
             latents = noise
-            mask1, mask2 = masks_like(noise, zero=False)
-
-            arg_c = {'context': context, 'seq_len': seq_len}
-            arg_null = {'context': context_null, 'seq_len': seq_len}
+            start = 0
+            snapshot = None
+            if snapshot_file is not None:
+                snapshot = SamplingSnapshot(
+                    snapshot_file,
+                    snapshot_steps,
+                    key=job_key(type(self).__name__, input_prompt, n_prompt,
+                                seed, tuple(noise[0].shape), sample_solver,
+                                sampling_steps, shift, guide_scale, batch_cfg,
+                                step_cache_threshold, step_cache_warmup),
+                    save=self.rank == 0,
+                    seed=seed)
+                start, latents[0] = snapshot.restore(
+                    0, sample_scheduler, seed_g, latents[0])
+
+            step_cache = StepCache(
+                threshold=step_cache_threshold,
+                warmup_steps=step_cache_warmup,
+                num_steps=len(timesteps)) if step_cache_threshold > 0 else None
+            arg_c = {
+                'context': context,
+                'seq_len': seq_len,
+                'step_cache': step_cache,
+            }
+            arg_null = {
+                'context': context_null,
+                'seq_len': seq_len,
+                'step_cache': step_cache,
+            }
+            cfg_batcher = CFGBatcher(
+                arg_c, arg_null, enabled=batch_cfg, device=self.device)
 
-            if offload_model or self.init_on_cpu:
+            if not self.block_streaming and (offload_model or
+                                             self.init_on_cpu):
                 self.model.to(self.device)
                 torch.cuda.empty_cache()
 
-            for _, t in enumerate(tqdm(timesteps)):
+            preview = None
+            if preview_callback is not None and self.rank == 0:
+                preview = self.previewer.hook(preview_callback, preview_steps,
+                                              len(timesteps),
+                                              self.num_train_timesteps)
+            steps = timesteps[start:] if self.compiler is None else (
+                self.compiler.steps(timesteps[start:], tuple(noise[0].shape)))
+            steps = cancellable(steps, cancel_token)
+            for i, t in enumerate(
+                    tqdm(steps, initial=start, total=len(timesteps)), start):
+                if step_cache is not None:
+                    step_cache.begin_step(i)
                 latent_model_input = latents
                 timestep = [t]
 
+                # no frame is masked, so all tokens share the timestep
                 timestep = torch.stack(timestep)
 
-                temp_ts = (mask2[0][0][:, ::2, ::2] * timestep).flatten()
-                temp_ts = torch.cat([
-                    temp_ts,
-                    temp_ts.new_ones(seq_len - temp_ts.size(0)) * timestep
-                ])
-                timestep = temp_ts.unsqueeze(0)
-
-                noise_pred_cond = self.model(
-                    latent_model_input, t=timestep, **arg_c)[0]
-                noise_pred_uncond = self.model(
-                    latent_model_input, t=timestep, **arg_null)[0]
+                noise_pred_cond, noise_pred_uncond = cfg_batcher(
+                    self.model, latent_model_input, timestep)
+                noise_pred_cond = noise_pred_cond[0]
+                noise_pred_uncond = noise_pred_uncond[0]
 
                 noise_pred = noise_pred_uncond + guide_scale * (
                     noise_pred_cond - noise_pred_uncond)
 
+                if preview is not None:
+                    preview(i, t, latents[0], noise_pred)
+
                 temp_x0 = sample_scheduler.step(
                     noise_pred.unsqueeze(0),
                     t,
@@ -392,13 +596,34 @@ class WanTI2V:
                     return_dict=False,
                     generator=seed_g)[0]
                 latents = [temp_x0.squeeze(0)]
+                if callback is not None:
+                    callback(i, t, latents[0])
+                if snapshot is not None:
+                    snapshot.step(0, i, latents[0], sample_scheduler, seed_g)
+
+            if step_cache is not None:
+                logging.info(
+                    f"Step cache skipped {step_cache.skipped}/{step_cache.total} DiT forwards."
+                )
             x0 = latents
-            if offload_model:
+            if self.block_streaming:
+                self.model.block_streamer.release()
+            elif offload_model:
                 self.model.cpu()
                 torch.cuda.synchronize()
                 torch.cuda.empty_cache()
-            if self.rank == 0:
-                videos = self.vae.decode(x0)
+            if cancel_token is not None and cancel_token.cancelled:
+                logging.info("Generation cancelled.")
+                videos = [None]
+            elif self.rank == 0:
+                if video_writer is not None:
+                    for chunk in self.vae.decode_stream(x0[0]):
+                        video_writer.write(chunk)
+                    videos = [None]
+                else:
+                    videos = self.vae.decode(x0)
+                if snapshot is not None:
+                    snapshot.clear()
 
         del noise, latents
         del sample_scheduler
@@ -421,7 +646,17 @@ class WanTI2V:
             guide_scale=5.0,
             n_prompt="",
             seed=-1,
-            offload_model=False):  # WELL optimization: Changed to False
+            offload_model=False,  # WELL optimization: Changed to False
+            batch_cfg=False,
+            step_cache_threshold=0.0,
+            step_cache_warmup=1,
+            video_writer=None,
+            preview_callback=None,
+            preview_steps=5,
+            callback=None,
+            cancel_token=None,
+            snapshot_file=None,
+            snapshot_steps=5):
         r"""
         Generates video frames from input image and text prompt using diffusion process.
 
@@ -449,6 +684,40 @@ class WanTI2V:
                 Random seed for noise generation. If -1, use random seed
             offload_model (`bool`, *optional*, defaults to False):
                 If True, offloads models to CPU during generation to save VRAM. False is faster on Windows
+            batch_cfg (`bool`, *optional*, defaults to False):
+                If True, runs the conditional and unconditional passes as one
+                batched forward. Falls back to sequential passes on OOM.
+            step_cache_threshold (`float`, *optional*, defaults to 0.0):
+                Accumulated relative change of the modulated DiT input below
+                which a step reuses the cached block residual instead of running
+                the transformer blocks. 0 disables the step cache.
+            step_cache_warmup (`int`, *optional*, defaults to 1):
+                Number of leading steps that always run the transformer blocks.
+            video_writer (`VideoWriter`, *optional*, defaults to None):
+                If given, decoded frames are streamed to this writer chunk by
+                chunk and None is returned instead of the video tensor.
+            preview_callback (`callable`, *optional*, defaults to None):
+                Called as `preview_callback(step, preview)` every
+                `preview_steps` steps and at the last step, with a cheap RGB
+                preview [3, T, H / stride, W / stride] in [-1, 1] of the current
+                denoised estimate. Only called on rank 0.
+            preview_steps (`int`, *optional*, defaults to 5):
+                Number of steps between two previews.
+            callback (`callable`, *optional*, defaults to None):
+                Called as `callback(step, t, latent)` after every sampling step,
+                with the updated latent [C, T, H, W].
+            cancel_token (`CancellationToken`, *optional*, defaults to None):
+                If cancelled, sampling stops before the next step, the models are
+                offloaded as after a finished run, nothing is decoded and None is
+                returned. In a distributed run every rank passes a token, and
+                cancelling any of them stops all ranks at the same step.
+            snapshot_file (`str`, *optional*, defaults to None):
+                If given, the sampling state is saved to this file every
+                `snapshot_steps` steps, and a run with the same
+                arguments and seed resumes from it. It is removed once the video
+                is decoded.
+            snapshot_steps (`int`, *optional*, defaults to 5):
+                Number of steps between two snapshots.
 
         Returns:
             torch.Tensor:
@@ -482,6 +751,10 @@ class WanTI2V:
                 self.patch_size[1] * self.patch_size[2])
         seq_len = int(math.ceil(seq_len / self.sp_size)) * self.sp_size
 
+        if seed < 0 and snapshot_file is not None:
+            # resume an interrupted run that drew a random seed
+            seed = snapshot_seed(snapshot_file)
+            seed = seed if seed is not None else -1
         seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
         seed_g = torch.Generator(device=self.device)
         seed_g.manual_seed(seed)
@@ -497,17 +770,12 @@ class WanTI2V:
             n_prompt = self.sample_neg_prompt
 
         # preprocess
-        if not self.t5_cpu:
-            self.text_encoder.model.to(self.device)
-            context = self.text_encoder([input_prompt], self.device)
-            context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
-                self.text_encoder.model.cpu()
-        else:
-            context = self.text_encoder([input_prompt], torch.device('cpu'))
-            context_null = self.text_encoder([n_prompt], torch.device('cpu'))
-            context = [t.to(self.device) for t in context]
-            context_null = [t.to(self.device) for t in context_null]
+        context, context_null = self.text_encoder.encode(
+            [input_prompt, n_prompt],
+            self.device,
+            offload_model=offload_model,
+            cpu=self.t5_cpu)
+        context, context_null = [context], [context_null]
 
         z = self.vae.encode([img])
 
@@ -549,22 +817,60 @@ class WanTI2V:
             latent = noise
             mask1, mask2 = masks_like([noise], zero=True)
             latent = (1. - mask2[0]) * z[0] + mask2[0] * latent
-
+            start = 0
+            snapshot = None
+            if snapshot_file is not None:
+                snapshot = SamplingSnapshot(
+                    snapshot_file,
+                    snapshot_steps,
+                    key=job_key(type(self).__name__, img, input_prompt, n_prompt,
+                                seed, tuple(noise.shape), sample_solver,
+                                sampling_steps, shift, guide_scale, batch_cfg,
+                                step_cache_threshold, step_cache_warmup),
+                    save=self.rank == 0,
+                    seed=seed)
+                start, latent = snapshot.restore(0, sample_scheduler, seed_g,
+                                                 latent)
+
+            step_cache = StepCache(
+                threshold=step_cache_threshold,
+                warmup_steps=step_cache_warmup,
+                num_steps=len(timesteps)) if step_cache_threshold > 0 else None
             arg_c = {
                 'context': [context[0]],
                 'seq_len': seq_len,
+                'step_cache': step_cache,
             }
 
             arg_null = {
                 'context': context_null,
                 'seq_len': seq_len,
+                'step_cache': step_cache,
             }
+            cfg_batcher = CFGBatcher(
+                arg_c,
+                arg_null,
+                enabled=batch_cfg,
+                device=self.device,
+                empty_cache=offload_model)
 
-            if offload_model or self.init_on_cpu:
+            if not self.block_streaming and (offload_model or
+                                             self.init_on_cpu):
                 self.model.to(self.device)
                 torch.cuda.empty_cache()
 
-            for _, t in enumerate(tqdm(timesteps)):
+            preview = None
+            if preview_callback is not None and self.rank == 0:
+                preview = self.previewer.hook(preview_callback, preview_steps,
+                                              len(timesteps),
+                                              self.num_train_timesteps)
+            steps = timesteps[start:] if self.compiler is None else (
+                self.compiler.steps(timesteps[start:], tuple(noise.shape)))
+            steps = cancellable(steps, cancel_token)
+            for i, t in enumerate(
+                    tqdm(steps, initial=start, total=len(timesteps)), start):
+                if step_cache is not None:
+                    step_cache.begin_step(i)
                 latent_model_input = [latent.to(self.device)]
                 timestep = [t]
 
@@ -577,17 +883,16 @@ class WanTI2V:
                 ])
                 timestep = temp_ts.unsqueeze(0)
 
-                noise_pred_cond = self.model(
-                    latent_model_input, t=timestep, **arg_c)[0]
-                if offload_model:
-                    torch.cuda.empty_cache()
-                noise_pred_uncond = self.model(
-                    latent_model_input, t=timestep, **arg_null)[0]
-                if offload_model:
-                    torch.cuda.empty_cache()
+                noise_pred_cond, noise_pred_uncond = cfg_batcher(
+                    self.model, latent_model_input, timestep)
+                noise_pred_cond = noise_pred_cond[0]
+                noise_pred_uncond = noise_pred_uncond[0]
                 noise_pred = noise_pred_uncond + guide_scale * (
                     noise_pred_cond - noise_pred_uncond)
 
+                if preview is not None:
+                    preview(i, t, latent, noise_pred)
+
                 temp_x0 = sample_scheduler.step(
                     noise_pred.unsqueeze(0),
                     t,
@@ -596,17 +901,37 @@ class WanTI2V:
                     generator=seed_g)[0]
                 latent = temp_x0.squeeze(0)
                 latent = (1. - mask2[0]) * z[0] + mask2[0] * latent
+                if callback is not None:
+                    callback(i, t, latent)
+                if snapshot is not None:
+                    snapshot.step(0, i, latent, sample_scheduler, seed_g)
 
-                x0 = [latent]
                 del latent_model_input, timestep
 
-            if offload_model:
+            x0 = [latent]
+            if step_cache is not None:
+                logging.info(
+                    f"Step cache skipped {step_cache.skipped}/{step_cache.total} DiT forwards."
+                )
+            if self.block_streaming:
+                self.model.block_streamer.release()
+            elif offload_model:
                 self.model.cpu()
                 torch.cuda.synchronize()
                 torch.cuda.empty_cache()
 
-            if self.rank == 0:
-                videos = self.vae.decode(x0)
+            if cancel_token is not None and cancel_token.cancelled:
+                logging.info("Generation cancelled.")
+                videos = [None]
+            elif self.rank == 0:
+                if video_writer is not None:
+                    for chunk in self.vae.decode_stream(x0[0]):
+                        video_writer.write(chunk)
+                    videos = [None]
+                else:
+                    videos = self.vae.decode(x0)
+                if snapshot is not None:
+                    snapshot.clear()
 
         del noise, latent, x0
         del sample_scheduler
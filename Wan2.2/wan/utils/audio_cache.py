@@ -0,0 +1,115 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import hashlib
+import logging
+import os
+import threading
+
+import torch
+
+__all__ = ['AudioFeatureCache']
+
+
+def _file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AudioFeatureCache:
+    r"""
+    On-disk cache of audio encoder features.
+
+    Entries are keyed by the content of the audio file and the settings of
+    the encoder, so renamed or copied tracks still hit. They are loaded
+    memory-mapped, so a hit costs neither decoding the audio nor reading the
+    features into memory up front. The least recently used files are evicted
+    once the total size exceeds `max_disk_bytes`.
+    """
+
+    def __init__(self, cache_dir, max_disk_bytes=8 * 1024**3):
+        r"""
+        Args:
+            cache_dir (`str`):
+                Directory of the cache files.
+            max_disk_bytes (`int`, *optional*, defaults to 8 GiB):
+                Size budget of the cache directory.
+        """
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(audio_path, *parts):
+        r"""
+        Hashes the content of `audio_path` and `parts` (strings and numbers)
+        into a cache key.
+        """
+        digest = hashlib.sha256(_file_digest(audio_path).encode('utf-8'))
+        for p in parts:
+            digest.update(b'\0' + str(p).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pt')
+
+    def get(self, key):
+        r"""
+        Returns the memory-mapped features stored under `key`, or None.
+        """
+        path = self._path(key)
+        with self._lock:
+            if not os.path.exists(path):
+                return None
+            try:
+                tensor = torch.load(
+                    path, map_location='cpu', mmap=True, weights_only=True)
+                os.utime(path)
+            except Exception as e:
+                logging.warning(f'Dropping unreadable cache entry {key}: {e}')
+                self._remove(path)
+                return None
+        return tensor
+
+    def put(self, key, tensor):
+        r"""
+        Stores `tensor` under `key`.
+        """
+        tensor = tensor.detach().to('cpu').contiguous()
+        with self._lock:
+            tmp = self._path(key) + '.tmp'
+            try:
+                torch.save(tensor, tmp)
+                os.replace(tmp, self._path(key))
+            except Exception as e:
+                logging.warning(f'Failed to write cache entry {key}: {e}')
+                self._remove(tmp)
+                return
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pt'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(u[1] for u in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,72 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import threading
+
+import torch
+import torch.distributed as dist
+
+__all__ = ['CancellationToken', 'cancellable']
+
+
+class CancellationToken:
+    r"""
+    Thread-safe flag to abort a running `generate()` from another thread.
+
+    The sampling loop checks the token before every step. Once it is
+    cancelled, the loop stops, the models go back to where they are kept
+    between jobs, decoding is skipped and `generate()` returns None, so the
+    pipeline can take the next job without reloading anything.
+
+    In a distributed run, every rank passes a token and the ranks agree on
+    the cancellation before every step, so cancelling the token of any rank
+    stops all of them at the same step instead of leaving the others waiting
+    in a collective. After the first agreement, `cancelled` reports the
+    agreed state, which is the same on every rank.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._synced = False
+        self._agreed = False
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def requested(self):
+        r"""
+        Whether `cancel()` was called on this rank.
+        """
+        return self._event.is_set()
+
+    @property
+    def cancelled(self):
+        if self._synced:
+            return self._agreed
+        return self._event.is_set()
+
+    def sync(self):
+        r"""
+        Agrees on the cancellation across the default process group and
+        returns it. Every rank has to call it at the same point. Without a
+        distributed run, returns the local state.
+        """
+        if not dist.is_initialized() or dist.get_world_size() == 1:
+            return self.cancelled
+        device = torch.device(
+            'cuda', torch.cuda.current_device()
+        ) if dist.get_backend() == 'nccl' else torch.device('cpu')
+        flag = torch.tensor([int(self._event.is_set())], device=device)
+        dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+        self._synced = True
+        self._agreed = self._agreed or bool(flag.item())
+        return self._agreed
+
+
+def cancellable(steps, token=None):
+    r"""
+    Iterates over `steps` until `token` is cancelled, on any rank.
+    """
+    for step in steps:
+        if token is not None and token.sync():
+            return
+        yield step
@@ -0,0 +1,131 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import logging
+
+import torch
+
+from .device import empty_cache_if_needed, is_oom
+
+__all__ = ['CFGBatcher', 'merge_cfg_args']
+
+
+def merge_cfg_args(arg_c, arg_null):
+    r"""
+    Stacks the conditional and unconditional model arguments along the batch
+    dimension so that both guidance branches run in a single forward.
+
+    Tensors are concatenated along dim 0, lists of tensors are concatenated,
+    and every other value (sequence length, flags, frame counts) must be the
+    same for both branches and is passed through unchanged.
+
+    Args:
+        arg_c (`dict`):
+            Keyword arguments of the conditional forward.
+        arg_null (`dict`):
+            Keyword arguments of the unconditional forward.
+
+    Returns:
+        `dict`: Keyword arguments of the batched forward.
+    """
+    assert arg_c.keys() == arg_null.keys()
+    merged = {}
+    for key, cond in arg_c.items():
+        uncond = arg_null[key]
+        if isinstance(cond, torch.Tensor):
+            merged[key] = torch.cat([cond, uncond])
+        elif isinstance(cond, (list, tuple)) and len(cond) > 0 and isinstance(
+                cond[0], torch.Tensor):
+            merged[key] = list(cond) + list(uncond)
+        else:
+            assert cond == uncond, f"`{key}` differs between CFG branches."
+            merged[key] = cond
+    return merged
+
+
+class CFGBatcher:
+    r"""
+    Runs the conditional and unconditional passes of classifier-free guidance.
+
+    With `enabled=True` both branches are stacked into one batch-2 forward so
+    the weights are read once per step. If that forward runs out of memory the
+    batcher logs a warning and falls back to two sequential batch-1 forwards
+    for the rest of the generation.
+    """
+
+    def __init__(self,
+                 arg_c,
+                 arg_null,
+                 enabled=True,
+                 device=None,
+                 empty_cache=False,
+                 prepare=None):
+        r"""
+        Args:
+            arg_c (`dict`):
+                Keyword arguments of the conditional forward.
+            arg_null (`dict`):
+                Keyword arguments of the unconditional forward.
+            enabled (`bool`, *optional*, defaults to True):
+                Whether to fuse both branches into one batched forward.
+            device (`torch.device`, *optional*, defaults to None):
+                Device used to release cached memory after a fallback.
+            empty_cache (`bool`, *optional*, defaults to False):
+                Release cached device memory after each sequential forward.
+            prepare (`Callable`, *optional*, defaults to None):
+                Maps keyword arguments to the ones passed to the model, e.g.
+                to compute step-invariant conditioning once. Applied to the
+                batched arguments up front and to the per-branch arguments
+                when they are first used.
+        """
+        self.arg_c = arg_c
+        self.arg_null = arg_null
+        self.enabled = enabled
+        self.device = device
+        self.empty_cache = empty_cache
+        self.prepare = prepare
+        self._prepared = prepare is None
+        self.arg_cfg = self._prepare(merge_cfg_args(
+            arg_c, arg_null)) if enabled else None
+
+    def _prepare(self, kwargs):
+        return kwargs if self.prepare is None else self.prepare(kwargs)
+
+    def __call__(self, model, x, t):
+        r"""
+        Args:
+            model (`torch.nn.Module`):
+                The diffusion model of the current step.
+            x (List[Tensor]):
+                Noisy latents of the conditional branch.
+            t (Tensor):
+                Timesteps of the conditional branch, shape [B] or [B, L].
+
+        Returns:
+            Tuple[List[Tensor], List[Tensor]]:
+                The conditional and unconditional predictions.
+        """
+        if self.enabled:
+            try:
+                out = model(x + x, t=torch.cat([t, t]), **self.arg_cfg)
+                return out[:len(x)], out[len(x):]
+            except RuntimeError as e:
+                if not is_oom(e):
+                    raise
+                logging.warning(
+                    'Batched CFG ran out of memory, falling back to '
+                    'sequential cond/uncond forwards.')
+                self.enabled = False
+                self.arg_cfg = None
+                if self.device is not None:
+                    empty_cache_if_needed(self.device)
+
+        if not self._prepared:
+            self.arg_c = self._prepare(self.arg_c)
+            self.arg_null = self._prepare(self.arg_null)
+            self._prepared = True
+        noise_pred_cond = model(x, t=t, **self.arg_c)
+        if self.empty_cache and self.device is not None:
+            empty_cache_if_needed(self.device)
+        noise_pred_uncond = model(x, t=t, **self.arg_null)
+        if self.empty_cache and self.device is not None:
+            empty_cache_if_needed(self.device)
+        return noise_pred_cond, noise_pred_uncond
@@ -0,0 +1,140 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import argparse
+import logging
+import os
+
+import torch
+import torch.nn as nn
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+__all__ = ['resolve_checkpoint', 'load_checkpoint', 'convert_to_safetensors']
+
+
+def resolve_checkpoint(path):
+    r"""
+    Returns the safetensors sibling of a `.pth` checkpoint if it was
+    converted, `path` otherwise.
+    """
+    root, ext = os.path.splitext(path)
+    if ext in ('.pth', '.pt') and os.path.exists(root + '.safetensors'):
+        return root + '.safetensors'
+    return path
+
+
+def _torch_load(path):
+    try:
+        return torch.load(
+            path, map_location='cpu', mmap=True, weights_only=True)
+    except RuntimeError:
+        # legacy (non-zip) pickles cannot be mapped
+        return torch.load(path, map_location='cpu', weights_only=True)
+
+
+def _iter_tensors(path):
+    if path.endswith('.safetensors'):
+        with safe_open(path, framework='pt', device='cpu') as f:
+            for key in f.keys():
+                # read one tensor at a time from the mapped file
+                yield key, f.get_tensor(key)
+    else:
+        state_dict = _torch_load(path)
+        yield from state_dict.items()
+
+
+def _assign(model, name, tensor):
+    module_name, _, attr = name.rpartition('.')
+    module = model.get_submodule(module_name)
+    if attr in module._parameters:
+        module._parameters[attr] = nn.Parameter(
+            tensor, requires_grad=module._parameters[attr].requires_grad)
+    elif attr in module._buffers:
+        module._buffers[attr] = tensor
+    else:
+        return False
+    return True
+
+
+def load_checkpoint(model, path, device='cpu', dtype=None):
+    r"""
+    Loads a checkpoint into `model` tensor by tensor.
+
+    The model is expected to be created on the meta device. Each tensor is
+    read from the memory-mapped checkpoint, moved to `device` and assigned to
+    the model before the next one is read, so the host never holds more than
+    one tensor of a safetensors checkpoint. `.pth` checkpoints are mapped
+    with `torch.load(mmap=True)`; converting them with
+    `convert_to_safetensors` also removes the pickle.
+
+    Args:
+        model (`torch.nn.Module`):
+            Model to load into, usually on the meta device.
+        path (`str`):
+            Path of a `.safetensors` or `.pth` checkpoint. A converted
+            `.safetensors` sibling of a `.pth` path is preferred.
+        device (`torch.device`, *optional*, defaults to 'cpu'):
+            Device the weights are placed on.
+        dtype (`torch.dtype`, *optional*, defaults to None):
+            Floating point dtype of the weights. If None, the checkpoint dtype
+            is kept.
+
+    Returns:
+        `torch.nn.Module`: `model`.
+    """
+    path = resolve_checkpoint(path)
+    logging.info(f'loading {path}')
+    expected = set(model.state_dict().keys())
+    unexpected = []
+    for name, tensor in _iter_tensors(path):
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        if name not in expected or not _assign(model, name, tensor.to(device)):
+            unexpected.append(name)
+            continue
+        expected.discard(name)
+    if expected or unexpected:
+        raise RuntimeError(
+            f"Error loading {path}: missing keys {sorted(expected)}, "
+            f"unexpected keys {sorted(unexpected)}")
+    return model
+
+
+def convert_to_safetensors(path, output=None):
+    r"""
+    Converts a `.pth` state dict into a `.safetensors` file next to it.
+
+    Returns:
+        `str`: Path of the converted checkpoint.
+    """
+    output = output or os.path.splitext(path)[0] + '.safetensors'
+    state_dict = _torch_load(path)
+    seen = set()
+    tensors = {}
+    for key, tensor in state_dict.items():
+        # safetensors refuses tensors that share storage
+        ptr = tensor.untyped_storage().data_ptr()
+        tensors[key] = tensor.clone() if ptr in seen else tensor.contiguous()
+        seen.add(ptr)
+    save_file(tensors, output)
+    logging.info(f'converted {path} to {output}')
+    return output
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Convert the .pth checkpoints of a model directory to "
+        "safetensors so that they can be memory-mapped.")
+    parser.add_argument(
+        'paths',
+        nargs='+',
+        help="Checkpoint files or directories searched for .pth files.")
+    args = parser.parse_args()
+    for path in args.paths:
+        files = [path] if os.path.isfile(path) else [
+            os.path.join(path, name)
+            for name in sorted(os.listdir(path))
+            if name.endswith('.pth')
+        ]
+        for file in files:
+            convert_to_safetensors(file)
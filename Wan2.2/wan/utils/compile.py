@@ -0,0 +1,170 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import hashlib
+import logging
+import os
+import statistics
+import time
+
+import torch
+
+from .device import synchronize_if_needed
+
+__all__ = ['BlockCompiler', 'COMPILE_MODES']
+
+COMPILE_MODES = ('default', 'reduce-overhead', 'max-autotune',
+                 'max-autotune-no-cudagraphs')
+
+# modes that capture CUDA graphs
+_CUDAGRAPH_MODES = ('reduce-overhead', 'max-autotune')
+
+
+class BlockCompiler:
+    r"""
+    Regional `torch.compile` of the transformer blocks of the DiT.
+
+    Every block is compiled on its own with static shapes. The blocks of a
+    model share one compiled graph per resolution bucket, and the rest of the
+    forward (embeddings, sequence parallel communication, head) stays eager.
+    Compiled artifacts are stored under `cache_dir`, keyed by the model
+    config, latent shape and dtype, so a later process loads a bucket it has
+    already compiled. On CPU, inductor emits C++ kernels and a C++ wrapper.
+
+    `steps` wraps the sampling loop and logs the compile overhead against the
+    steady-state step time, to judge the break-even of short jobs.
+    """
+
+    def __init__(self, mode='default', cache_dir=None, device=None,
+                 max_buckets=16):
+        r"""
+        Args:
+            mode (`str`, *optional*, defaults to 'default'):
+                `torch.compile` mode, one of `COMPILE_MODES`.
+            cache_dir (`str`, *optional*, defaults to None):
+                Directory of the compiled artifacts. If None, only inductor's
+                default cache is used.
+            device (`torch.device`, *optional*, defaults to None):
+                Device the model runs on.
+            max_buckets (`int`, *optional*, defaults to 16):
+                Number of shapes each block may be compiled for before it
+                falls back to eager.
+        """
+        import torch._dynamo
+        import torch._inductor.config
+
+        assert mode in COMPILE_MODES, f"Unsupported compile mode {mode}."
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.device = torch.device(device) if device is not None else None
+        self.max_buckets = max_buckets
+        self._models = []
+        self._loaded = set()
+        self._saved = set()
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR',
+                                  os.path.join(cache_dir, 'inductor'))
+            torch._inductor.config.fx_graph_cache = True
+        if self.device is not None and self.device.type == 'cpu':
+            torch._inductor.config.cpp_wrapper = True
+        # blocks are traced with their parameters as inputs, so the blocks
+        # of both A14B experts reuse the graph of a bucket
+        if hasattr(torch._dynamo.config, 'inline_inbuilt_nn_modules'):
+            torch._dynamo.config.inline_inbuilt_nn_modules = True
+
+    def compile(self, model):
+        r"""
+        Compiles the blocks of `model` in place.
+
+        Returns:
+            `torch.nn.Module`: `model`.
+        """
+        import torch._dynamo
+
+        for block in model.blocks:
+            block.compile(mode=self.mode, dynamic=False)
+        self._models.append(model)
+        num_blocks = sum(len(m.blocks) for m in self._models)
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit,
+            num_blocks * self.max_buckets)
+        return model
+
+    def _key(self, shape):
+        parts = [torch.__version__, self.mode, tuple(shape)]
+        for model in self._models:
+            parts.append(type(model).__name__)
+            parts.append(sorted(dict(getattr(model, 'config', {})).items()))
+            parts.append(next(model.parameters()).dtype)
+        return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.bin')
+
+    def _load(self, key):
+        if (self.cache_dir is None or key in self._loaded or
+                not hasattr(torch.compiler, 'load_cache_artifacts')):
+            return
+        self._loaded.add(key)
+        if not os.path.exists(self._path(key)):
+            return
+        try:
+            with open(self._path(key), 'rb') as f:
+                torch.compiler.load_cache_artifacts(f.read())
+            self._saved.add(key)
+            logging.info(f'Loaded compiled artifacts {key[:16]}.')
+        except Exception as e:
+            logging.warning(f'Ignoring unreadable compiled artifacts: {e}')
+
+    def _save(self, key):
+        if (self.cache_dir is None or key in self._saved or
+                not hasattr(torch.compiler, 'save_cache_artifacts')):
+            return
+        self._saved.add(key)
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is None:
+            return
+        tmp = self._path(key) + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(artifacts[0])
+            os.replace(tmp, self._path(key))
+        except OSError as e:
+            logging.warning(f'Failed to write compiled artifacts: {e}')
+
+    def steps(self, timesteps, shape):
+        r"""
+        Iterates over `timesteps`, timing every step of the loop.
+
+        Args:
+            timesteps (Iterable):
+                Timesteps of the sampling loop.
+            shape (`tuple`):
+                Latent shape, the resolution bucket of the compiled graphs.
+        """
+        key = self._key(shape)
+        self._load(key)
+        times = []
+        for t in timesteps:
+            if self.mode in _CUDAGRAPH_MODES:
+                torch.compiler.cudagraph_mark_step_begin()
+            start = time.perf_counter()
+            yield t
+            if self.device is not None:
+                synchronize_if_needed(self.device)
+            times.append(time.perf_counter() - start)
+        self._save(key)
+        self._report(times)
+
+    def _report(self, times):
+        if len(times) < 2:
+            return
+        # steps well above the steady state include compilation, e.g. the
+        # first step and the first step of the second A14B expert
+        steady = statistics.median(times[1:])
+        overhead = sum(max(0., u - steady) for u in times)
+        logging.info(
+            f"Compiled {len(times)} steps: {overhead:.1f}s compile overhead, "
+            f"{steady:.2f}s/step steady state. Compiling pays off for jobs "
+            f"longer than {overhead:.1f}s / (eager s/step - {steady:.2f}s) "
+            f"steps.")
@@ -62,3 +62,9 @@ def synchronize_if_needed(device: torch.device) -> None:
         torch.cuda.synchronize()
 
 
+
+
+def is_oom(e: BaseException) -> bool:
+    """Whether `e` reports that the device ran out of memory."""
+    return isinstance(e, torch.cuda.OutOfMemoryError) or (
+        "out of memory" in str(e).lower())
@@ -0,0 +1,393 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import logging
+
+import torch
+
+from .device import is_oom
+
+__all__ = ['BlockStreamer', 'ExpertSwapper', 'HostCopier']
+
+
+def _pin(tensor):
+    if tensor.is_pinned():
+        return tensor
+    try:
+        return tensor.pin_memory()
+    except RuntimeError:
+        # pinned memory is limited, fall back to pageable copies
+        return tensor
+
+
+class ExpertSwapper:
+    r"""
+    Swaps the MoE experts between host and device memory.
+
+    Every expert keeps a host copy of its weights, so evicting an expert only
+    drops its device tensors, one tensor at a time, without a device-to-host
+    copy. On CUDA the next expert can be prefetched on a side stream while
+    the current expert is still sampling. The prefetch copies the expert
+    tensor by tensor, in module order, and stops at its budget: the free
+    device memory minus what the sampling steps of the active expert need on
+    top of its weights. That headroom is the peak allocated since the expert
+    was activated, with a margin, and at least `reserve_fraction` of the
+    device memory. Whatever did not fit is copied when the expert is
+    activated, after the previous expert has been evicted.
+
+    Only the tensors that the prefetch copies are pinned, the first time
+    they are prefetched, so the pinned host memory is bounded by the
+    prefetch budget rather than by the size of all experts.
+    """
+
+    def __init__(self,
+                 device,
+                 max_prefetch_bytes=None,
+                 reserve_bytes=None,
+                 reserve_fraction=0.25,
+                 pin_memory=True):
+        r"""
+        Args:
+            device (`torch.device`):
+                Device the active expert runs on.
+            max_prefetch_bytes (`int`, *optional*, defaults to None):
+                Upper bound of the weights prefetched ahead of a swap. If None,
+                only the free device memory limits the prefetch.
+            reserve_bytes (`int`, *optional*, defaults to None):
+                Free device memory that the prefetch leaves untouched. If None,
+                the measured peak of the sampling steps with a margin, and at
+                least `reserve_fraction` of the device memory.
+            reserve_fraction (`float`, *optional*, defaults to 0.25):
+                Lower bound of the measured reserve, as a fraction of the
+                device memory.
+            pin_memory (`bool`, *optional*, defaults to True):
+                Pin the prefetched host weights, so that their copies overlap
+                with compute. Without pinning the prefetch copies are not
+                asynchronous.
+        """
+        self.device = device
+        self.max_prefetch_bytes = max_prefetch_bytes
+        self.reserve_bytes = reserve_bytes
+        self.reserve_fraction = reserve_fraction
+        self.pin_memory = pin_memory
+        self._stream = torch.cuda.Stream(
+            device) if device.type == 'cuda' else None
+        self._host = {}
+        self._pending = {}
+        self._active = None
+
+    @staticmethod
+    def _tensors(model):
+        return list(model.parameters()) + list(model.buffers())
+
+    def _host_copies(self, model):
+        key = id(model)
+        if key not in self._host:
+            self._host[key] = [
+                p.data if p.device.type == 'cpu' else p.data.cpu()
+                for p in self._tensors(model)
+            ]
+        return self._host[key]
+
+    def _reserve(self):
+        if self.reserve_bytes is not None:
+            return self.reserve_bytes
+        total = torch.cuda.get_device_properties(self.device).total_memory
+        # activations of a step, over the weights and latents resident now
+        peak = torch.cuda.max_memory_allocated(
+            self.device) - torch.cuda.memory_allocated(self.device)
+        return max(int(peak * 1.25), int(total * self.reserve_fraction))
+
+    def _prefetch_budget(self):
+        free, _ = torch.cuda.mem_get_info(self.device)
+        budget = free - self._reserve()
+        if self.max_prefetch_bytes is not None:
+            budget = min(budget, self.max_prefetch_bytes)
+        return budget
+
+    def prefetch(self, model):
+        r"""
+        Starts copying `model` onto the device without blocking the current
+        stream. Does nothing on devices without CUDA streams.
+        """
+        if (self._stream is None or id(model) in self._pending or
+                id(model) == self._active):
+            return
+        host = self._host_copies(model)
+        budget = self._prefetch_budget()
+        copied = 0
+        with torch.cuda.stream(self._stream):
+            for i, (p, h) in enumerate(zip(self._tensors(model), host)):
+                if p.device.type != 'cpu':
+                    continue
+                nbytes = h.numel() * h.element_size()
+                if copied + nbytes > budget:
+                    break
+                if self.pin_memory:
+                    # kept pinned for the next swaps, the pageable copy goes
+                    h = host[i] = _pin(h)
+                try:
+                    p.data = h.to(self.device, non_blocking=True)
+                except RuntimeError as e:
+                    if not is_oom(e):
+                        raise
+                    break
+                copied += nbytes
+        if copied == 0:
+            return
+        event = torch.cuda.Event()
+        event.record(self._stream)
+        self._pending[id(model)] = event
+        logging.info(
+            f"Prefetching {type(model).__name__} ({copied / 1024**3:.1f} GiB).")
+
+    def evict(self, model):
+        r"""
+        Releases the device memory of `model`, restoring its host weights.
+        """
+        if self.device.type == 'cpu':
+            return
+        host = self._host_copies(model)
+        self._pending.pop(id(model), None)
+        for p, h in zip(self._tensors(model), host):
+            if p.device.type != 'cpu':
+                p.data = h
+        if self._active == id(model):
+            self._active = None
+
+    def activate(self, model, evict=None):
+        r"""
+        Makes `model` resident on the device.
+
+        Args:
+            model (`torch.nn.Module`):
+                The expert required by the current step.
+            evict (`torch.nn.Module`, *optional*, defaults to None):
+                The expert to release before `model` is completed.
+
+        Returns:
+            `torch.nn.Module`: `model`, with all weights on the device.
+        """
+        if self._active == id(model) or self.device.type == 'cpu':
+            return model
+        if evict is not None:
+            self.evict(evict)
+        host = self._host_copies(model)
+        event = self._pending.pop(id(model), None)
+        stream = torch.cuda.current_stream(
+            self.device) if self._stream is not None else None
+        if event is not None:
+            stream.wait_event(event)
+        for p, h in zip(self._tensors(model), host):
+            if p.device.type == 'cpu':
+                p.data = h.to(self.device, non_blocking=True)
+            elif event is not None:
+                # allocated on the side stream, now consumed by this one
+                p.data.record_stream(stream)
+        self._active = id(model)
+        if self._stream is not None:
+            # the prefetch budget measures the steps from here
+            torch.cuda.reset_peak_memory_stats(self.device)
+        return model
+
+
+def _nbytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class BlockStreamer:
+    r"""
+    Runs the transformer blocks of a model from host memory.
+
+    The blocks stay in pinned host memory and only a window of
+    `resident_blocks` blocks is on the device at a time. When a block starts,
+    the copies of the following blocks of the window are issued on a side
+    stream, so the transfer of block k + 1 overlaps with the compute of block
+    k. A block is released right after its forward. The window wraps around,
+    so the first blocks of the next forward load while the head runs. All
+    other modules of the model, and the parameters held by the blocks
+    themselves, such as their modulation tables, stay on the device.
+
+    Forward hooks drive the streaming, so the forward of the model is not
+    modified. The streamer is stored as `model.block_streamer`.
+    """
+
+    def __init__(self, model, device, resident_blocks=2):
+        r"""
+        Args:
+            model (`torch.nn.Module`):
+                Model with a `blocks` ModuleList.
+            device (`torch.device`):
+                Device the model runs on.
+            resident_blocks (`int`, *optional*, defaults to 2):
+                Number of blocks on the device at the same time.
+        """
+        self.device = device
+        self.blocks = list(model.blocks)
+        self.resident_blocks = max(1, min(resident_blocks, len(self.blocks)))
+        self._stream = torch.cuda.Stream(
+            device) if device.type == 'cuda' else None
+        self._events = {}
+        self._hosts = []
+
+        for name, child in model.named_children():
+            if name != 'blocks':
+                child.to(device)
+        for module in [model] + self.blocks:
+            for p in module.parameters(recurse=False):
+                p.data = p.data.to(device)
+            for b in module.buffers(recurse=False):
+                b.data = b.data.to(device)
+        for block in self.blocks:
+            hosts = []
+            for p in self._streamed(block):
+                host = p.data.cpu()
+                if self._stream is not None:
+                    host = _pin(host)
+                p.data = host
+                hosts.append(host)
+            self._hosts.append(hosts)
+        self._handles = []
+        for k, block in enumerate(self.blocks):
+            self._handles.append(
+                block.register_forward_pre_hook(self._pre_hook(k)))
+            self._handles.append(block.register_forward_hook(self._post_hook(k)))
+        model.block_streamer = self
+
+    @classmethod
+    def from_budget(cls, models, device, budget_bytes):
+        r"""
+        Fits the weights of `models`, which run one at a time like the MoE
+        experts, in `budget_bytes` of device memory, all models together.
+
+        Nothing is moved if all models fit at once, so that they are placed
+        as without a budget. If only each model alone fits, they have to stay
+        on the host and be swapped in one at a time. Otherwise the blocks of
+        every model are streamed: the other modules of all models stay on the
+        device and the remaining budget sets the number of resident blocks.
+
+        Returns:
+            `str`: 'resident', 'swap' or 'stream'. Streamed models get their
+            `BlockStreamer` as `model.block_streamer`.
+        """
+        sizes = [_nbytes(cls._tensors(m)) for m in models]
+        if sum(sizes) <= budget_bytes:
+            return 'resident'
+        if max(sizes) <= budget_bytes:
+            logging.info(
+                f"The DiT models fit a budget of {budget_bytes / 1024**3:.1f} "
+                f"GiB one at a time, swapping them from host memory.")
+            return 'swap'
+        block_bytes = max(
+            _nbytes(cls._streamed(b)) for m in models for b in m.blocks)
+        other_bytes = sum(sizes) - sum(
+            _nbytes(cls._streamed(b)) for m in models for b in m.blocks)
+        resident = int((budget_bytes - other_bytes) // block_bytes)
+        if resident < 2:
+            logging.warning(
+                f"A budget of {budget_bytes / 1024**3:.1f} GiB leaves room for "
+                f"{max(resident, 0)} blocks, streaming 2 blocks anyway.")
+            resident = 2
+        for model in models:
+            logging.info(
+                f"Streaming {type(model).__name__} blocks, {resident} of "
+                f"{len(model.blocks)} resident on {device}.")
+            cls(model, device, resident_blocks=resident)
+        return 'stream'
+
+    @staticmethod
+    def _tensors(module):
+        return list(module.parameters()) + list(module.buffers())
+
+    @classmethod
+    def _streamed(cls, block):
+        return [t for child in block.children() for t in cls._tensors(child)]
+
+    def _issue(self, k):
+        if k in self._events:
+            return
+        tensors = self._streamed(self.blocks[k])
+        if self._stream is None:
+            for p, h in zip(tensors, self._hosts[k]):
+                p.data = h.to(self.device)
+            self._events[k] = None
+            return
+        with torch.cuda.stream(self._stream):
+            for p, h in zip(tensors, self._hosts[k]):
+                p.data = h.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        self._events[k] = event
+
+    def _release(self, k):
+        self._events.pop(k, None)
+        for p, h in zip(self._streamed(self.blocks[k]), self._hosts[k]):
+            p.data = h
+
+    def _pre_hook(self, k):
+
+        def hook(module, args):
+            for j in range(self.resident_blocks):
+                self._issue((k + j) % len(self.blocks))
+            event = self._events[k]
+            if event is not None:
+                stream = torch.cuda.current_stream(self.device)
+                stream.wait_event(event)
+                for p in self._streamed(module):
+                    # allocated on the side stream, now consumed by this one
+                    p.data.record_stream(stream)
+
+        return hook
+
+    def _post_hook(self, k):
+
+        def hook(module, args, output):
+            self._release(k)
+
+        return hook
+
+    def release(self):
+        r"""
+        Releases every block that is on the device or in flight.
+        """
+        for k in list(self._events):
+            self._release(k)
+
+
+class HostCopier:
+    r"""
+    Copies device tensors to pinned host memory without blocking the host.
+
+    The copies run on a side stream after the work already queued on the
+    current stream, so the caller can keep queueing device work. The host
+    tensors are valid after `synchronize`.
+    """
+
+    def __init__(self, device):
+        r"""
+        Args:
+            device (`torch.device`):
+                Device the copied tensors live on.
+        """
+        self.device = device
+        self._stream = torch.cuda.Stream(
+            device) if device.type == 'cuda' else None
+
+    def copy(self, tensor):
+        r"""
+        Starts copying `tensor` to the host and returns the host tensor.
+        """
+        if self._stream is None:
+            return tensor.cpu()
+        host = _pin(torch.empty(tensor.shape, dtype=tensor.dtype))
+        self._stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self._stream):
+            host.copy_(tensor, non_blocking=True)
+        # the caching allocator must not reuse the memory before the copy
+        tensor.record_stream(self._stream)
+        return host
+
+    def synchronize(self):
+        r"""
+        Waits until all copies have landed.
+        """
+        if self._stream is not None:
+            self._stream.synchronize()
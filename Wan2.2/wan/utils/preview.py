@@ -0,0 +1,183 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import logging
+import os
+
+import torch
+import torch.nn.functional as F
+
+__all__ = [
+    'LatentPreviewer', 'fit_preview', 'pool_to_latent', 'synthetic_videos'
+]
+
+
+def synthetic_videos(num_videos=8, frame_num=17, size=(256, 256), seed=0):
+    r"""
+    Smooth random colour fields that drift over time, in [-1, 1]. They cover
+    the colour space well enough to fit a linear preview without any media.
+
+    Returns:
+        `list[Tensor]`: Videos of shape [3, frame_num, H, W].
+    """
+    g = torch.Generator().manual_seed(seed)
+    h, w = size
+    videos = []
+    for _ in range(num_videos):
+        cells = int(torch.randint(2, 9, (1,), generator=g))
+        field = torch.rand(1, 3, cells + 1, cells, generator=g) * 2 - 1
+        # taller than a frame, so that the frames can slide over it
+        field = F.interpolate(
+            field, size=(h + 2 * frame_num, w), mode='bicubic',
+            align_corners=False).clamp_(-1, 1)[0]
+        videos.append(
+            torch.stack([field[:, 2 * i:2 * i + h] for i in range(frame_num)],
+                        dim=1))
+    return videos
+
+
+def pool_to_latent(video, latent_shape, stride_t=4):
+    r"""
+    Averages a decoded video [3, F, H, W] down to the latent grid
+    `latent_shape` (T, h, w): the first latent frame covers the first frame,
+    every later one the next `stride_t` frames.
+    """
+    video = torch.cat(
+        [video[:, :1], video[:, 1:].unflatten(1, (-1, stride_t)).mean(2)],
+        dim=1)
+    assert video.shape[1] == latent_shape[0]
+    return F.adaptive_avg_pool2d(video, tuple(latent_shape[1:]))
+
+
+@torch.no_grad()
+def fit_preview(vae, videos, vae_stride=(4, 8, 8)):
+    r"""
+    Fits the linear map from normalized latents to RGB by least squares
+    against the decoder output of `vae`. Every latent pixel is paired with
+    the mean colour of the decoded block it covers.
+
+    Args:
+        vae (`Wan2_1_VAE` or `Wan2_2_VAE`):
+            VAE whose latent space is previewed.
+        videos (`list[Tensor]`):
+            Calibration videos [3, 1 + 4k, H, W] in [-1, 1], with H and W
+            multiples of the spatial stride.
+        vae_stride (`tuple[int]`, *optional*, defaults to (4, 8, 8)):
+            Temporal and spatial strides of the VAE.
+
+    Returns:
+        `tuple[Tensor]`: Weight [3, C] and bias [3] in float32.
+    """
+    inputs, targets = [], []
+    for video in videos:
+        z = vae.encode([video.to(vae.device)])[0].float()
+        x = pool_to_latent(vae.decode([z])[0].float(), z.shape[1:],
+                           vae_stride[0])
+        inputs.append(z.flatten(1).t().cpu())
+        targets.append(x.flatten(1).t().cpu())
+    inputs = torch.cat(inputs)
+    inputs = torch.cat([inputs, torch.ones_like(inputs[:, :1])], dim=1)
+    solution = torch.linalg.lstsq(inputs, torch.cat(targets)).solution
+    return solution[:-1].t().contiguous(), solution[-1].contiguous()
+
+
+class LatentPreviewer:
+    r"""
+    Cheap latent-to-RGB preview for the sampling loops.
+
+    A fitted 1x1 projection maps every latent pixel to a colour, so a preview
+    costs one small matmul instead of a VAE decode and comes out at latent
+    resolution, one frame per latent frame. The projection is read from
+    `checkpoint`, written by `calibrate_preview.py`. Fitting it takes several
+    VAE passes, so it is never done here: without a checkpoint, previews are
+    disabled with a warning.
+    """
+
+    def __init__(self, vae, checkpoint=None, vae_stride=(4, 8, 8)):
+        r"""
+        Args:
+            vae (`Wan2_1_VAE` or `Wan2_2_VAE`):
+                VAE whose latent space is previewed.
+            checkpoint (`str`, *optional*, defaults to None):
+                Path of the fitted projection.
+            vae_stride (`tuple[int]`, *optional*, defaults to (4, 8, 8)):
+                Temporal and spatial strides of the VAE.
+        """
+        self.vae = vae
+        self.checkpoint = checkpoint
+        self.vae_stride = vae_stride
+        self.weight = None
+        self.bias = None
+        self._warned = False
+
+    def load(self):
+        r"""
+        Reads the projection from `checkpoint` unless it is already set.
+
+        Returns:
+            `bool`: Whether the projection is available. The first miss logs
+            a warning.
+        """
+        if self.weight is not None:
+            return True
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            if not self._warned:
+                logging.warning(
+                    f"No latent preview weights at {self.checkpoint}, previews "
+                    f"are disabled. Run calibrate_preview.py to create them.")
+                self._warned = True
+            return False
+        z_dim = self.vae.model.z_dim
+        state = torch.load(self.checkpoint, map_location='cpu')
+        assert state['weight'].shape == (3, z_dim), (
+            f"{self.checkpoint} does not match a {z_dim}-channel VAE.")
+        self.weight, self.bias = state['weight'], state['bias']
+        return True
+
+    def save(self, checkpoint=None):
+        checkpoint = checkpoint or self.checkpoint
+        if checkpoint is None:
+            return
+        try:
+            torch.save({
+                'weight': self.weight,
+                'bias': self.bias
+            }, checkpoint)
+        except OSError as e:
+            logging.warning(f"Failed to write latent preview weights: {e}")
+
+    @torch.no_grad()
+    def __call__(self, latent):
+        r"""
+        Args:
+            latent (Tensor):
+                Normalized latent video of shape [C, T, H, W].
+
+        Returns:
+            Tensor: RGB preview [3, T, H, W] in [-1, 1], on the latent device.
+        """
+        if not self.load():
+            raise RuntimeError(
+                f"No latent preview weights at {self.checkpoint}.")
+        weight = self.weight.to(latent.device)
+        bias = self.bias.to(latent.device)
+        return torch.einsum('rc,cthw->rthw', weight,
+                            latent.float()).add_(bias.view(3, 1, 1, 1)).clamp_(
+                                -1, 1)
+
+    def hook(self, callback, interval, num_steps, num_train_timesteps):
+        r"""
+        Returns a function `(step, t, latent, flow)` for the sampling loop
+        that passes a preview of the denoised estimate to
+        `callback(step, preview)` every `interval` steps and at the last step,
+        or None if there are no preview weights.
+        """
+        if not self.load():
+            return None
+
+        def preview(step, t, latent, flow):
+            if (step + 1) % interval != 0 and step + 1 != num_steps:
+                return
+            # flow matching: x_0 = x_t - sigma_t * v
+            sigma = float(t) / num_train_timesteps
+            callback(step, self(latent - sigma * flow))
+
+        return preview
@@ -0,0 +1,187 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import hashlib
+import logging
+import os
+
+import torch
+import torch.distributed as dist
+
+from .audio_cache import _file_digest
+
+__all__ = ['SamplingSnapshot', 'job_key', 'snapshot_seed']
+
+# multistep state of the flow matching schedulers, whichever they define
+SCHEDULER_STATE = ('model_outputs', 'timestep_list', 'last_sample',
+                   'lower_order_nums', 'this_order', '_step_index',
+                   '_begin_index')
+
+
+def job_key(*parts, files=()):
+    r"""
+    Digest of the inputs that define a job. Images and arrays contribute
+    their content, anything else its `repr`. The input files in `files`
+    contribute their content, not their path, so a file replaced at the same
+    path makes a different job. None entries of `files` are skipped.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, torch.Tensor):
+            part = part.cpu().numpy()
+        digest.update(part.tobytes() if hasattr(part, 'tobytes') else repr(
+            part).encode('utf-8'))
+    for path in files:
+        digest.update(b'None' if path is None else _file_digest(path).encode(
+            'utf-8'))
+    return digest.hexdigest()
+
+
+def _load(path):
+    # only rank 0 writes the snapshot, so only rank 0 reads it and the other
+    # ranks, which may not see the file at all, e.g. on a node-local path,
+    # receive its state and resume at the same step
+    distributed = dist.is_initialized() and dist.get_world_size() > 1
+    state = None
+    if (not distributed or dist.get_rank() == 0) and os.path.exists(path):
+        try:
+            state = torch.load(path, map_location='cpu')
+        except Exception as e:
+            logging.warning(f"Failed to read snapshot {path}: {e}")
+    if distributed:
+        state = [state]
+        dist.broadcast_object_list(state, src=0)
+        state = state[0]
+    return state
+
+
+def snapshot_seed(path):
+    r"""
+    Returns the seed of the job that took the snapshot at `path`, or None if
+    there is no readable snapshot. A run without a fixed seed takes it to
+    resume. In a distributed run, every rank has to call it, and all of them
+    get the seed of the snapshot of rank 0.
+    """
+    if path is None:
+        return None
+    state = _load(path)
+    return state.get('seed') if state is not None else None
+
+
+def _to(value, device):
+    if isinstance(value, torch.Tensor):
+        return value.to(device)
+    if isinstance(value, list):
+        return [_to(v, device) for v in value]
+    return value
+
+
+class SamplingSnapshot:
+    r"""
+    Periodic snapshot of a sampling loop, to resume a long render after the
+    process died.
+
+    Every `interval` steps the latent, the multistep state of the scheduler
+    and the state of the sampling generator are written to `path`, so that a
+    resumed loop continues exactly where the snapshot was taken. The final
+    latent of every clip is kept as well: a resumed multi-clip run only
+    decodes the finished clips again instead of sampling them. A snapshot is
+    only resumed by a job with the same `key`, e.g. prompt, seed and shape.
+    The seed is stored as well, see `snapshot_seed`.
+
+    In a distributed run, every rank creates the snapshot and rank 0 alone
+    reads and writes the file, then shares its state with the other ranks.
+
+    The state of the step cache is not part of the snapshot. A resumed run
+    with the step cache starts with a full forward and skips other steps than
+    the run that was interrupted, so its result is close to, but not exactly
+    the same as, that of an uninterrupted run.
+    """
+
+    def __init__(self, path, interval=5, key=None, save=True, seed=None):
+        r"""
+        Args:
+            path (`str`):
+                Snapshot file, read at start by rank 0 and rewritten
+                atomically.
+            interval (`int`, *optional*, defaults to 5):
+                Number of steps between two snapshots.
+            key (`str`, *optional*, defaults to None):
+                Identity of the job, see `job_key`. A snapshot is only
+                resumed by a job with the same key.
+            save (`bool`, *optional*, defaults to True):
+                Whether this process writes the snapshot, i.e. rank 0 only.
+            seed (`int`, *optional*, defaults to None):
+                Seed of the job, stored so that a rerun without a fixed seed
+                can resume.
+        """
+        self.path = path
+        self.interval = interval
+        self.key = key
+        self.save = save
+        self.state = {'key': self.key, 'seed': seed, 'clips': []}
+        state = _load(path)
+        if state is not None:
+            if state.get('key') == self.key:
+                self.state = state
+                logging.info(
+                    f"Resuming from snapshot {path}: clip "
+                    f"{state.get('clip', len(state['clips']))}, step "
+                    f"{state.get('step', 0)}, {len(state['clips'])} "
+                    f"finished clips.")
+            else:
+                logging.warning(
+                    f"Ignoring snapshot {path}, it was taken for a different "
+                    f"job. Resuming needs the same arguments and inputs.")
+
+    def restore(self, clip, scheduler, generator, latent):
+        r"""
+        Restores `scheduler` and `generator` of `clip` from the snapshot.
+
+        Returns:
+            `tuple`: The step to continue from and the latent, `latent` itself
+            if the snapshot holds nothing for `clip`. A finished clip comes
+            back at its last step with its final latent.
+        """
+        if clip < len(self.state['clips']):
+            return len(scheduler.timesteps), _to(self.state['clips'][clip],
+                                                 latent.device)
+        if self.state.get('clip') != clip:
+            return 0, latent
+        for name, value in self.state['scheduler'].items():
+            setattr(scheduler, name, _to(value, latent.device))
+        generator.set_state(self.state['rng'])
+        return self.state['step'], _to(self.state['latent'], latent.device)
+
+    def step(self, clip, step, latent, scheduler, generator):
+        r"""
+        Records the state after `step` of `clip`, every `interval` steps and
+        at the last step, which finishes the clip.
+        """
+        num_steps = len(scheduler.timesteps)
+        if not self.save or ((step + 1) % self.interval != 0 and
+                             step + 1 != num_steps):
+            return
+        if step + 1 == num_steps:
+            for name in ('clip', 'step', 'latent', 'scheduler', 'rng'):
+                self.state.pop(name, None)
+            self.state['clips'].append(latent.cpu())
+        else:
+            self.state.update(
+                clip=clip,
+                step=step + 1,
+                latent=latent.cpu(),
+                scheduler={
+                    name: _to(getattr(scheduler, name), 'cpu')
+                    for name in SCHEDULER_STATE
+                    if hasattr(scheduler, name)
+                },
+                rng=generator.get_state())
+        tmp = self.path + '.tmp'
+        torch.save(self.state, tmp)
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        r"""
+        Removes the snapshot once the job has finished.
+        """
+        if self.save and os.path.exists(self.path):
+            os.remove(self.path)
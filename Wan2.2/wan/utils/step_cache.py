@@ -0,0 +1,121 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import torch
+import torch.distributed as dist
+
+__all__ = ['StepCache']
+
+
+class _StreamState:
+
+    def __init__(self):
+        self.modulated = None
+        self.residual = None
+        self.accumulated = 0.0
+
+
+class StepCache:
+    r"""
+    Residual cache that skips the transformer blocks of `WanModel` on steps
+    where their input barely changed.
+
+    Each forward measures the relative L1 change of the timestep-modulated
+    input of the first block with respect to the previous step. The changes
+    are accumulated, and while the sum stays below `threshold` the forward
+    reuses the residual (output minus input of the block stack) of the last
+    computed step instead of running the blocks. Once the sum reaches the
+    threshold the blocks run again and the sum is reset.
+
+    Every guidance branch (conditional, unconditional or both when batched)
+    and every expert keeps its own state, keyed by the model and the text
+    context passed to the forward. Each state holds two activations of shape
+    [B, L, C].
+    """
+
+    def __init__(self, threshold=0.1, warmup_steps=1, num_steps=None):
+        r"""
+        Args:
+            threshold (`float`, *optional*, defaults to 0.1):
+                Accumulated relative L1 change below which the cached
+                residual is reused. Higher values skip more steps.
+            warmup_steps (`int`, *optional*, defaults to 1):
+                Number of leading steps that are always computed.
+            num_steps (`int`, *optional*, defaults to None):
+                Total number of sampling steps. If given, the last step is
+                always computed.
+        """
+        self.threshold = threshold
+        self.warmup_steps = warmup_steps
+        self.num_steps = num_steps
+        self.step = 0
+        self.skipped = 0
+        self.total = 0
+        self._states = {}
+
+    def begin_step(self, step):
+        r"""
+        Marks the start of sampling step `step`.
+        """
+        self.step = step
+
+    def _state(self, model, branch):
+        key = (id(model), tuple(u.data_ptr() for u in branch))
+        if key not in self._states:
+            self._states[key] = _StreamState()
+        return self._states[key]
+
+    def _must_compute(self, state, modulated):
+        if state.residual is None or state.modulated is None:
+            return True
+        if state.modulated.shape != modulated.shape:
+            return True
+        if self.step < self.warmup_steps:
+            return True
+        return self.num_steps is not None and self.step >= self.num_steps - 1
+
+    def _relative_change(self, prev, cur, group):
+        stats = torch.stack([(cur - prev).abs().sum(), prev.abs().sum()])
+        if group is not None:
+            # every rank holds a shard of the sequence, so all ranks must
+            # reach the same decision
+            dist.all_reduce(stats, group=group)
+        return (stats[0] / stats[1].clamp(min=1e-12)).item()
+
+    def __call__(self, model, x, modulated, branch, run_blocks, group=None):
+        r"""
+        Runs or skips the block stack of one forward.
+
+        Args:
+            model (`torch.nn.Module`):
+                The model running the forward.
+            x (Tensor):
+                Input of the first block, shape [B, L, C].
+            modulated (Tensor):
+                Timestep-modulated input of the first block, shape [B, L, C].
+            branch (List[Tensor]):
+                Text context passed to the forward, identifies the guidance
+                branch.
+            run_blocks (`Callable`):
+                Maps `x` and `modulated` to the output of the block stack, so
+                the first block does not compute `modulated` again.
+            group (`ProcessGroup`, *optional*, defaults to None):
+                Sequence parallel group the sequence is sharded over.
+
+        Returns:
+            Tensor: Output of the block stack, shape [B, L, C].
+        """
+        state = self._state(model, branch)
+        compute = self._must_compute(state, modulated)
+        if not compute:
+            state.accumulated += self._relative_change(state.modulated,
+                                                       modulated, group)
+            compute = state.accumulated >= self.threshold
+        state.modulated = modulated
+        self.total += 1
+
+        if compute:
+            state.accumulated = 0.0
+            out = run_blocks(x, modulated)
+            state.residual = out - x
+            return out
+        self.skipped += 1
+        return x + state.residual
@@ -0,0 +1,124 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from safetensors.torch import load_file, save_file
+
+__all__ = ['TextEmbeddingCache']
+
+
+class TextEmbeddingCache:
+    r"""
+    Content-addressed cache of text encoder outputs.
+
+    Entries are looked up in an in-memory LRU tier first and in an optional
+    on-disk safetensors tier second. The disk tier evicts the least recently
+    used files once its total size exceeds `max_disk_bytes`.
+    """
+
+    def __init__(self,
+                 cache_dir=None,
+                 max_memory_items=16,
+                 max_disk_bytes=1024**3):
+        r"""
+        Args:
+            cache_dir (`str`, *optional*, defaults to None):
+                Directory of the on-disk tier. If None, only the in-memory
+                tier is used.
+            max_memory_items (`int`, *optional*, defaults to 16):
+                Number of embeddings kept in host memory.
+            max_disk_bytes (`int`, *optional*, defaults to 1 GiB):
+                Size budget of the on-disk tier.
+        """
+        self.cache_dir = cache_dir
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        r"""
+        Hashes `parts` (strings and numbers) into a cache key.
+        """
+        blob = json.dumps([str(p) for p in parts], ensure_ascii=False)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.safetensors')
+
+    def _remember(self, key, tensor):
+        self._memory[key] = tensor
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key, device=None):
+        r"""
+        Returns the embedding stored under `key` on `device`, or None.
+        """
+        with self._lock:
+            tensor = self._memory.get(key)
+            if tensor is not None:
+                self._memory.move_to_end(key)
+            elif self.cache_dir is not None and os.path.exists(self._path(key)):
+                try:
+                    tensor = load_file(self._path(key))['context']
+                    os.utime(self._path(key))
+                    self._remember(key, tensor)
+                except Exception as e:
+                    logging.warning(f'Dropping unreadable cache entry {key}: {e}')
+                    self._remove(self._path(key))
+        if tensor is None:
+            return None
+        return tensor.to(device) if device is not None else tensor
+
+    def put(self, key, tensor):
+        r"""
+        Stores a copy of `tensor` under `key` in every enabled tier.
+        """
+        tensor = tensor.detach().to('cpu', copy=True).contiguous()
+        with self._lock:
+            self._remember(key, tensor)
+            if self.cache_dir is None:
+                return
+            tmp = self._path(key) + '.tmp'
+            try:
+                save_file({'context': tensor}, tmp)
+                os.replace(tmp, self._path(key))
+            except Exception as e:
+                logging.warning(f'Failed to write cache entry {key}: {e}')
+                self._remove(tmp)
+                return
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.safetensors'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(u[1] for u in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
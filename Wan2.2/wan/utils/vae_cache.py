@@ -0,0 +1,117 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import torch
+import torch.nn.functional as F
+
+__all__ = ['CausalCache', 'shape_batches']
+
+
+class CausalCache:
+    r"""
+    Temporal caches of the causal convolutions of one chunked VAE pass.
+
+    Every cached conv keeps the last input frames of the previous chunk in a
+    buffer that is allocated on the first chunk and updated in place. The
+    history and the new frames are assembled in a workspace that is shared by
+    all convs of the same input shape, and the conv pads spatially by itself,
+    so a chunk neither clones, concatenates nor pads its inputs. The history
+    starts as zeros, which matches the zero padding of the first chunk.
+    """
+
+    def __init__(self, num_layers, workspaces=None):
+        r"""
+        Args:
+            num_layers (`int`):
+                Number of cached layers, an upper bound is fine.
+            workspaces (`dict`, *optional*, defaults to None):
+                Workspaces to share with other caches that run one after the
+                other, e.g. the tiles of a frame.
+        """
+        self.histories = [None] * num_layers
+        self.primed = [False] * num_layers
+        self.workspaces = {} if workspaces is None else workspaces
+
+    def _workspace(self, shape, dtype, device):
+        key = (tuple(shape), dtype, device)
+        ws = self.workspaces.get(key)
+        if ws is None:
+            ws = self.workspaces[key] = torch.empty(
+                shape, dtype=dtype, device=device)
+        return ws
+
+    def prime(self, idx):
+        r"""
+        Returns True the first time layer `idx` is visited and False after,
+        for layers that treat the first chunk specially.
+        """
+        first = not self.primed[idx]
+        self.primed[idx] = True
+        return first
+
+    def store(self, x, idx, frames):
+        r"""
+        Records the last `frames` frames of `x` as the history of layer `idx`.
+        """
+        history = self._history(x, idx, frames)
+        n = min(frames, x.size(2))
+        history[:, :, frames - n:].copy_(x[:, :, x.size(2) - n:])
+
+    def _history(self, x, idx, frames):
+        history = self.histories[idx]
+        if history is None:
+            b, c, _, h, w = x.shape
+            history = self.histories[idx] = x.new_zeros(b, c, frames, h, w)
+        return history
+
+    def conv(self, conv, x, idx, frames=None):
+        r"""
+        Applies the causal `conv` to `x` preceded by the history of layer
+        `idx`, then makes the last `frames` frames the new history.
+
+        Args:
+            conv (`CausalConv3d`):
+                Convolution whose temporal padding is replaced by the history.
+            x (Tensor):
+                Input chunk of shape [B, C, T, H, W].
+            idx (`int`):
+                Index of the layer in the cache.
+            frames (`int`, *optional*, defaults to None):
+                Number of history frames, the temporal padding of `conv` if
+                None.
+        """
+        frames = conv._padding[4] if frames is None else frames
+        history = self._history(x, idx, frames)
+        b, c, t, h, w = x.shape
+        ws = self._workspace((b, c, frames + t, h, w), x.dtype, x.device)
+        ws[:, :, :frames].copy_(history)
+        ws[:, :, frames:].copy_(x)
+        history.copy_(ws[:, :, t:])
+        return F.conv3d(ws, conv.weight, conv.bias, conv.stride,
+                        (0, conv._padding[2], conv._padding[0]), conv.dilation,
+                        conv.groups)
+
+
+def shape_batches(tensors, batch_size=None):
+    r"""
+    Groups the indices of `tensors` that share shape, dtype and device into
+    batches of at most `batch_size`, so that each batch can be stacked into
+    one VAE pass. The causal caches are batched like their inputs, so every
+    sample keeps its own history.
+
+    Args:
+        tensors (`list[Tensor]`):
+            Videos or latents.
+        batch_size (`int`, *optional*, defaults to None):
+            Largest batch, unbounded if None.
+
+    Returns:
+        `list[list[int]]`: Indices into `tensors`, in order within a batch.
+    """
+    groups = {}
+    for i, u in enumerate(tensors):
+        groups.setdefault((tuple(u.shape), u.dtype, u.device), []).append(i)
+    batches = []
+    for indices in groups.values():
+        step = batch_size or len(indices)
+        batches.extend(
+            indices[j:j + step] for j in range(0, len(indices), step))
+    return batches
@@ -0,0 +1,85 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import itertools
+
+import torch
+
+__all__ = ['tile_spans', 'tile_grid', 'blend_tiles']
+
+
+def tile_spans(size, tile_size=None, overlap=8):
+    r"""
+    Splits an axis of `size` latent pixels into overlapping `(start, end)`
+    spans of at most `tile_size` pixels. Returns a single span covering the
+    axis if `tile_size` is None or not smaller than `size`.
+    """
+    if tile_size is None or size <= tile_size:
+        return [(0, size)]
+    assert 0 <= overlap < tile_size, "`overlap` must be smaller than the tile."
+    starts = list(range(0, size - tile_size + 1, tile_size - overlap))
+    if starts[-1] + tile_size < size:
+        starts.append(size - tile_size)
+    return [(s, s + tile_size) for s in starts]
+
+
+def tile_grid(height, width, tile_size=None, overlap=8):
+    r"""
+    Returns the row and column spans of a tiled latent frame and the
+    row-major list of `(row_span, col_span)` tiles.
+    """
+    spans_h = tile_spans(height, tile_size, overlap)
+    spans_w = tile_spans(width, tile_size, overlap)
+    return spans_h, spans_w, list(itertools.product(spans_h, spans_w))
+
+
+def _ramp(spans, i, scale, device):
+    # weights of tile `i` along one axis, fading linearly across the overlap
+    # with its neighbours and flat elsewhere
+    start, end = spans[i]
+    weight = torch.ones((end - start) * scale, device=device)
+    if i > 0:
+        lead = (spans[i - 1][1] - start) * scale
+        if lead > 0:
+            weight[:lead] = torch.arange(
+                1, lead + 1, device=device) / (lead + 1)
+    if i < len(spans) - 1:
+        trail = (end - spans[i + 1][0]) * scale
+        if trail > 0:
+            weight[-trail:] = torch.arange(
+                trail, 0, -1, device=device) / (trail + 1)
+    return weight
+
+
+def blend_tiles(chunks, spans_h, spans_w):
+    r"""
+    Stitches decoded tiles into one frame chunk, blending overlapping seams.
+
+    Args:
+        chunks (List[Tensor]):
+            Decoded tiles in row-major order, each with shape
+            [B, C, T, h * scale, w * scale].
+        spans_h (List[Tuple[int]]):
+            Latent row spans of the tiles.
+        spans_w (List[Tuple[int]]):
+            Latent column spans of the tiles.
+
+    Returns:
+        Tensor: The stitched chunk, shape [B, C, T, H * scale, W * scale].
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+    scale = chunks[0].size(-1) // (spans_w[0][1] - spans_w[0][0])
+    b, c, t = chunks[0].shape[:3]
+    device = chunks[0].device
+    out = chunks[0].new_zeros(b, c, t, spans_h[-1][1] * scale,
+                              spans_w[-1][1] * scale)
+    total = torch.zeros(out.shape[-2:], dtype=out.dtype, device=device)
+    for k, chunk in enumerate(chunks):
+        i, j = divmod(k, len(spans_w))
+        weight = torch.outer(
+            _ramp(spans_h, i, scale, device),
+            _ramp(spans_w, j, scale, device)).to(out.dtype)
+        rows = slice(spans_h[i][0] * scale, spans_h[i][1] * scale)
+        cols = slice(spans_w[j][0] * scale, spans_w[j][1] * scale)
+        out[..., rows, cols] += chunk * weight
+        total[rows, cols] += weight
+    return out / total
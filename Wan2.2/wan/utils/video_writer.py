@@ -0,0 +1,162 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import logging
+import os
+import queue
+import subprocess
+import threading
+
+import torch
+
+__all__ = ['VideoWriter']
+
+
+def _ffmpeg_exe():
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return 'ffmpeg'
+
+
+class VideoWriter:
+    r"""
+    Encodes video frames with ffmpeg while they are still being produced.
+
+    Frame chunks passed to `write` are queued, converted to uint8 on a
+    background thread and piped to a single ffmpeg process. If `audio_path`
+    is given, the audio track is muxed by the same process, with the duration
+    set to the shorter of the two streams.
+
+    Use it as a context manager: the file is finalized on a clean exit and
+    removed if the body raises.
+    """
+
+    def __init__(self,
+                 save_file,
+                 fps=30,
+                 audio_path=None,
+                 value_range=(-1, 1),
+                 crf=10,
+                 max_pending=4):
+        r"""
+        Args:
+            save_file (`str`):
+                Path of the output video.
+            fps (`int`, *optional*, defaults to 30):
+                Frame rate of the output video.
+            audio_path (`str`, *optional*, defaults to None):
+                Audio file muxed into the output video.
+            value_range (`tuple[float]`, *optional*, defaults to (-1, 1)):
+                Value range of the frames passed to `write`.
+            crf (`int`, *optional*, defaults to 10):
+                Constant rate factor of libx264, lower is better quality.
+            max_pending (`int`, *optional*, defaults to 4):
+                Number of chunks that may wait for conversion before `write`
+                blocks.
+        """
+        if audio_path is not None and not os.path.exists(audio_path):
+            raise FileNotFoundError(f"audio file {audio_path} does not exist")
+        self.save_file = save_file
+        self.fps = fps
+        self.audio_path = audio_path
+        self.value_range = value_range
+        self.crf = crf
+        self.num_frames = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._proc = None
+        self._thread = None
+        self._error = None
+        self.aborted = False
+
+    def _start(self, height, width):
+        command = [
+            _ffmpeg_exe(), '-y', '-loglevel', 'error', '-f', 'rawvideo',
+            '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r',
+            str(self.fps), '-i', '-'
+        ]
+        if self.audio_path is not None:
+            command += [
+                '-i', self.audio_path, '-map', '0:v:0', '-map', '1:a:0',
+                '-c:a', 'aac', '-b:a', '192k', '-shortest'
+            ]
+        command += [
+            '-c:v', 'libx264', '-crf',
+            str(self.crf), '-pix_fmt', 'yuv420p', '-vf',
+            'pad=ceil(iw/2)*2:ceil(ih/2)*2', self.save_file
+        ]
+        self._proc = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        low, high = min(self.value_range), max(self.value_range)
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            if self._error is not None:
+                # keep draining so that `write` never blocks
+                continue
+            try:
+                frames = ((chunk.clamp(low, high) - low) / (high - low) *
+                          255).to(torch.uint8)
+                frames = frames.permute(1, 2, 3, 0).contiguous().cpu()
+                self._proc.stdin.write(frames.numpy().tobytes())
+            except Exception as e:
+                self._error = e
+
+    def write(self, chunk):
+        r"""
+        Queues a chunk of frames with shape [C, T, H, W].
+        """
+        if self._error is not None:
+            raise RuntimeError(f"VideoWriter failed: {self._error}")
+        if self._proc is None:
+            self._start(chunk.size(2), chunk.size(3))
+        self.num_frames += chunk.size(1)
+        self._queue.put(chunk.detach())
+
+    def close(self):
+        r"""
+        Flushes the queued frames and finalizes the file.
+
+        Returns:
+            `str`: Path of the written video.
+        """
+        if self._proc is None:
+            raise RuntimeError("VideoWriter received no frames.")
+        self._queue.put(None)
+        self._thread.join()
+        self._proc.stdin.close()
+        stderr = self._proc.stderr.read().decode(errors='ignore')
+        if self._proc.wait() != 0 or self._error is not None:
+            raise RuntimeError(
+                f"VideoWriter failed: {self._error or stderr.strip()}")
+        logging.info(f"Wrote {self.num_frames} frames to {self.save_file}")
+        return self.save_file
+
+    def abort(self):
+        r"""
+        Stops ffmpeg and removes the partial file.
+        """
+        self.aborted = True
+        if self._proc is None:
+            return
+        self._error = self._error or RuntimeError("aborted")
+        self._proc.kill()
+        self._queue.put(None)
+        self._thread.join()
+        self._proc.wait()
+        if os.path.exists(self.save_file):
+            os.remove(self.save_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None and not self.aborted:
+            self.close()
+        else:
+            self.abort()
+        return False